@@ -0,0 +1,74 @@
+"""
+Compares the inference backends on the same images: seconds per image, model size and tag agreement with the
+float model. Without --model a randomly initialised ResNet50 of the same input and output size stands in for
+deepdanbooru, its timings are representative but its tags are not, use a real model for the agreement.
+
+    python -m benchmarks.bench_backends --images 32 --model models/deepdanbooru-v3-20211112-sgd-e28
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from benchmarks.synthetic import make_images
+from src.commands.backends import (INFERENCE_BACKENDS, load_backend, calibration_images, compare_backends,
+                                   format_agreement)
+from src.commands.load_actions import load_model
+from src.commands.pipeline import list_images
+
+
+def time_model(model, images: list[np.ndarray], batch_size: int) -> float:
+    """
+    :return: seconds per image, after one batch to warm up
+    """
+    batches = [np.stack(images[start:start + batch_size]) for start in range(0, len(images), batch_size)]
+    model.predict_on_batch(batches[0])
+    start = time.perf_counter()
+    for batch in batches:
+        model.predict_on_batch(batch)
+    return (time.perf_counter() - start) / len(images)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", help="model folder, a random ResNet50 stands in if not given")
+    parser.add_argument("--directory", help="images to run on, synthetic ones are made if not given")
+    parser.add_argument("--images", type=int, default=32)
+    parser.add_argument("--labels", type=int, default=9176, help="outputs of the stand-in model")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--backends", nargs="+", choices=INFERENCE_BACKENDS, default=list(INFERENCE_BACKENDS))
+    args = parser.parse_args()
+
+    if args.model:
+        model = load_model(args.model)
+    else:
+        model = tf.keras.applications.ResNet50(weights=None, input_shape=(512, 512, 3), classes=args.labels + 3,
+                                               classifier_activation="sigmoid")
+    workdir = tempfile.mkdtemp(prefix="bench_backends_")
+    try:
+        if args.directory:
+            image_paths = list_images(args.directory)[:args.images]
+        else:
+            image_paths = make_images(os.path.join(workdir, "images"), args.images)
+        images = calibration_images(image_paths, model.input_shape[1:3], args.images)
+        for backend in args.backends:
+            start = time.perf_counter()
+            converted, _ = load_backend(model, backend, image_paths, args.images)
+            converted_in = time.perf_counter() - start
+            size = getattr(converted, "nbytes", None) or sum(weight.nbytes for weight in model.get_weights())
+            print(f"{backend:12} {time_model(converted, images, args.batch_size) * 1000:8.1f} ms/image  "
+                  f"{size / 2 ** 20:7.1f} MB  converted in {converted_in:5.1f}s")
+            if backend != "keras":
+                print("   ", format_agreement(compare_backends(model, converted, images, args.batch_size)))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
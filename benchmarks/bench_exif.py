@@ -0,0 +1,63 @@
+"""
+Compares writing tags by splicing the Exif block into the file with saving the image again through PIL.
+
+    python -m benchmarks.bench_exif --images 32 --resolution 3000x2000 --format jpg
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from benchmarks.synthetic import make_images
+from src.commands.exif_actions import write_tags, reencode_tags
+
+TAGS = ", ".join(f"tag_{i}" for i in range(40))
+
+
+def time_writer(writer, paths: list[str]) -> float:
+    """
+    :param writer: write_tags or reencode_tags
+    :param paths: images to tag
+    :return: wall time in seconds
+    """
+    start = time.perf_counter()
+    for path in paths:
+        writer(path, TAGS)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=32)
+    parser.add_argument("--resolution", default="3000x2000", help="WIDTHxHEIGHT of the generated images")
+    parser.add_argument("--format", default="jpg", help="jpg or png")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    resolution = tuple(int(side) for side in args.resolution.split("x"))
+
+    workdir = tempfile.mkdtemp(prefix="bench_exif_")
+    try:
+        originals = make_images(os.path.join(workdir, "originals"), args.images, resolution, args.format)
+        times = {"reencode": [], "splice": []}
+        for _ in range(args.repeat):
+            for name, writer in (("reencode", reencode_tags), ("splice", write_tags)):
+                copies = os.path.join(workdir, name)
+                shutil.rmtree(copies, ignore_errors=True)
+                shutil.copytree(os.path.dirname(originals[0]), copies)
+                paths = [os.path.join(copies, os.path.basename(path)) for path in originals]
+                times[name].append(time_writer(writer, paths))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    reencode, splice = min(times["reencode"]), min(times["splice"])
+    print(f"{args.images} {args.format} images at {args.resolution}")
+    print(f"reencode: {reencode * 1000:8.2f} ms ({reencode / args.images * 1000:8.2f} ms/image)")
+    print(f"splice:   {splice * 1000:8.2f} ms ({splice / args.images * 1000:8.2f} ms/image)")
+    print(f"speedup:  {reencode / splice:8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Compares the vectorised TagPostProcessor with the per label loop it replaced.
+
+    python -m benchmarks.bench_postprocess --images 256 --labels 9000
+"""
+from __future__ import annotations
+
+import argparse
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from src.commands.postprocess import TagPostProcessor
+
+
+def legacy_postprocess(probs, labels, char_labels, score_threshold, char_threshold):
+    """
+    Label matching loop as it was in predict before TagPostProcessor, kept as a reference
+    :return: (result_threshold, result_all, result_rating, result_char, result_text) for one image
+    """
+    rating_labels = ["rating:safe", "rating:questionable", "rating:explicit"]
+    rating_probs = probs[-3:]
+
+    probs = probs[:-3]
+    result_rating = OrderedDict(zip(rating_labels, rating_probs))
+
+    indices = np.argsort(probs)[::-1]
+
+    result_all = OrderedDict()
+    result_threshold = OrderedDict()
+    result_char = OrderedDict()
+
+    for index in indices:
+        label = labels[index]
+        prob = probs[index]
+
+        result_all[label] = prob
+
+        if prob < score_threshold and prob < char_threshold:
+            break
+
+        if prob > score_threshold and label not in char_labels:
+            result_threshold[label] = prob
+        if prob > char_threshold and label in char_labels:
+            result_char[label] = prob
+
+    result_text = ', '.join(result_all.keys())
+    return result_threshold, result_all, result_rating, result_char, result_text
+
+
+def synthetic_probs(n_images: int, n_labels: int, seed: int = 0) -> np.ndarray:
+    """
+    Model like output, most labels are close to 0 and a few are confident
+    """
+    rng = np.random.default_rng(seed)
+    return rng.beta(0.005, 1.0, size=(n_images, n_labels + 3))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=256)
+    parser.add_argument("--labels", type=int, default=9000)
+    parser.add_argument("--threshold", type=float, default=0.5)
+    parser.add_argument("--char-threshold", type=float, default=0.85)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    labels = [f"tag_{i}" for i in range(args.labels)]
+    char_labels = set(labels[-args.labels // 10:])
+    probs = synthetic_probs(args.images, args.labels)
+    postprocessor = TagPostProcessor(labels, char_labels)
+
+    loop_times, vector_times = [], []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        for row in probs:
+            legacy_postprocess(row, labels, char_labels, args.threshold, args.char_threshold)
+        loop_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        postprocessor.process(probs, args.threshold, args.char_threshold)
+        vector_times.append(time.perf_counter() - start)
+
+    loop, vector = min(loop_times), min(vector_times)
+    print(f"{args.images} images x {args.labels} labels")
+    print(f"loop:       {loop * 1000:8.2f} ms ({loop / args.images * 1e6:8.1f} us/image)")
+    print(f"vectorised: {vector * 1000:8.2f} ms ({vector / args.images * 1e6:8.1f} us/image)")
+    print(f"speedup:    {loop / vector:8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""
+Measures images/sec of each stage of tagging a folder with a synthetic stand-in model, the real model is not needed.
+Stages: process_images_from_directory, predict on every preprocessed image, the PredictWorker batch path
+and write_tags. Results are written as JSON, pass an earlier file with --compare to see the change.
+
+    python -m benchmarks.bench_throughput --images 64 --resolution 1024x768 --output after.json --compare before.json
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from typing import Callable
+
+import numpy as np
+import tensorflow as tf
+
+from benchmarks.synthetic import make_images, write_model
+from src.commands.exif_actions import write_tags
+from src.commands.load_actions import load_model, load_labels, load_char_labels
+from src.commands.pipeline import BACKENDS
+from src.commands.postprocess import TagPostProcessor
+from src.commands.predict_all import process_images_from_directory, predict
+from src.gui.action_box import PredictWorker
+
+STAGES = ("process_images_from_directory", "predict", "predict_worker", "write_tags")
+
+
+def time_stage(function: Callable[[], object], repeat: int) -> list[float]:
+    """
+    :param function: stage to run
+    :param repeat: number of runs
+    :return: wall time of each run in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def run_predict_worker(model, directory, labels, char_labels, batch_size, workers, backend):
+    """
+    Runs PredictWorker in this thread, the way the GUI thread would see it
+    :return: number of images with results
+    """
+    worker = PredictWorker(model, directory, labels, char_labels, 0.5, 0.85, batch_size=batch_size,
+                           backend=backend, workers=workers)
+    results = []
+    errors = []
+    worker.results.connect(lambda result_count: results.extend(result_count[0]))
+    worker.finished.connect(lambda error: errors.append(error) if error else None)
+    worker.run()
+    if errors:
+        raise RuntimeError(errors[0])
+    return len(results)
+
+
+def run_benchmark(workdir: str | os.path,
+                  images: int = 64,
+                  resolution: tuple[int, int] = (1024, 768),
+                  image_format: str = "jpg",
+                  n_labels: int = 9000,
+                  input_size: int = 512,
+                  batch_size: int = 20,
+                  workers: int | None = None,
+                  backend: str = "thread",
+                  repeat: int = 3,
+                  stages: tuple[str, ...] = STAGES
+                  ) -> dict:
+    """
+    Builds the synthetic model and images in workdir and times each stage
+    :return: {"environment": {...}, "config": {...}, "stages": {stage: {"runs", "best", "images_per_second"}}},
+     times are in seconds
+    """
+    model_path = write_model(os.path.join(workdir, "model"), n_labels, input_size=input_size)
+    directory = os.path.join(workdir, "images")
+    make_images(directory, images, resolution, image_format)
+
+    model = load_model(model_path)
+    labels = load_labels(model_path)
+    char_labels = load_char_labels(model_path)
+    # first call traces the model, keep it out of the timings
+    model.predict_on_batch(np.zeros((1, input_size, input_size, 3), dtype=np.float32))
+
+    timings = {}
+    if "process_images_from_directory" in stages or "predict" in stages:
+        preprocessed = []
+        times = time_stage(lambda: preprocessed.append(process_images_from_directory(model, directory)),
+                           repeat if "process_images_from_directory" in stages else 1)
+        if "process_images_from_directory" in stages:
+            timings["process_images_from_directory"] = times
+        if "predict" in stages:
+            postprocessor = TagPostProcessor(labels, char_labels)
+            timings["predict"] = time_stage(lambda: [predict(model, labels, char_labels, image,
+                                                             postprocessor=postprocessor)
+                                                     for _, image in preprocessed[0]], repeat)
+        del preprocessed
+
+    if "predict_worker" in stages:
+        timings["predict_worker"] = time_stage(
+            lambda: run_predict_worker(model, directory, labels, char_labels, batch_size, workers, backend), repeat)
+
+    if "write_tags" in stages:
+        copies = os.path.join(workdir, "write_tags")
+        tags = ", ".join(labels[:30])
+
+        def write_all():
+            for image_path in os.listdir(copies):
+                write_tags(os.path.join(copies, image_path), tags)
+
+        timings["write_tags"] = []
+        for _ in range(repeat):
+            # tags are written in place, start every run from untouched images
+            shutil.rmtree(copies, ignore_errors=True)
+            shutil.copytree(directory, copies)
+            timings["write_tags"] += time_stage(write_all, 1)
+
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "tensorflow": tf.__version__,
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor() or platform.machine(),
+            "cpu_count": os.cpu_count(),
+        },
+        "config": {
+            "images": images,
+            "resolution": list(resolution),
+            "format": image_format,
+            "labels": n_labels,
+            "input_size": input_size,
+            "batch_size": batch_size,
+            "workers": workers,
+            "backend": backend,
+            "repeat": repeat,
+        },
+        "stages": {
+            stage: {
+                "runs": times,
+                "best": min(times),
+                "images_per_second": images / min(times),
+            } for stage, times in timings.items()
+        },
+    }
+
+
+def print_results(results: dict, baseline: dict | None = None) -> None:
+    """
+    :param results: output of run_benchmark
+    :param baseline: earlier results to compare against
+    """
+    config = results["config"]
+    print(f"{config['images']} images {config['resolution'][0]}x{config['resolution'][1]} {config['format']}, "
+          f"{config['labels']} labels, batch size {config['batch_size']}")
+    for stage, result in results["stages"].items():
+        line = f"{stage:32} {result['best'] * 1000:10.1f} ms {result['images_per_second']:8.1f} images/s"
+        if baseline is not None and stage in baseline.get("stages", {}):
+            line += f" {result['images_per_second'] / baseline['stages'][stage]['images_per_second']:6.2f}x"
+        print(line)
+
+
+def parse_resolution(value: str) -> tuple[int, int]:
+    try:
+        width, height = value.lower().split("x")
+        return int(width), int(height)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected WIDTHxHEIGHT, got {value!r}")
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=64)
+    parser.add_argument("--resolution", type=parse_resolution, default=(1024, 768), help="WIDTHxHEIGHT")
+    parser.add_argument("--format", default="jpg", help="image file extension")
+    parser.add_argument("--labels", type=int, default=9000)
+    parser.add_argument("--input-size", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--backend", choices=BACKENDS, default="thread")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--workdir", help="where to put the model and images, defaults to a temporary folder")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        results = run_benchmark(args.workdir or temp_dir, args.images, args.resolution, args.format, args.labels,
+                                args.input_size, args.batch_size, args.workers, args.backend, args.repeat,
+                                tuple(args.stages))
+
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,83 @@
+"""
+Synthetic stand-ins for benchmarking without the deepdanbooru model: a tiny Keras model with the same
+input/output contract and folders of generated images.
+"""
+from __future__ import annotations
+
+import os
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+from src.commands.prediction_cache import PredictionCache
+
+
+def build_model(n_labels: int = 9000, input_size: int = 512, seed: int = 0) -> tf.keras.Model:
+    """
+    Tiny model taking (input_size, input_size, 3) images in [0, 1] and returning n_labels + 3 rating probabilities.
+    Cost is dominated by reading the input so timings show the pipeline rather than the network.
+    :param n_labels: number of general and character tags
+    :param input_size: height and width of the input
+    :param seed: weight initialisation seed
+    :return: model
+    """
+    tf.keras.utils.set_random_seed(seed)
+    inputs = tf.keras.Input((input_size, input_size, 3))
+    x = tf.keras.layers.AveragePooling2D(max(input_size // 32, 1))(inputs)
+    x = tf.keras.layers.Conv2D(16, 3, strides=2, activation='relu')(x)
+    x = tf.keras.layers.GlobalAveragePooling2D()(x)
+    # negative bias keeps most tags near 0 like the real model
+    outputs = tf.keras.layers.Dense(n_labels + 3, activation='sigmoid',
+                                    bias_initializer=tf.keras.initializers.Constant(-3.))(x)
+    return tf.keras.Model(inputs, outputs)
+
+
+def write_model(model_path: str | os.path, n_labels: int = 9000, n_char_labels: int | None = None,
+                input_size: int = 512) -> str:
+    """
+    Saves a synthetic model folder in the layout load_model, load_labels and load_char_labels expect
+    :param model_path: folder to create
+    :param n_labels: number of tags
+    :param n_char_labels: how many of the tags are character tags, defaults to a tenth
+    :param input_size: height and width of the input
+    :return: model_path
+    """
+    os.makedirs(model_path, exist_ok=True)
+    n_char_labels = n_labels // 10 if n_char_labels is None else n_char_labels
+    labels = [f"tag_{i}" for i in range(n_labels)]
+
+    build_model(n_labels, input_size).save(os.path.join(model_path, PredictionCache.model_file))
+    with open(os.path.join(model_path, PredictionCache.tags_file), 'w') as f:
+        f.write("\n".join(labels))
+    with open(os.path.join(model_path, "tags-character.txt"), 'w') as f:
+        f.write("\n".join(labels[n_labels - n_char_labels:]))
+    return os.fspath(model_path)
+
+
+def make_images(directory: str | os.path, count: int, resolution: tuple[int, int] = (1024, 768),
+                image_format: str = "jpg", seed: int = 0) -> list[str]:
+    """
+    Fills a folder with photo like images, smooth gradients with noise so they compress like real pictures
+    :param directory: folder to create
+    :param count: number of images
+    :param resolution: (width, height) of each image
+    :param image_format: file extension, jpg, png, webp...
+    :param seed: random seed
+    :return: file paths
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    width, height = resolution
+    x = np.linspace(0, 1, width, dtype=np.float32)[None, :, None]
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None, None]
+
+    paths = []
+    for i in range(count):
+        colour = rng.uniform(0, 255, size=(2, 3)).astype(np.float32)
+        pixels = colour[0] * x + colour[1] * y
+        pixels += rng.normal(0, 12, size=(height, width, 1)).astype(np.float32)
+        path = os.path.join(directory, f"image_{i:05d}.{image_format}")
+        Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(path)
+        paths.append(path)
+    return paths
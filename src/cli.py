@@ -0,0 +1,233 @@
+"""
+Tags folders of images from the command line, without starting the GUI.
+
+    python -m src.cli --model models/deepdanbooru-v3-20211112-sgd-e28 --output tags.jsonl path/to/images
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import os
+import sqlite3
+import sys
+import time
+
+from src.commands.autotune import BatchSizeCache, tuned_batch_size
+from src.commands.backends import INFERENCE_BACKENDS, load_backend, model_variant, compare_backends, \
+    format_agreement
+from src.commands.exif_actions import write_tags
+from src.commands.export import EXPORT_FORMATS, SIDECAR_FORMATS, ResultExporter, format_for, open_exporter
+from src.commands.load_actions import load_model, load_labels, load_char_labels
+from src.commands.metrics import PipelineMetrics
+from src.commands.model_cache import ModelCache
+from src.commands.pipeline import BACKENDS
+from src.commands.postprocess import TagPostProcessor, has_tags
+from src.commands.prediction_cache import PredictionCache
+from src.commands.scanner import scan_images
+from src.commands.tagging_job import TaggingJob
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="bulk-tagger", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directories", nargs="+", help="folders of images to tag")
+    parser.add_argument("-r", "--recursive", action="store_true", help="also tag images in subdirectories")
+    parser.add_argument("--max-depth", type=int, default=None, help="subdirectory levels to go into with --recursive")
+    parser.add_argument("--include", action="append", metavar="GLOB", help="only tag files matching this pattern")
+    parser.add_argument("--exclude", action="append", metavar="GLOB",
+                        help="skip files and folders matching this pattern")
+    parser.add_argument("--check-magic", action="store_true",
+                        help="check file signatures instead of trusting extensions")
+    parser.add_argument("-m", "--model", required=True, help="model folder, see README for the expected layout")
+    parser.add_argument("-t", "--threshold", type=float, default=0.5, help="general tags threshold (default: 0.5)")
+    parser.add_argument("-c", "--char-threshold", type=float, default=0.85,
+                        help="character tags threshold (default: 0.85)")
+    parser.add_argument("-b", "--batch-size", type=int, default=None,
+                        help="images per model call (default: the fastest found by probing the model, remembered per "
+                             "model and machine)")
+    parser.add_argument("--retune", action="store_true", help="probe the batch size again even if one is remembered")
+    parser.add_argument("--memory-budget", type=int, default=None, metavar="MB",
+                        help="memory batches may use when picking the batch size (default: half the free memory)")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="decode threads or processes (default: number of cores)")
+    parser.add_argument("--backend", choices=BACKENDS, default="thread",
+                        help="decode images on threads, on a process pool or in a tf.data pipeline (default: thread)")
+    parser.add_argument("--fast-decode", action="store_true",
+                        help="decode large images at a reduced scale, much faster on big JPEGs")
+    parser.add_argument("--inference", choices=INFERENCE_BACKENDS, default="keras",
+                        help="run the float model, or a TFLite version with int8 weights (tflite) or int8 weights and "
+                             "activations calibrated on the first folder (tflite-int8) (default: keras)")
+    parser.add_argument("--calibration-images", type=int, default=100,
+                        help="images of the first folder tflite-int8 is calibrated on (default: 100)")
+    parser.add_argument("--agreement", type=int, default=0, metavar="N",
+                        help="compare the tags of the tflite model with the float model on N images of the first folder")
+    parser.add_argument("--queue-depth", type=int, default=4,
+                        help="batches decoded ahead of the model (default: 4)")
+    parser.add_argument("-o", "--output", help="write results to this file, see --format")
+    parser.add_argument("-f", "--format", choices=EXPORT_FORMATS, default=None,
+                        help="jsonl, csv or sqlite for --output, txt or json to write a file next to each image "
+                             "(default: from the --output extension, jsonl otherwise)")
+    parser.add_argument("--precision", type=int, default=4, help="decimal places of exported probabilities (default: 4)")
+    parser.add_argument("--exif", action="store_true", help="write tags to the ImageDescription exif of each image")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="do not read or write the prediction cache, the converted model cache or the "
+                             "remembered batch sizes")
+    parser.add_argument("--metrics", metavar="PATH",
+                        help="write stage timings, queue depths and peak memory to a .json or .csv report")
+    parser.add_argument("--restart", action="store_true",
+                        help="ignore the checkpoints of an interrupted run and start over")
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    export_format = args.format or (format_for(args.output) if args.output else None)
+    if args.output is None and export_format not in SIDECAR_FORMATS and not args.exif:
+        print("Nothing to do, use --output, --format txt/json and/or --exif", file=sys.stderr)
+        return 2
+    if args.output is None and export_format not in SIDECAR_FORMATS:
+        export_format = None
+
+    model_cache = None
+    if not args.no_cache:
+        try:
+            model_cache = ModelCache()
+        except OSError as e:
+            print("Model cache disabled:", e, file=sys.stderr)
+    model = load_model(args.model, model_cache)
+    if model is None:
+        return 1
+    if args.inference != "keras":
+        model = convert_model(args, model, model_cache)
+        if model is None:
+            return 1
+    labels = load_labels(args.model)
+    if not labels:
+        return 1
+    char_labels = load_char_labels(args.model)
+    batch_sizes = None
+    if not args.no_cache:
+        try:
+            batch_sizes = BatchSizeCache()
+        except OSError as e:
+            print("Batch size cache disabled:", e, file=sys.stderr)
+    memory_budget = args.memory_budget * 2 ** 20 if args.memory_budget else None
+    args.batch_size = tuned_batch_size(model, os.path.join(args.model, PredictionCache.model_file), args.batch_size,
+                                       args.queue_depth, memory_budget, batch_sizes, args.retune)
+
+    cache = None
+    if not args.no_cache:
+        try:
+            cache = PredictionCache(args.model, variant=model_variant(model))
+        except (sqlite3.Error, OSError) as e:
+            print("Prediction cache disabled:", e, file=sys.stderr)
+
+    try:
+        output = open_exporter(export_format, args.output, args.precision) if export_format else None
+    except (OSError, sqlite3.Error) as e:
+        print(f"Error opening {args.output}: {e}", file=sys.stderr)
+        if cache is not None:
+            cache.close()
+        return 1
+
+    postprocessor = TagPostProcessor(labels, char_labels)
+    metrics = PipelineMetrics()
+    start = time.perf_counter()
+    count = tagged = 0
+    try:
+        for directory in args.directories:
+            counts = tag_directory(args, directory, model, postprocessor, cache, output, metrics)
+            count += counts[0]
+            tagged += counts[1]
+    except KeyboardInterrupt:
+        print("Interrupted, run the same command again to continue where it stopped", file=sys.stderr)
+        return 130
+    finally:
+        if output is not None:
+            output.close()
+        if cache is not None:
+            cache.close()
+        metrics.finish()
+        if args.metrics:
+            try:
+                metrics.save(args.metrics)
+            except OSError as e:
+                print(f"Error writing report {args.metrics}: {e}", file=sys.stderr)
+
+    elapsed = time.perf_counter() - start
+    print(f"Tagged {tagged} of {count} images in {elapsed:.1f}s ({count / max(elapsed, 1e-9):.1f} images/s)",
+          file=sys.stderr)
+    return 0
+
+
+def convert_model(args: argparse.Namespace, model, model_cache: ModelCache | None):
+    """
+    Converts the float model to the --inference backend, sample images come from the first folder
+    :return: converted model, None if it could not be converted
+    """
+    count = max(args.calibration_images if args.inference == "tflite-int8" else 0, args.agreement)
+    image_paths = (entry.path for entry in scan_images(args.directories[0], args.recursive, args.max_depth,
+                                                       args.include, args.exclude, check_magic=args.check_magic))
+    model_file = os.path.join(args.model, PredictionCache.model_file)
+    try:
+        converted, calibration = load_backend(model, args.inference, image_paths if count else None, count,
+                                              model_cache, model_file)
+    except (ValueError, RuntimeError) as e:
+        print(f"Error converting the model to {args.inference}: {e}", file=sys.stderr)
+        return None
+    if args.agreement:
+        print(format_agreement(compare_backends(model, converted, calibration[:args.agreement], args.batch_size or 8,
+                                                args.threshold)), file=sys.stderr)
+    return converted
+
+
+def tag_directory(args: argparse.Namespace,
+                  directory: str,
+                  model,
+                  postprocessor: TagPostProcessor,
+                  cache: PredictionCache | None,
+                  output: ResultExporter | None,
+                  metrics: PipelineMetrics
+                  ) -> tuple[int, int]:
+    """
+    Tags one folder as a TaggingJob, an interrupted run picks up from its checkpoints
+    :return: number of images processed and number of images with tags
+    """
+    # Filters change which files belong to the job, only runs that scan the folder the default way are resumed
+    filtered = args.max_depth is not None or args.include or args.exclude or args.check_magic
+    job = TaggingJob(directory, None if filtered else args.model, args.recursive, args.fast_decode,
+                     variant=model_variant(model))
+    if args.restart:
+        job.discard()
+
+    image_paths = (entry.path for entry in scan_images(directory, args.recursive, args.max_depth,
+                                                       args.include, args.exclude, check_magic=args.check_magic))
+    predictions = job.run(model, image_paths, args.batch_size, args.queue_depth, args.workers,
+                          cache=cache, backend=args.backend, metrics=metrics)
+    count = tagged = 0
+    # closing checkpoints the chunk in progress when interrupted
+    with contextlib.closing(predictions):
+        for filenames, probs in predictions:
+            with metrics.stage("postprocess", len(filenames)):
+                results = postprocessor.process(probs, args.threshold, args.char_threshold, include_rating=True)
+            for filename, result in zip(filenames, results):
+                count += 1
+                if not has_tags(result):
+                    continue
+                tagged += 1
+                if output is not None:
+                    with metrics.stage("export"):
+                        output.add(filename, result)
+                if args.exif:
+                    try:
+                        with metrics.stage("write_exif"):
+                            write_tags(filename, result[4])
+                    except Exception as e:  # broken files raise anything, see write_tags_all
+                        print(f"Error writing tags to {filename}: {str(e) or type(e).__name__}", file=sys.stderr)
+    if job.restored:
+        print(f"{directory}: resumed, {job.restored} images restored from checkpoints", file=sys.stderr)
+    return count, tagged
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,261 @@
+from __future__ import annotations
+
+import json
+import os
+import platform
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from src.commands.backends import model_variant
+from src.commands.metrics import peak_rss
+from src.commands.model_cache import warm_up
+from src.commands.prediction_cache import user_cache_dir
+
+BATCH_SIZES = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+def memory_info() -> tuple[int | None, int | None]:
+    """
+    :return: (total, available) bytes of physical memory, None for what the platform does not report
+    """
+    if os.name == 'nt':
+        import ctypes
+
+        class MemoryStatus(ctypes.Structure):
+            _fields_ = [("dwLength", ctypes.c_ulong),
+                        ("dwMemoryLoad", ctypes.c_ulong),
+                        ("ullTotalPhys", ctypes.c_ulonglong),
+                        ("ullAvailPhys", ctypes.c_ulonglong),
+                        ("ullTotalPageFile", ctypes.c_ulonglong),
+                        ("ullAvailPageFile", ctypes.c_ulonglong),
+                        ("ullTotalVirtual", ctypes.c_ulonglong),
+                        ("ullAvailVirtual", ctypes.c_ulonglong),
+                        ("ullAvailExtendedVirtual", ctypes.c_ulonglong)]
+
+        status = MemoryStatus()
+        status.dwLength = ctypes.sizeof(status)
+        if not ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return None, None
+        return status.ullTotalPhys, status.ullAvailPhys
+
+    total = available = None
+    try:
+        total = os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        pass
+    try:
+        # counts the page cache that can be dropped, unlike SC_AVPHYS_PAGES
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) * 1024
+                    break
+    except (OSError, ValueError, IndexError):
+        pass
+    if available is None:
+        try:
+            available = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        except (ValueError, OSError, AttributeError):
+            pass
+    return total, available
+
+
+def default_memory_budget(fraction: float = 0.5) -> int | None:
+    """
+    :param fraction: share of the memory available now that batches may use
+    :return: bytes, None if the available memory is not known
+    """
+    _, available = memory_info()
+    return int(available * fraction) if available is not None else None
+
+
+def host_id() -> str:
+    """
+    :return: name, processor, core count, memory and GPUs of this machine, a tuned batch size only holds for these
+    """
+    total, _ = memory_info()
+    gpus = []
+    for gpu in tf.config.list_physical_devices("GPU"):
+        try:
+            gpus.append(tf.config.experimental.get_device_details(gpu).get("device_name", gpu.name))
+        except (RuntimeError, ValueError):
+            gpus.append(gpu.name)
+    return "/".join([platform.node(), platform.machine(), str(os.cpu_count()), str(total), *gpus])
+
+
+def image_bytes(model, queue_depth: int = 4) -> int:
+    """
+    :param model: model taking (batch, height, width, 3) images
+    :param queue_depth: batches decoded ahead of the model, see stream_predictions
+    :return: bytes each image of a batch takes outside the model, as float32 and as uint8 in the decode queue
+    """
+    _, height, width, channels = model.input_shape
+    return height * width * channels * (4 + queue_depth)
+
+
+def autotune_batch_size(model,
+                        memory_budget: int | None = None,
+                        queue_depth: int = 4,
+                        candidates: tuple[int, ...] = BATCH_SIZES,
+                        repeats: int = 2,
+                        min_gain: float = 0.05,
+                        patience: int = 2,
+                        time_budget: float = 60.,
+                        seed: int = 0) -> dict:
+    """
+    Probes the throughput of the model at increasing batch sizes on random images and picks the fastest.
+    Probing stops after patience sizes in a row that are not min_gain faster than the best so far, at a size that
+    would go over the memory budget or runs out of memory, or at one that could not be timed within time_budget.
+    Memory per image is the growth of the peak resident memory between probes, which larger batches only ever raise,
+    plus the images.
+    The model is warmed up first so tracing is neither timed nor counted as memory.
+    :param model: tf.keras.Model or TFLiteModel
+    :param memory_budget: bytes the batches may use on top of the loaded model, not capped if None
+    :param queue_depth: batches decoded ahead of the model, counted in the memory per image
+    :param candidates: batch sizes to try, in increasing order
+    :param repeats: calls timed per batch size, the fastest counts
+    :param min_gain: relative speedup a larger batch needs to be picked
+    :param patience: sizes in a row without a speedup before probing stops, single timings are noisy
+    :param time_budget: seconds probing may take, estimated from the best throughput so far
+    :param seed: random images seed
+    :return: picked batch_size, throughput in images per second by batch size and image_bytes, the memory per image
+    """
+    _, height, width, channels = model.input_shape
+    rng = np.random.default_rng(seed)
+    per_image = image_bytes(model, queue_depth)
+    throughput = {}
+    best, best_rate = candidates[0], 0.
+    slower = 0
+    warm_up(model)
+    previous_size, previous_peak = 0, peak_rss()
+    start = time.perf_counter()
+    for batch_size in candidates:
+        if memory_budget is not None and batch_size > 1 and batch_size * per_image > memory_budget:
+            break
+        if best_rate and time.perf_counter() - start + repeats * batch_size / best_rate > time_budget:
+            break
+        images = rng.random((batch_size, height, width, channels), dtype=np.float32)
+        try:
+            seconds = []
+            for _ in range(repeats):
+                call_start = time.perf_counter()
+                model.predict_on_batch(images)
+                seconds.append(time.perf_counter() - call_start)
+        except (tf.errors.ResourceExhaustedError, MemoryError) as e:
+            print(f"Batch size {batch_size} ran out of memory: {e}")
+            break
+        rate = batch_size / max(min(seconds), 1e-9)
+        throughput[batch_size] = rate
+
+        peak = peak_rss()
+        if peak is not None and previous_peak is not None:
+            per_image = max(per_image, image_bytes(model, queue_depth)
+                            + (peak - previous_peak) // (batch_size - previous_size))
+        previous_size, previous_peak = batch_size, peak
+
+        if rate > best_rate * (1 + min_gain):
+            best, best_rate = batch_size, rate
+            slower = 0
+        else:
+            slower += 1
+            if slower == patience:
+                break
+    return {"batch_size": best, "throughput": throughput, "image_bytes": per_image}
+
+
+class BatchSizeCache:
+    """
+    Batch sizes picked by autotune_batch_size, kept in a JSON file in the user cache folder.
+    Entries are keyed on the model file, its converted variant and the host, a changed model file or a different
+    machine is tuned again.
+    :param path: JSON file, defaults to batch_sizes.json in the user cache folder
+    """
+    def __init__(self, path: str | os.path | None = None):
+        self.path = os.fspath(path or os.path.join(user_cache_dir(), "batch_sizes.json"))
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model_file: str | os.path, variant: str = "") -> str:
+        """
+        :param model_file: .h5 the model was loaded from
+        :param variant: see model_variant
+        :return: key of the model on this host
+        """
+        stat = os.stat(model_file)
+        return "|".join([os.path.abspath(model_file), str(stat.st_mtime_ns), str(stat.st_size), variant, host_id()])
+
+    def get(self, key: str) -> dict | None:
+        """
+        :param key: see key
+        :return: result of autotune_batch_size, None if the model was not tuned on this host
+        """
+        with self._lock:
+            return self._read().get(key)
+
+    def put(self, key: str, result: dict) -> None:
+        """
+        :param key: see key
+        :param result: result of autotune_batch_size
+        """
+        with self._lock:
+            entries = self._read()
+            entries[key] = {"batch_size": result["batch_size"], "image_bytes": result["image_bytes"],
+                            "throughput": {str(size): rate for size, rate in result["throughput"].items()}}
+            with open(self.path + ".tmp", 'w') as f:
+                json.dump(entries, f, indent=1)
+            os.replace(self.path + ".tmp", self.path)
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+
+def tuned_batch_size(model,
+                     model_file: str | os.path | None = None,
+                     override: int | None = None,
+                     queue_depth: int = 4,
+                     memory_budget: int | None = None,
+                     cache: BatchSizeCache | None = None,
+                     retune: bool = False) -> int:
+    """
+    Batch size to run the model with on this host: the override, the cached pick or a new autotune_batch_size
+    :param model: tf.keras.Model or TFLiteModel
+    :param model_file: .h5 the model was loaded from, picks are only cached with one
+    :param override: batch size set by hand, returned as is
+    :param queue_depth: batches decoded ahead of the model
+    :param memory_budget: bytes batches may use, defaults to half the memory available now
+    :param cache: where picks are kept
+    :param retune: tune again even if a pick is cached
+    :return: batch size
+    """
+    if override:
+        return override
+    if memory_budget is None:
+        memory_budget = default_memory_budget()
+    key = None
+    if cache is not None and model_file is not None:
+        try:
+            key = cache.key(model_file, model_variant(model))
+        except OSError as e:
+            print("Batch size not cached:", e)
+    result = cache.get(key) if key is not None and not retune else None
+    if result is None:
+        result = autotune_batch_size(model, memory_budget, queue_depth)
+        rates = ", ".join(f"{size}: {rate:.1f}" for size, rate in result["throughput"].items())
+        print(f"Batch size {result['batch_size']} picked, images/s by batch size {rates}")
+        if key is not None:
+            try:
+                cache.put(key, result)
+            except OSError as e:
+                print("Batch size not cached:", e)
+    batch_size = result["batch_size"]
+    if memory_budget is not None:
+        # less memory may be free than when it was tuned
+        batch_size = min(batch_size, max(1, memory_budget // max(result["image_bytes"], 1)))
+    return batch_size
@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+from typing import Iterable, Iterator
+
+import numpy as np
+import tensorflow as tf
+
+from src.commands.model_cache import ModelCache
+from src.commands.pipeline import preprocess_image
+
+INFERENCE_BACKENDS = ("keras", "tflite", "tflite-int8")
+
+
+class TFLiteModel:
+    """
+    Runs a TFLite flatbuffer through tf.lite.Interpreter with the input_shape, predict and predict_on_batch
+    of a tf.keras.Model, so it can be passed anywhere a model is.
+    The interpreter is resized whenever the batch size changes, calls are serialised since it is not thread safe.
+    :param model_content: converted model, see convert_to_tflite
+    :param variant: tells its predictions apart from the float model in caches and job ids
+    :param num_threads: interpreter threads, defaults to the number of cores
+    """
+    def __init__(self, model_content: bytes, variant: str, num_threads: int | None = None):
+        self.variant = variant
+        self.nbytes = len(model_content)
+        self.interpreter = tf.lite.Interpreter(model_content=model_content,
+                                               num_threads=num_threads or os.cpu_count())
+        input_details = self.interpreter.get_input_details()[0]
+        output_details = self.interpreter.get_output_details()[0]
+        self._input = input_details["index"]
+        self._output = output_details["index"]
+        self.input_shape = (None, *input_details["shape_signature"][1:].tolist())
+        self.output_shape = (None, *output_details["shape_signature"][1:].tolist())
+        self._batch_size = None
+        self._lock = threading.Lock()
+
+    def predict_on_batch(self, images: np.ndarray) -> np.ndarray:
+        """
+        :param images: (batch, height, width, 3) normalized images
+        :return: (batch, outputs) probabilities
+        """
+        images = np.asarray(images, dtype=np.float32)
+        with self._lock:
+            if len(images) != self._batch_size:
+                self.interpreter.resize_tensor_input(self._input, [len(images), *self.input_shape[1:]])
+                self.interpreter.allocate_tensors()
+                self._batch_size = len(images)
+            self.interpreter.set_tensor(self._input, images)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self._output).copy()
+
+    def predict(self, images: np.ndarray, batch_size: int = 32, verbose=None) -> np.ndarray:
+        return np.concatenate([self.predict_on_batch(images[start:start + batch_size])
+                               for start in range(0, len(images), batch_size)])
+
+
+def model_variant(model) -> str:
+    """
+    :param model: tf.keras.Model or TFLiteModel
+    :return: empty for the float model, otherwise what it was converted to
+    """
+    return getattr(model, "variant", "")
+
+
+def calibration_images(image_paths: Iterable[str], size: tuple[int, int], count: int = 100) -> list[np.ndarray]:
+    """
+    Preprocesses sample images the way the pipeline does, unreadable files are skipped
+    :param image_paths: candidates, the first count that can be read are used
+    :param size: (height, width) of the model input
+    :param count: number of images
+    :return: float32 images
+    """
+    images = []
+    for image_path in image_paths:
+        if len(images) == count:
+            break
+        try:
+            images.append(preprocess_image(image_path, size).astype(np.float32))
+        except (OSError, ValueError) as e:
+            print(f"Skipping calibration image {image_path}: {e}")
+    return images
+
+
+def convert_to_tflite(model: tf.keras.Model, backend: str = "tflite",
+                      calibration: list[np.ndarray] | None = None) -> bytes:
+    """
+    Quantises a Keras model for tf.lite.Interpreter. tflite stores the weights as int8 (dynamic range),
+    tflite-int8 also runs the activations in int8 using ranges measured on the calibration images.
+    Inputs and outputs stay float32 either way
+    :param model: float model
+    :param backend: tflite or tflite-int8
+    :param calibration: images for tflite-int8, see calibration_images
+    :return: flatbuffer
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if backend == "tflite-int8":
+        if not calibration:
+            raise ValueError("tflite-int8 needs calibration images")
+        converter.representative_dataset = lambda: ([image[None, ...]] for image in calibration)
+    elif backend != "tflite":
+        raise ValueError(f"Unknown backend {backend}, expected one of {', '.join(INFERENCE_BACKENDS)}")
+    return converter.convert()
+
+
+def load_backend(model: tf.keras.Model,
+                 backend: str = "keras",
+                 calibration_paths: Iterable[str] | None = None,
+                 calibration_count: int = 100,
+                 model_cache: ModelCache | None = None,
+                 model_file: str | os.path | None = None,
+                 num_threads: int | None = None):
+    """
+    Puts a loaded model behind the inference backend asked for
+    :param model: float model
+    :param backend: one of INFERENCE_BACKENDS, keras returns the model as is
+    :param calibration_paths: images to calibrate tflite-int8 on, usually the folder to tag
+    :param calibration_count: number of calibration images
+    :param model_cache: keeps the converted flatbuffers, they are only converted again when the .h5 changes
+    :param model_file: the .h5 the model was loaded from, needed with model_cache
+    :param num_threads: interpreter threads
+    :return: (model, calibration images), the model is a tf.keras.Model or TFLiteModel
+    """
+    if backend == "keras":
+        return model, []
+    calibration = []
+    if calibration_paths is not None:
+        _, height, width, _ = model.input_shape
+        calibration = calibration_images(calibration_paths, (height, width), calibration_count)
+    variant = backend
+    if backend == "tflite-int8":
+        # predictions depend on the images the ranges were measured on
+        digest = hashlib.blake2b(digest_size=8)
+        for image in calibration:
+            digest.update(image.tobytes())
+        variant = f"{backend}-{digest.hexdigest()}"
+
+    path = model_cache.tflite_path(model_file, variant) if model_cache is not None else None
+    if path is not None and os.path.isfile(path):
+        with open(path, 'rb') as f:
+            return TFLiteModel(f.read(), variant, num_threads), calibration
+    model_content = convert_to_tflite(model, backend, calibration)
+    if path is not None:
+        try:
+            with open(path + ".tmp", 'wb') as f:
+                f.write(model_content)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            print("Converted model not cached:", e)
+    return TFLiteModel(model_content, variant, num_threads), calibration
+
+
+def tag_agreement(reference: np.ndarray, candidate: np.ndarray, score_threshold: float = 0.5) -> dict[str, float]:
+    """
+    Compares the tags a converted model gives with those of the float model on the same images
+    :param reference: (images, labels + 3) output of the float model
+    :param candidate: output of the converted model
+    :param score_threshold: tags above this count
+    :return: mean Jaccard index of the tag sets, images with the exact same tags, precision and recall of the
+     converted model's tags, matching top ratings and the largest probability difference
+    """
+    reference = np.asarray(reference, dtype=np.float32)
+    candidate = np.asarray(candidate, dtype=np.float32)
+    expected = reference[:, :-3] > score_threshold
+    found = candidate[:, :-3] > score_threshold
+    common = (expected & found).sum(axis=1)
+    either = (expected | found).sum(axis=1)
+    jaccard = np.where(either > 0, common / np.maximum(either, 1), 1.)
+    return {"images": len(reference),
+            "jaccard": float(jaccard.mean()),
+            "exact_match": float((expected == found).all(axis=1).mean()),
+            "precision": float(common.sum() / max(found.sum(), 1)),
+            "recall": float(common.sum() / max(expected.sum(), 1)),
+            "rating_match": float((reference[:, -3:].argmax(axis=1) == candidate[:, -3:].argmax(axis=1)).mean()),
+            "max_abs_diff": float(np.abs(reference - candidate).max(initial=0.))}
+
+
+def compare_backends(reference: tf.keras.Model, candidate, images: list[np.ndarray], batch_size: int = 8,
+                     score_threshold: float = 0.5) -> dict[str, float]:
+    """
+    Runs both models over the same images, see tag_agreement
+    :param reference: float model
+    :param candidate: converted model
+    :param images: preprocessed images, the calibration images work
+    :param batch_size: images per call
+    :param score_threshold: tags above this count
+    :return: agreement report
+    """
+    if not images:
+        return tag_agreement(np.zeros((0, 4)), np.zeros((0, 4)), score_threshold)
+    expected, found = [], []
+    for batch in _batches(images, batch_size):
+        expected.append(np.asarray(reference.predict_on_batch(batch)))
+        found.append(candidate.predict_on_batch(batch))
+    return tag_agreement(np.concatenate(expected), np.concatenate(found), score_threshold)
+
+
+def format_agreement(report: dict[str, float]) -> str:
+    """
+    :param report: see tag_agreement
+    :return: one line summary
+    """
+    return (f"Tag agreement on {report['images']} images: jaccard {report['jaccard']:.3f}, "
+            f"exact {report['exact_match']:.1%}, precision {report['precision']:.3f}, recall {report['recall']:.3f}, "
+            f"rating {report['rating_match']:.1%}, max diff {report['max_abs_diff']:.4f}")
+
+
+def _batches(images: list[np.ndarray], batch_size: int) -> Iterator[np.ndarray]:
+    for start in range(0, len(images), batch_size):
+        yield np.stack(images[start:start + batch_size])
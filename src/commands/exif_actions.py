@@ -1,15 +1,174 @@
 from __future__ import annotations
 
+import collections
 import io
+import os
+import shutil
+import tempfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable
 
 from PIL import Image
 from PIL.ExifTags import TAGS
 from PIL.TiffImagePlugin import ImageFileDirectory_v2
 
 
+JPEG_SOI = b"\xff\xd8"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+EXIF_HEADER = b"Exif\x00\x00"
+IMAGE_DESCRIPTION = 270
+
+
+def exif_with_description(exif: bytes | None, info: str) -> bytes:
+    """
+    Sets ImageDescription in an Exif block, the other tags are kept
+    :param exif: Exif block as found in the file, with or without the Exif header, or None
+    :param info: tags to write
+    :return: TIFF data of the new block without the Exif header
+    """
+    data = Image.Exif()
+    if exif:
+        data.load(exif)
+    data[IMAGE_DESCRIPTION] = info
+    return data.tobytes()[len(EXIF_HEADER):]
+
+
+def splice_jpeg(data: bytes, info: str) -> bytes | None:
+    """
+    Replaces the APP1 Exif segment of a JPEG, or inserts one after SOI and APP0, the other segments and the
+    compressed image data are copied as they are
+    :param data: JPEG file
+    :param info: tags to write
+    :return: new JPEG file, None if the file could not be parsed or the Exif block does not fit a segment
+    """
+    if not data.startswith(JPEG_SOI):
+        return None
+    insert_at = len(JPEG_SOI)
+    exif_segment = None
+    pos = len(JPEG_SOI)
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:  # fill byte
+            pos += 1
+            continue
+        if 0xD0 <= marker <= 0xD7 or marker == 0x01:  # no length
+            pos += 2
+            continue
+        if marker in (0xDA, 0xD9):  # start of scan, the rest is image data
+            break
+        end = pos + 2 + int.from_bytes(data[pos + 2:pos + 4], "big")
+        if end > len(data):
+            return None
+        if marker == 0xE1 and data[pos + 4:pos + 10] == EXIF_HEADER:
+            exif_segment = (pos, end)
+            break
+        if marker == 0xE0 and pos == insert_at:  # JFIF has to stay first
+            insert_at = end
+        pos = end
+    else:
+        return None
+
+    if exif_segment is None:
+        start = end = insert_at
+        exif = None
+    else:
+        start, end = exif_segment
+        exif = data[start + 4:end]
+    payload = EXIF_HEADER + exif_with_description(exif, info)
+    if len(payload) + 2 > 0xFFFF:
+        return None
+    segment = b"\xff\xe1" + (len(payload) + 2).to_bytes(2, "big") + payload
+    return data[:start] + segment + data[end:]
+
+
+def splice_png(data: bytes, info: str) -> bytes | None:
+    """
+    Replaces the eXIf chunk of a PNG, or inserts one before the image data, the other chunks are copied as they are
+    :param data: PNG file
+    :param info: tags to write
+    :return: new PNG file, None if the file could not be parsed
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        return None
+    pos = len(PNG_SIGNATURE)
+    while pos + 8 <= len(data):
+        length = int.from_bytes(data[pos:pos + 4], "big")
+        chunk_type = data[pos + 4:pos + 8]
+        end = pos + 12 + length
+        if end > len(data):
+            return None
+        if chunk_type == b"eXIf":
+            start, exif = pos, data[pos + 8:pos + 8 + length]
+            break
+        if chunk_type in (b"IDAT", b"IEND"):  # eXIf has to come before the image data
+            start, end, exif = pos, pos, None
+            break
+        pos = end
+    else:
+        return None
+
+    payload = exif_with_description(exif, info)
+    chunk = (len(payload).to_bytes(4, "big") + b"eXIf" + payload
+             + zlib.crc32(b"eXIf" + payload).to_bytes(4, "big"))
+    return data[:start] + chunk + data[end:]
+
+
+def replace_file(path: str | os.path, write: Callable[[io.BufferedWriter], None]) -> None:
+    """
+    Writes a new version of a file next to it then renames it over the original,
+    the original is left as it was if writing fails or the process dies part way
+    :param path: file to replace
+    :param write: writes the new content to the file object it is given
+    """
+    fd, temp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        shutil.copymode(path, temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
 def write_tags(image_path: str, info: str):
     """
-    Writes tags to exif, modified from Vladmanic's https://github.com/AUTOMATIC1111/stable-diffusion-webui/issues/6087
+    Writes tags to exif ImageDescription. JPEG and PNG files only have their Exif block replaced,
+    the image is not decoded or compressed again. Other formats are saved again through PIL.
+    The image is replaced in one step, it is never left half written
+
+    :param image_path: file path of image
+    :param info: tags to write
+    :return: none
+    """
+    with open(image_path, "rb") as f:
+        data = f.read()
+    if data.startswith(JPEG_SOI):
+        spliced = splice_jpeg(data, info)
+    elif data.startswith(PNG_SIGNATURE):
+        spliced = splice_png(data, info)
+    else:
+        spliced = None
+
+    if spliced is None:
+        reencode_tags(image_path, info)
+        return
+    replace_file(image_path, lambda f: f.write(spliced))
+
+
+def reencode_tags(image_path: str, info: str):
+    """
+    Writes tags to exif by saving the image again, modified from Vladmanic's
+    https://github.com/AUTOMATIC1111/stable-diffusion-webui/issues/6087
 
     :param image_path: file path of image
     :param info: tags to write
@@ -24,10 +183,54 @@ def write_tags(image_path: str, info: str):
         ifd.save(exif_stream)
         hex = b"Exif\x00\x00" + exif_stream.getvalue()
 
-        img.save(image_path, exif=hex)
+        replace_file(image_path, lambda f: img.save(f, format=img.format, exif=hex))
         # read_exif(image_path)
 
 
+def write_tags_all(items: Iterable[tuple[str, str]],
+                   workers: int | None = None,
+                   on_written: Callable[[str, str | None], None] | None = None,
+                   cancel: threading.Event | None = None
+                   ) -> list[tuple[str, str]]:
+    """
+    Runs write_tags over many images on a pool of threads, a file that can not be written does not stop the rest.
+    Only a few writes per thread are queued at a time so a cancel stops soon
+    :param items: (file path, tags) of each image
+    :param workers: number of threads, defaults to the number of cores up to 8
+    :param on_written: called with the file path and None or the error after each image, from the calling thread
+    :param cancel: stops submitting writes once set, writes in progress finish
+    :return: (file path, error) of the images that failed
+    """
+    workers = workers or min(8, os.cpu_count() or 1)
+    failures = []
+
+    def write(image_path, info):
+        try:
+            write_tags(image_path, info)
+        except Exception as e:  # broken files raise anything from SyntaxError to DecompressionBombError
+            return image_path, str(e) or type(e).__name__
+        return image_path, None
+
+    def done(future):
+        image_path, error = future.result()
+        if error is not None:
+            failures.append((image_path, error))
+        if on_written is not None:
+            on_written(image_path, error)
+
+    with ThreadPoolExecutor(workers) as executor:
+        pending = collections.deque()
+        for image_path, info in items:
+            if cancel is not None and cancel.is_set():
+                break
+            pending.append(executor.submit(write, image_path, info))
+            if len(pending) >= workers * 4:
+                done(pending.popleft())
+        while pending:
+            done(pending.popleft())
+    return failures
+
+
 def read_exif(image_path):
     """
     Reads tags from exif
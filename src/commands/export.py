@@ -0,0 +1,218 @@
+from __future__ import annotations
+
+import abc
+import csv
+import json
+import os
+import sqlite3
+from typing import Iterable
+
+from src.commands.postprocess import TagPostProcessor, RATING_LABELS, has_tags
+
+EXPORT_FORMATS = ("jsonl", "csv", "sqlite", "txt", "json")
+SIDECAR_FORMATS = ("txt", "json")
+EXTENSIONS = {".jsonl": "jsonl", ".csv": "csv", ".sqlite": "sqlite", ".sqlite3": "sqlite", ".db": "sqlite"}
+
+
+def format_for(path: str | os.path) -> str:
+    """
+    :param path: output file name
+    :return: export format matching its extension, jsonl if it is not known
+    """
+    return EXTENSIONS.get(os.path.splitext(path)[1].lower(), "jsonl")
+
+
+class ResultExporter(abc.ABC):
+    """
+    Writes results out in batches, the images themselves are never opened.
+    Use add for each result then close, or use it as a context manager.
+    :param path: output file, sidecar exporters write next to each image instead
+    :param precision: decimal places kept of the probabilities
+    :param batch_size: results buffered before they are written
+    """
+    def __init__(self, path: str | os.path | None = None, precision: int = 4, batch_size: int = 1000):
+        self.path = path
+        self.precision = precision
+        self.batch_size = batch_size
+        self.count = 0
+        self._buffer = []
+
+    def record(self, file_path: str, result: tuple, text: str | None = None) -> dict:
+        """
+        :param file_path: image the result is for
+        :param result: (result_threshold, result_all, result_rating, result_char, result_text)
+        :param text: tags to write instead of result_text, for results edited by hand
+        :return: file, rating, character, general and tags of the result with rounded probabilities
+        """
+        result_threshold, _, result_rating, result_char, result_text = result
+        digits = self.precision
+        return {"file": file_path,
+                "rating": {tag: round(value, digits) for tag, value in result_rating.items()},
+                "character": {tag: round(value, digits) for tag, value in result_char.items()},
+                "general": {tag: round(value, digits) for tag, value in result_threshold.items()},
+                "tags": result_text if text is None else text}
+
+    def add(self, file_path: str, result: tuple, text: str | None = None) -> None:
+        """
+        :param file_path: image the result is for
+        :param result: (result_threshold, result_all, result_rating, result_char, result_text)
+        :param text: tags to write instead of result_text
+        """
+        self._buffer.append(self.record(file_path, result, text))
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def add_all(self, results: Iterable[tuple[str, tuple]]) -> None:
+        """
+        :param results: (file_path, result) pairs
+        """
+        for file_path, result in results:
+            self.add(file_path, result)
+
+    def flush(self) -> None:
+        if self._buffer:
+            self._write(self._buffer)
+            self.count += len(self._buffer)
+            self._buffer = []
+
+    def close(self) -> None:
+        self.flush()
+        self._close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @abc.abstractmethod
+    def _write(self, records: list[dict]) -> None:
+        """ Writes a batch of records, see record"""
+
+    def _close(self) -> None:
+        pass
+
+
+class JsonlExporter(ResultExporter):
+    """ One JSON object per line"""
+    def __init__(self, path: str | os.path, precision: int = 4, batch_size: int = 1000):
+        super().__init__(path, precision, batch_size)
+        self._file = open(path, 'w', encoding='utf-8')
+
+    def _write(self, records):
+        self._file.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+
+    def _close(self):
+        self._file.close()
+
+
+class CsvExporter(ResultExporter):
+    """ One row per image, a column per rating, character and general tags as JSON objects"""
+    columns = ["file", "tags"] + RATING_LABELS + ["character", "general"]
+
+    def __init__(self, path: str | os.path, precision: int = 4, batch_size: int = 1000):
+        super().__init__(path, precision, batch_size)
+        self._file = open(path, 'w', encoding='utf-8', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(self.columns)
+
+    def _write(self, records):
+        self._writer.writerows([record["file"], record["tags"]]
+                               + [record["rating"].get(label) for label in RATING_LABELS]
+                               + [json.dumps(record["character"], ensure_ascii=False),
+                                  json.dumps(record["general"], ensure_ascii=False)]
+                               for record in records)
+
+    def _close(self):
+        self._file.close()
+
+
+class SqliteExporter(ResultExporter):
+    """
+    A results table keyed on the file name, exporting again replaces the rows of the same images.
+    Ratings, character and general tags are JSON objects, readable with SQLite's json functions
+    """
+    def __init__(self, path: str | os.path, precision: int = 4, batch_size: int = 1000):
+        super().__init__(path, precision, batch_size)
+        self._db = sqlite3.connect(path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS results "
+                         "(file TEXT PRIMARY KEY, tags TEXT, rating TEXT, character TEXT, general TEXT)")
+        self._db.commit()
+
+    def _write(self, records):
+        with self._db:  # one transaction per batch
+            self._db.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                                 [(record["file"], record["tags"], json.dumps(record["rating"]),
+                                   json.dumps(record["character"], ensure_ascii=False),
+                                   json.dumps(record["general"], ensure_ascii=False))
+                                  for record in records])
+
+    def _close(self):
+        self._db.close()
+
+
+class SidecarExporter(ResultExporter):
+    """
+    A file next to each image with the same name, image.jpg gets image.txt with its tags
+    or image.json with the whole record
+    :param extension: txt or json
+    """
+    def __init__(self, extension: str = "txt", precision: int = 4, batch_size: int = 1000):
+        super().__init__(None, precision, batch_size)
+        self.extension = extension
+
+    def _write(self, records):
+        for record in records:
+            path = os.path.splitext(record["file"])[0] + "." + self.extension
+            with open(path, 'w', encoding='utf-8') as f:
+                if self.extension == "json":
+                    json.dump(record, f, ensure_ascii=False)
+                else:
+                    f.write(record["tags"])
+
+
+def open_exporter(export_format: str, path: str | os.path | None = None, precision: int = 4,
+                  batch_size: int = 1000) -> ResultExporter:
+    """
+    :param export_format: one of EXPORT_FORMATS
+    :param path: output file, not used by the sidecar formats
+    :param precision: decimal places kept of the probabilities
+    :param batch_size: results buffered before they are written
+    :return: exporter, close it once all results were added
+    """
+    if export_format in SIDECAR_FORMATS:
+        return SidecarExporter(export_format, precision, batch_size)
+    if path is None:
+        raise ValueError(f"{export_format} export needs an output file")
+    exporters = {"jsonl": JsonlExporter, "csv": CsvExporter, "sqlite": SqliteExporter}
+    if export_format not in exporters:
+        raise ValueError(f"Unknown export format {export_format}, expected one of {', '.join(EXPORT_FORMATS)}")
+    return exporters[export_format](path, precision, batch_size)
+
+
+def export_store(store, exporter: ResultExporter, score_threshold: float, char_threshold: float,
+                 texts: dict[str, str] | None = None) -> int:
+    """
+    Exports the results of a ResultsStore, thresholds are applied a chunk at a time
+    :param store: ResultsStore of a job
+    :param exporter: where the results go, it is not closed
+    :param score_threshold: general tags threshold
+    :param char_threshold: character tags threshold
+    :param texts: if given only these images are exported, with these tags, otherwise images with tags
+    :return: number of results exported
+    """
+    postprocessor = TagPostProcessor(store.labels, store.char_labels)
+    count = 0
+    for paths, probs in store.iter_chunks():
+        results = postprocessor.process(probs, score_threshold, char_threshold, include_rating=True)
+        for file_path, result in zip(paths, results):
+            if texts is None:
+                if not has_tags(result):
+                    continue
+                exporter.add(file_path, result)
+            elif file_path in texts:
+                exporter.add(file_path, result, texts[file_path])
+            else:
+                continue
+            count += 1
+    return count
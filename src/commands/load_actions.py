@@ -4,11 +4,14 @@ import os
 
 import tensorflow as tf
 
+from src.commands.model_cache import ModelCache
 
-def load_model(model_path: str | os.path) -> tf.keras.Model:
+
+def load_model(model_path: str | os.path, cache: ModelCache | None = None) -> tf.keras.Model:
     """
     Loads models model_path, should be called before using predict
     :param model_path: file name
+    :param cache: loads the converted copy of the model kept in this ModelCache, converting it the first time
     :return: returns the loaded model
     """
     file_name = "model-resnet_custom_v3.h5"
@@ -16,7 +19,7 @@ def load_model(model_path: str | os.path) -> tf.keras.Model:
 
     try:
         print("Loading model")
-        model = tf.keras.models.load_model(path)
+        model = cache.load(path) if cache is not None else tf.keras.models.load_model(path)
     except FileNotFoundError as file_not_found_error:
         print("Model file not found:", file_not_found_error)
         return None
@@ -0,0 +1,205 @@
+from __future__ import annotations
+
+import contextlib
+import csv
+import json
+import os
+import sys
+import threading
+import time
+from array import array
+from typing import Iterator
+
+import numpy as np
+
+# upper bounds of the latency histogram buckets in milliseconds, the last bucket takes everything slower
+HISTOGRAM_EDGES_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+def peak_rss() -> int | None:
+    """
+    :return: highest resident memory of this process so far in bytes, None if the platform does not report it
+    """
+    if os.name == 'nt':
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD),
+                        ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t),
+                        ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t),
+                        ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return None
+        return counters.PeakWorkingSetSize
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class PipelineMetrics:
+    """
+    Collects timings of the stages of a tagging job, safe to record into from several threads.
+    Each stage keeps the per image latency of every item so percentiles and histograms are exact,
+    batch stages such as predict record the batch time split over the images in it.
+    Queue depths are sampled by the consumer each time it takes an item.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = {}  # stage -> array of per image seconds
+        self._totals = {}  # stage -> seconds spent in the stage
+        self._queues = {}  # queue -> [samples, sum of depths, max depth, capacity]
+        self.images = 0
+        self.start_time = time.perf_counter()
+        self.end_time = None
+
+    def record(self, stage: str, seconds: float, count: int = 1) -> None:
+        """
+        :param stage: name of the stage
+        :param seconds: wall time the stage took
+        :param count: number of images processed in that time
+        """
+        with self._lock:
+            latencies = self._latencies.get(stage)
+            if latencies is None:
+                latencies = self._latencies[stage] = array('d')
+            latencies.extend([seconds / count] * count)
+            self._totals[stage] = self._totals.get(stage, 0.) + seconds
+
+    def record_many(self, timings: dict[str, float]) -> None:
+        """
+        :param timings: {stage: seconds} for one image
+        """
+        for stage, seconds in timings.items():
+            self.record(stage, seconds)
+
+    @contextlib.contextmanager
+    def stage(self, stage: str, count: int = 1) -> Iterator[None]:
+        """
+        Times the body of a with block, see record
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, count)
+
+    def sample_queue(self, queue: str, depth: int, capacity: int | None = None) -> None:
+        """
+        :param queue: name of the queue
+        :param depth: number of items waiting in it
+        :param capacity: most items it can hold
+        """
+        with self._lock:
+            stats = self._queues.get(queue)
+            if stats is None:
+                stats = self._queues[queue] = [0, 0, 0, capacity]
+            stats[0] += 1
+            stats[1] += depth
+            stats[2] = max(stats[2], depth)
+
+    def add_images(self, count: int) -> None:
+        """
+        :param count: images that made it through the whole pipeline
+        """
+        with self._lock:
+            self.images += count
+
+    def finish(self) -> None:
+        """ Stops the job clock"""
+        self.end_time = time.perf_counter()
+
+    @property
+    def elapsed(self) -> float:
+        return (self.end_time or time.perf_counter()) - self.start_time
+
+    def report(self) -> dict:
+        """
+        :return: {"elapsed", "images", "images_per_second", "peak_rss_bytes", "stages", "queues"},
+         stage latencies are in milliseconds and histogram counts line up with histogram_edges_ms
+        """
+        with self._lock:
+            latencies = {stage: np.frombuffer(values, dtype=float) * 1000 for stage, values in self._latencies.items()}
+            totals = dict(self._totals)
+            queues = {queue: list(stats) for queue, stats in self._queues.items()}
+            images = self.images
+        elapsed = self.elapsed
+
+        stages = {}
+        for stage, values in latencies.items():
+            buckets = np.searchsorted(HISTOGRAM_EDGES_MS, values)
+            histogram = np.bincount(buckets, minlength=len(HISTOGRAM_EDGES_MS) + 1)
+            stages[stage] = {
+                "count": len(values),
+                "total_seconds": totals[stage],
+                "mean_ms": float(values.mean()),
+                "p50_ms": float(np.percentile(values, 50)),
+                "p95_ms": float(np.percentile(values, 95)),
+                "max_ms": float(values.max()),
+                "histogram": histogram.tolist(),
+            }
+        return {
+            "elapsed": elapsed,
+            "images": images,
+            "images_per_second": images / elapsed if elapsed > 0 else 0.,
+            "peak_rss_bytes": peak_rss(),
+            "histogram_edges_ms": list(HISTOGRAM_EDGES_MS),
+            "stages": stages,
+            "queues": {queue: {"samples": samples, "mean": total / samples, "max": maximum, "capacity": capacity}
+                       for queue, (samples, total, maximum, capacity) in queues.items()},
+        }
+
+    def summary(self) -> str:
+        """
+        Cheap enough to call after every batch, only uses running totals
+        :return: a few lines for the progress dialog
+        """
+        with self._lock:
+            stages = [(stage, total / len(self._latencies[stage])) for stage, total in self._totals.items()]
+            queues = [(queue, total / samples, capacity or maximum)
+                      for queue, (samples, total, maximum, capacity) in self._queues.items()]
+            images = self.images
+        elapsed = self.elapsed
+
+        lines = [f"{images} images, {images / elapsed if elapsed > 0 else 0.:.1f} images/s"]
+        if stages:
+            lines.append(", ".join(f"{stage} {mean * 1000:.0f} ms" for stage, mean in stages))
+        if queues:
+            lines.append("queued " + ", ".join(f"{queue} {mean:.0f}/{capacity}" for queue, mean, capacity in queues))
+        rss = peak_rss()
+        if rss is not None:
+            lines.append(f"peak memory {rss / (1 << 20):.0f} MB")
+        return "\n".join(lines)
+
+    def save(self, path: str | os.path) -> None:
+        """
+        Writes the report as JSON, or as CSV with one row per stage if path ends in .csv
+        :param path: file name
+        """
+        report = self.report()
+        if os.fspath(path).lower().endswith(".csv"):
+            with open(path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                buckets = [f"<={edge}ms" for edge in HISTOGRAM_EDGES_MS] + [f">{HISTOGRAM_EDGES_MS[-1]}ms"]
+                writer.writerow(["stage", "count", "total_seconds", "mean_ms", "p50_ms", "p95_ms", "max_ms"] + buckets)
+                for stage, stats in report["stages"].items():
+                    writer.writerow([stage, stats["count"], stats["total_seconds"], stats["mean_ms"], stats["p50_ms"],
+                                     stats["p95_ms"], stats["max_ms"]] + stats["histogram"])
+        else:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
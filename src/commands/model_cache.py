@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+from src.commands.prediction_cache import user_cache_dir, file_digest
+
+
+class ModelCache:
+    """
+    Converted copies of .h5 models in the user cache folder, keyed on the content hash of the .h5.
+    TFLite conversions of the models are kept next to them, see load_backend.
+    A copy is the architecture as JSON and the weights as an uncompressed npz, loading it skips the optimizer
+    state and training config stored in the .h5 and reads the weights in one go.
+    SavedModel and frozen graphs were measured as well, both load slower than the .h5 with TF 2.15 on CPU.
+    Content hashes are remembered by path, mtime and size so an unchanged .h5 is not read again.
+    :param directory: folder of the converted models, defaults to models in the user cache folder
+    """
+    architecture_file = "architecture.json"
+    weights_file = "weights.npz"
+
+    def __init__(self, directory: str | os.path | None = None):
+        self.directory = directory or os.path.join(user_cache_dir(), "models")
+        os.makedirs(self.directory, exist_ok=True)
+        self._sources_path = os.path.join(self.directory, "sources.json")
+        self._lock = threading.Lock()
+
+    def digest(self, path: str | os.path) -> str:
+        """
+        :param path: .h5 file
+        :return: content hash, only read again if the file changed since it was last hashed
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self._lock:
+            sources = self._read_sources()
+            known = sources.get(path)
+            if known is not None and known[:2] == [stat.st_mtime_ns, stat.st_size]:
+                return known[2]
+        digest = file_digest(path)
+        with self._lock:
+            sources = self._read_sources()
+            sources[path] = [stat.st_mtime_ns, stat.st_size, digest]
+            with open(self._sources_path, 'w') as f:
+                json.dump(sources, f)
+        return digest
+
+    def entry(self, path: str | os.path) -> str:
+        """
+        :param path: .h5 file
+        :return: folder the converted copy of the file is kept in
+        """
+        return os.path.join(self.directory, self.digest(path))
+
+    def tflite_path(self, path: str | os.path, variant: str) -> str:
+        """
+        :param path: .h5 file
+        :param variant: what the model was converted to, see load_backend
+        :return: file the TFLite conversion of the file is kept in
+        """
+        return os.path.join(self.directory, f"{self.digest(path)}-{variant}.tflite")
+
+    def load(self, path: str | os.path) -> tf.keras.Model:
+        """
+        Loads the converted copy of a .h5 model, the .h5 is loaded and converted if there is none yet
+        :param path: .h5 file
+        :return: model, raises the errors of tf.keras.models.load_model if the .h5 can not be loaded
+        """
+        entry = self.entry(path)
+        if os.path.isdir(entry):
+            try:
+                return self._read(entry)
+            except (OSError, ValueError, KeyError) as e:
+                print("Converted model unreadable, converting again:", e)
+                shutil.rmtree(entry, ignore_errors=True)
+
+        model = tf.keras.models.load_model(path, compile=False)
+        try:
+            self._write(model, entry)
+        except (OSError, ValueError, TypeError, NotImplementedError) as e:
+            print("Model not cached:", e)
+        return model
+
+    def _read(self, entry):
+        with open(os.path.join(entry, self.architecture_file)) as f:
+            model = tf.keras.models.model_from_json(f.read())
+        with np.load(os.path.join(entry, self.weights_file)) as weights:
+            model.set_weights([weights[f"arr_{i}"] for i in range(len(weights.files))])
+        return model
+
+    def _write(self, model, entry):
+        # written next to the entry then renamed, a crash never leaves a half written copy
+        temp = tempfile.mkdtemp(prefix=".", dir=self.directory)
+        try:
+            with open(os.path.join(temp, self.architecture_file), 'w') as f:
+                f.write(model.to_json())
+            np.savez(os.path.join(temp, self.weights_file), *model.get_weights())
+            os.replace(temp, entry)
+        except BaseException:
+            shutil.rmtree(temp, ignore_errors=True)
+            raise
+
+    def _read_sources(self):
+        try:
+            with open(self._sources_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def clear(self) -> None:
+        """ Removes every converted model"""
+        with self._lock:
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+
+
+def warm_up(model: tf.keras.Model) -> None:
+    """
+    Runs the model on blank images so the first real batch does not pay for tracing the predict function.
+    Keras traces it again for a second batch size then keeps a trace for any batch size, so both are done here
+    :param model: model taking (batch, height, width, 3) images
+    """
+    _, height, width, channels = model.input_shape
+    for batch_size in (1, 2):
+        model.predict_on_batch(np.zeros((batch_size, height, width, channels), dtype=np.float32))
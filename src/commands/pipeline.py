@@ -0,0 +1,469 @@
+from __future__ import annotations
+
+import collections
+import math
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import shared_memory
+from typing import Any, Callable, Iterable, Iterator
+
+import deepdanbooru as dd
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+from src.commands.metrics import PipelineMetrics
+from src.commands.prediction_cache import PredictionCache
+from src.commands.scanner import scan_images
+
+BACKENDS = ("thread", "process", "tfdata")
+_DONE = object()  # sentinel put on the queue by each decode thread once it runs out of paths
+
+
+def preprocess_image(image_path: str | os.path,
+                     size: tuple[int, int],
+                     compact: bool = False,
+                     fast_decode: bool = False,
+                     timings: dict[str, float] | None = None
+                     ) -> np.ndarray:
+    """
+    Decodes, resizes and pads a single image so it can be fed to the model
+    :param image_path: file name
+    :param size: (height, width) of the model input
+    :param compact: return the padded image as uint8, call normalize_images before predicting on it
+    :param fast_decode: decode large images at a reduced scale that is still bigger than the model input,
+     see reduce_for_size
+    :param timings: filled with the seconds spent to decode, resize and pad the image
+    :return: processed image
+    """
+    start = time.perf_counter()
+    image = Image.open(image_path)
+    if fast_decode:
+        image = reduce_for_size(image, size)
+    # Model only supports 3 channels
+    image = image.convert('RGB')
+    image = np.asarray(image)
+    decoded = time.perf_counter()
+
+    image = tf.image.resize(image,
+                            size=size,
+                            method=tf.image.ResizeMethod.AREA,
+                            preserve_aspect_ratio=True)
+    image = image.numpy()
+    resized = time.perf_counter()
+
+    image = dd.image.transform_and_pad_image(image, size[1], size[0])
+    if compact:
+        image = np.rint(image, out=image).clip(0, 255).astype(np.uint8)
+    else:
+        image = image / 255.
+    if timings is not None:
+        timings["decode"] = decoded - start
+        timings["resize"] = resized - decoded
+        timings["pad"] = time.perf_counter() - resized
+    return image
+
+
+def reduce_for_size(image: Image.Image, size: tuple[int, int]) -> Image.Image:
+    """
+    Shrinks an image by an integer factor while keeping it at least as big as it will be after resizing to size.
+    JPEGs are decoded at 1/2, 1/4 or 1/8 scale straight from the DCT coefficients, other formats are decoded
+    in full and then box filtered with Image.reduce which is still much cheaper than the area resize.
+    :param image: freshly opened image, not loaded yet
+    :param size: (height, width) of the model input
+    :return: reduced image
+    """
+    height, width = size
+    scale = min(height / image.height, width / image.width)
+    if scale >= 1:
+        return image
+    target = (math.ceil(image.width * scale), math.ceil(image.height * scale))
+
+    if image.format == 'JPEG':
+        image.draft('RGB', target)
+        return image
+
+    factor = min(image.width // target[0], image.height // target[1])
+    if factor > 1:
+        return image.reduce(factor)
+    return image
+
+
+def normalize_images(images: np.ndarray) -> np.ndarray:
+    """
+    Scales compact uint8 images to the [0, 1] float32 range the model expects, other images are returned as is
+    :param images: batch of processed images
+    :return: normalized images
+    """
+    if images.dtype != np.uint8:
+        return images
+    images = images.astype(np.float32)
+    images *= 1 / 255.
+    return images
+
+
+def list_images(directory: str | os.path, **scan_options) -> list[str]:
+    """
+    Lists the images of a directory, does not go into subdirectories unless recursive is passed.
+    :param directory: directory of images
+    :param scan_options: see scan_images
+    :return: list of file paths
+    """
+    return [entry.path for entry in scan_images(directory, **scan_options)]
+
+
+def decode_images(image_paths: Iterable[str],
+                  size: tuple[int, int],
+                  capacity: int = 80,
+                  workers: int | None = None,
+                  compact: bool = False,
+                  lookup: Callable[[str], Any] | None = None,
+                  backend: str = "thread",
+                  fast_decode: bool = False,
+                  metrics: PipelineMetrics | None = None
+                  ) -> Iterator[tuple[str, np.ndarray | None, Any]]:
+    """
+    Preprocesses images on a pool of decode threads or processes.
+    Decoded images go through a bounded buffer so at most capacity images are held at once,
+    peak memory depends on this setting and not on how many images there are.
+    Images that fail to decode are skipped.
+    :param image_paths: files to process, can be a lazy iterable
+    :param size: (height, width) of the model input
+    :param capacity: number of images that can be waiting in the buffer
+    :param workers: number of decode threads, processes or parallel map calls, defaults to the number of cores
+    :param compact: keep the images as uint8, see preprocess_image
+    :param lookup: called with each path before decoding, if it returns something the image is not decoded
+    :param backend: "thread" decodes on threads of this process, images come out in the order they finish.
+     "process" decodes on a process pool which is not held back by the GIL, images come out in order.
+     Each worker process imports tensorflow on start up, so it pays off on large folders and many cores.
+     "tfdata" runs preprocess_image in a tf.data map with parallel calls and prefetch, images come out in order
+    :param fast_decode: decode large images at a reduced scale, see preprocess_image
+    :param metrics: records decode, resize, pad and lookup times and how full the buffer is
+    :return: generator of (file name, processed image, None) or (file name, None, lookup result)
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown preprocessing backend {backend!r}, use one of {BACKENDS}")
+    workers = workers or os.cpu_count() or 1
+    if backend == "tfdata":
+        return _decode_with_tfdata(image_paths, size, capacity, workers, compact, lookup, fast_decode, metrics)
+    if backend == "process":
+        return _decode_with_processes(image_paths, size, capacity, workers, compact, lookup, fast_decode, metrics)
+    return _decode_with_threads(image_paths, size, capacity, workers, compact, lookup, fast_decode, metrics)
+
+
+def _lookup(lookup, image_path, metrics):
+    if lookup is None:
+        return None
+    if metrics is None:
+        return lookup(image_path)
+    with metrics.stage("cache_lookup"):
+        return lookup(image_path)
+
+
+def _decode_with_threads(image_paths, size, capacity, workers, compact, lookup, fast_decode, metrics):
+    buffer = queue.Queue(maxsize=capacity)
+    paths = iter(image_paths)
+    paths_lock = threading.Lock()
+    stop = threading.Event()
+
+    def put(item):
+        # Keep checking stop so the threads can exit if the consumer goes away
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def decode():
+        while not stop.is_set():
+            with paths_lock:
+                image_path = next(paths, None)
+            if image_path is None:
+                break
+            try:
+                found = _lookup(lookup, image_path, metrics)
+                if found is not None:
+                    put((image_path, None, found))
+                    continue
+                timings = {} if metrics is not None else None
+                image = preprocess_image(image_path, size, compact, fast_decode, timings)
+                if metrics is not None:
+                    metrics.record_many(timings)
+                put((image_path, image, None))
+            except Exception as e:
+                print(f"Error processing {image_path}: {e}")
+        put(_DONE)
+
+    threads = [threading.Thread(target=decode, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        running = workers
+        while running:
+            if metrics is not None:
+                metrics.sample_queue("decoded", buffer.qsize(), capacity)
+            item = buffer.get()
+            if item is _DONE:
+                running -= 1
+                continue
+            yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def _decode_with_processes(image_paths, size, capacity, workers, compact, lookup, fast_decode, metrics):
+    # Workers write into slots of one shared memory block, only the path and slot number go through pickle
+    height, width = size
+    memory = shared_memory.SharedMemory(create=True, size=capacity * height * width * 3)
+    slots = np.ndarray((capacity, height, width, 3), dtype=np.uint8, buffer=memory.buf)
+    free_slots = list(range(capacity))
+    in_flight = collections.deque()
+    pool = ProcessPoolExecutor(workers,
+                               mp_context=multiprocessing.get_context("spawn"),  # forking a running TF is unsafe
+                               initializer=_attach_slots,
+                               initargs=(memory.name, capacity, size, fast_decode))
+    try:
+        paths = iter(image_paths)
+        exhausted = False
+        while True:
+            while free_slots and not exhausted:
+                image_path = next(paths, None)
+                if image_path is None:
+                    exhausted = True
+                    break
+                try:
+                    found = _lookup(lookup, image_path, metrics)
+                except Exception as e:
+                    print(f"Error processing {image_path}: {e}")
+                    continue
+                if found is not None:
+                    yield image_path, None, found
+                    continue
+                slot = free_slots.pop()
+                in_flight.append((image_path, slot, pool.submit(_decode_into_slot, image_path, slot)))
+
+            if not in_flight:
+                break
+            if metrics is not None:
+                metrics.sample_queue("decoding", len(in_flight), capacity)
+            image_path, slot, future = in_flight.popleft()
+            try:
+                timings = future.result()
+                if metrics is not None:
+                    metrics.record_many(timings)
+                image = slots[slot].copy() if compact else slots[slot] / np.float32(255.)
+            except Exception as e:
+                print(f"Error processing {image_path}: {e}")
+                continue
+            finally:
+                free_slots.append(slot)
+            yield image_path, image, None
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+        del slots
+        memory.close()
+        memory.unlink()
+
+
+def _decode_with_tfdata(image_paths, size, capacity, workers, compact, lookup, fast_decode, metrics):
+    # Paths the lookup finds only go through the dataset as a flag, their results wait here in the same order
+    found = collections.deque()
+    dtype = np.uint8 if compact else np.float32
+    empty = np.zeros((0, 0, 3), dtype)
+
+    def paths():
+        for image_path in image_paths:
+            try:
+                result = _lookup(lookup, image_path, metrics)
+            except Exception as e:
+                print(f"Error processing {image_path}: {e}")
+                continue
+            if result is not None:
+                found.append(result)
+            yield os.fsencode(image_path), result is not None
+
+    def decode(image_path, cached):
+        if cached:
+            return empty, True
+        image_path = os.fsdecode(image_path)
+        try:
+            timings = {} if metrics is not None else None
+            image = preprocess_image(image_path, size, compact, fast_decode, timings)
+            if metrics is not None:
+                metrics.record_many(timings)
+            return image.astype(dtype, copy=False), True
+        except Exception as e:
+            print(f"Error processing {image_path}: {e}")
+            return empty, False
+
+    def preprocess(image_path, cached):
+        image, decoded = tf.numpy_function(decode, [image_path, cached], (tf.as_dtype(dtype), tf.bool))
+        return image_path, cached, tf.ensure_shape(image, (None, None, 3)), decoded
+
+    def keep(image_path, cached, image, decoded):
+        return decoded
+
+    dataset = tf.data.Dataset.from_generator(paths, output_signature=(tf.TensorSpec((), tf.string),
+                                                                      tf.TensorSpec((), tf.bool)))
+    # deterministic keeps the order of image_paths, the cached flags have to line up with found
+    dataset = dataset.map(preprocess, num_parallel_calls=workers, deterministic=True)
+    dataset = dataset.filter(keep).prefetch(capacity)
+    options = tf.data.Options()
+    # decode calls wait on the GIL, on the shared inter-op pool they held up the model's own ops and
+    # halved throughput. Parallelism and buffer sizes are fixed so autotune would only cost CPU
+    options.threading.private_threadpool_size = workers
+    options.autotune.enabled = False
+    dataset = dataset.with_options(options)
+    for image_path, cached, image, _ in dataset.as_numpy_iterator():
+        if cached:
+            yield os.fsdecode(image_path), None, found.popleft()
+        else:
+            yield os.fsdecode(image_path), image, None
+
+
+_worker_memory = None
+_worker_slots = None
+_worker_size = None
+_worker_fast_decode = False
+
+
+def _attach_slots(name, capacity, size, fast_decode):
+    global _worker_memory, _worker_slots, _worker_size, _worker_fast_decode
+    # Each worker is one of many, keep TF from starting a thread per core in every one of them
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    _worker_memory = shared_memory.SharedMemory(name=name)
+    _worker_size = size
+    _worker_fast_decode = fast_decode
+    _worker_slots = np.ndarray((capacity, size[0], size[1], 3), dtype=np.uint8, buffer=_worker_memory.buf)
+
+
+def _decode_into_slot(image_path, slot):
+    timings = {}
+    _worker_slots[slot] = preprocess_image(image_path, _worker_size, True, _worker_fast_decode, timings)
+    return timings
+
+
+def stream_images(image_paths: Iterable[str],
+                  size: tuple[int, int],
+                  batch_size: int = 20,
+                  queue_depth: int = 4,
+                  workers: int | None = None,
+                  compact: bool = False,
+                  backend: str = "thread",
+                  fast_decode: bool = False,
+                  metrics: PipelineMetrics | None = None
+                  ) -> Iterator[tuple[list[str], np.ndarray]]:
+    """
+    Preprocesses images with decode_images and yields them in batches.
+    At most batch_size * queue_depth decoded images are held at once.
+    :param image_paths: files to process, can be a lazy iterable
+    :param size: (height, width) of the model input
+    :param batch_size: number of images per yielded batch
+    :param queue_depth: number of batches that can be waiting in the queue
+    :param workers: number of decode threads or processes, defaults to the number of cores
+    :param compact: keep the images as uint8, see preprocess_image
+    :param backend: "thread", "process" or "tfdata", see BACKENDS and decode_images
+    :param fast_decode: decode large images at a reduced scale, see preprocess_image
+    :param metrics: see decode_images
+    :return: generator of (file names, stacked images)
+    """
+    filenames, images = [], []
+    items = decode_images(image_paths, size, batch_size * queue_depth, workers, compact,
+                          backend=backend, fast_decode=fast_decode, metrics=metrics)
+    for image_path, image, _ in items:
+        filenames.append(image_path)
+        images.append(image)
+        if len(images) == batch_size:
+            yield filenames, np.stack(images)
+            filenames, images = [], []
+    if images:
+        yield filenames, np.stack(images)
+
+
+def stream_predictions(model: tf.keras.Model,
+                       image_paths: Iterable[str],
+                       batch_size: int = 20,
+                       queue_depth: int = 4,
+                       workers: int | None = None,
+                       compact: bool = True,
+                       cache: PredictionCache | None = None,
+                       backend: str = "thread",
+                       fast_decode: bool = False,
+                       metrics: PipelineMetrics | None = None
+                       ) -> Iterator[tuple[list[str], np.ndarray]]:
+    """
+    Runs the model over batches of images from decode_images, decoding of the next batches overlaps with inference.
+    With compact images only the batch being predicted is converted to float32.
+    Images found in the cache are not decoded or predicted, they come out in batches of their own.
+    :param model: model to use, shape is used to resize the images
+    :param image_paths: files to process
+    :param batch_size: number of images per batch
+    :param queue_depth: number of batches that can be waiting to be predicted
+    :param workers: number of decode threads or processes
+    :param compact: queue images as uint8 instead of float32
+    :param cache: prediction cache of the model, new predictions are added to it
+    :param backend: "thread", "process" or "tfdata", see BACKENDS and decode_images
+    :param fast_decode: decode large images at a reduced scale, see preprocess_image
+    :param metrics: records the decode_images stages, model and cache write times and the images yielded
+    :return: generator of (file names, probabilities)
+    """
+    _, height, width, _ = model.input_shape
+    lookup = partial(cache.get, fast_decode=fast_decode) if cache is not None else None
+    items = decode_images(image_paths, (height, width), batch_size * queue_depth, workers, compact, lookup, backend,
+                          fast_decode, metrics)
+
+    filenames, images = [], []
+    cached_filenames, cached_probs = [], []
+    try:
+        for image_path, image, probs in items:
+            if probs is not None:
+                cached_filenames.append(image_path)
+                cached_probs.append(probs)
+                if len(cached_probs) == batch_size:
+                    if metrics is not None:
+                        metrics.add_images(len(cached_filenames))
+                    yield cached_filenames, np.array(cached_probs, dtype=float)
+                    cached_filenames, cached_probs = [], []
+                continue
+
+            filenames.append(image_path)
+            images.append(image)
+            if len(images) == batch_size:
+                yield filenames, _predict_batch(model, filenames, images, cache, fast_decode, metrics)
+                filenames, images = [], []
+
+        if images:
+            yield filenames, _predict_batch(model, filenames, images, cache, fast_decode, metrics)
+        if cached_probs:
+            if metrics is not None:
+                metrics.add_images(len(cached_filenames))
+            yield cached_filenames, np.array(cached_probs, dtype=float)
+    finally:
+        items.close()
+        if cache is not None:
+            # hits not written yet and misses of images that failed to decode
+            cache.flush()
+
+
+def _predict_batch(model, filenames, images, cache, fast_decode, metrics):
+    start = time.perf_counter()
+    probs = np.asarray(model.predict_on_batch(normalize_images(np.stack(images))))
+    predicted = time.perf_counter()
+    if cache is not None:
+        cache.put_many(filenames, probs, fast_decode)
+    if metrics is not None:
+        metrics.record("predict", predicted - start, len(filenames))
+        if cache is not None:
+            metrics.record("cache_write", time.perf_counter() - predicted, len(filenames))
+        metrics.add_images(len(filenames))
+    return probs.astype(float)
@@ -0,0 +1,205 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import Iterable
+
+import numpy as np
+
+RATING_LABELS = ["rating:safe", "rating:questionable", "rating:explicit"]
+
+
+class TagPostProcessor:
+    """
+    Matches model outputs with labels for a whole batch at once.
+    The last three outputs of the model are the content ratings, everything before them lines up with labels.
+    :param labels: general tags
+    :param char_labels: character tags
+    """
+    def __init__(self, labels: list[str], char_labels: Iterable[str]):
+        self.labels = np.asarray(labels, dtype=object)
+        self.char_mask = np.isin(self.labels, list(char_labels))
+
+    def process(self,
+                probs: np.ndarray,
+                score_threshold: float = 0.5,
+                char_threshold: float = 0.85,
+                include_rating: bool = False,
+                top_k: int | None = None,
+                tag_count: dict[str, int] | None = None
+                ) -> list[tuple[dict[str, float], dict[str, float], dict[str, float], dict[str, float], str]]:
+        """
+        Applies the thresholds to a (batch, labels + 3) probability matrix.
+        result_all holds the labels in descending order down to and including the first one under both thresholds.
+        :param probs: model output
+        :param score_threshold: general tags, if the probability of the prediction is greater than this number add to tags
+        :param char_threshold: character tags, see above
+        :param include_rating: put the highest rating at the front of result_all and result_text
+        :param top_k: keep at most this many labels per image, useful with very low thresholds
+        :param tag_count: if given, the labels of each result_all are counted into it, see count_tags
+        :return: [(result_threshold, result_all, result_rating, result_char, result_text)] one per row,
+         use has_tags to find rows without tags within threshold
+        """
+        probs = self._as_matrix(probs)
+        n_images, n_outputs = probs.shape
+        n_labels = n_outputs - 3
+        rating_probs = probs[:, n_labels:]
+        above = self._select(probs, score_threshold, char_threshold, top_k)
+        rows, cols, values = self._sorted(probs, above)
+        if tag_count is not None:
+            self._count(probs, np.bincount(cols, minlength=n_outputs), include_rating, tag_count)
+        splits = np.cumsum(np.bincount(rows, minlength=n_images))[:-1]
+
+        is_char = self.char_mask[cols]
+        general = (values > score_threshold) & ~is_char
+        character = (values > char_threshold) & is_char
+        labels = self.labels[cols]
+
+        results = []
+        for i, (row_labels, row_probs, row_general, row_char) in enumerate(zip(np.split(labels, splits),
+                                                                              np.split(values, splits),
+                                                                              np.split(general, splits),
+                                                                              np.split(character, splits))):
+            result_rating = OrderedDict(zip(RATING_LABELS, rating_probs[i].tolist()))
+
+            result_all = OrderedDict()
+            if include_rating:
+                max_rating = max(result_rating, key=result_rating.get)
+                result_all[max_rating] = result_rating[max_rating]
+            result_all.update(zip(row_labels.tolist(), row_probs.tolist()))
+            result_threshold = OrderedDict(zip(row_labels[row_general].tolist(), row_probs[row_general].tolist()))
+            result_char = OrderedDict(zip(row_labels[row_char].tolist(), row_probs[row_char].tolist()))
+            result_text = ', '.join(result_all.keys())
+            results.append((result_threshold, result_all, result_rating, result_char, result_text))
+        return results
+
+    def select(self,
+               probs: np.ndarray,
+               score_threshold: float = 0.5,
+               char_threshold: float = 0.85,
+               tag_count: dict[str, int] | None = None
+               ) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        The labels process would put in result_all as column numbers, without building the results.
+        For keeping the labels of many images and only building the results of the few that are looked at.
+        :param probs: model output, see process
+        :param score_threshold: see process
+        :param char_threshold: see process
+        :param tag_count: if given, the labels and the highest rating of each image are counted into it
+        :return: (counts, cols, tagged, rating): number of labels of each row, their columns row after row
+         in the order of result_all, whether the row has tags within threshold (see has_tags)
+         and the index into RATING_LABELS of its highest rating
+        """
+        probs = self._as_matrix(probs)
+        n_images, n_outputs = probs.shape
+        above = self._select(probs, score_threshold, char_threshold)
+        rows, cols, values = self._sorted(probs, above)
+        if tag_count is not None:
+            self._count(probs, np.bincount(cols, minlength=n_outputs), True, tag_count)
+        within = np.where(self.char_mask[cols], values > char_threshold, values > score_threshold)
+        tagged = np.bincount(rows[within], minlength=n_images) > 0
+        rating = probs[:, n_outputs - 3:].argmax(axis=1)
+        return np.bincount(rows, minlength=n_images), cols, tagged, rating
+
+    def count_tags(self,
+                   probs: np.ndarray,
+                   score_threshold: float = 0.5,
+                   char_threshold: float = 0.85,
+                   include_rating: bool = True
+                   ) -> dict[str, int]:
+        """
+        Counts how many images each label of result_all would show up for, without building the results.
+        :param probs: model output, see process
+        :param score_threshold: see process
+        :param char_threshold: see process
+        :param include_rating: count the highest rating of each image
+        :return: {label: number of images}, ratings first then labels from most to least common
+        """
+        probs = self._as_matrix(probs)
+        tag_count = {}
+        above = self._select(probs, score_threshold, char_threshold)
+        self._count(probs, above.sum(axis=0), include_rating, tag_count)
+        return tag_count
+
+    def _count(self, probs: np.ndarray, counts: np.ndarray, include_rating: bool, tag_count: dict[str, int]) -> None:
+        """
+        :param counts: number of selected images of each column, the rating columns are left out
+        """
+        n_labels = probs.shape[1] - 3
+        if include_rating:
+            ratings = np.bincount(probs[:, n_labels:].argmax(axis=1), minlength=len(RATING_LABELS))
+            for label, count in zip(RATING_LABELS, ratings.tolist()):
+                tag_count[label] = tag_count.get(label, 0) + count
+        counts = counts[:n_labels]
+        found = np.flatnonzero(counts)
+        found = found[np.argsort(-counts[found], kind='stable')]
+        for label, count in zip(self.labels[found].tolist(), counts[found].tolist()):
+            tag_count[label] = tag_count.get(label, 0) + count
+
+    @staticmethod
+    def _sorted(probs: np.ndarray, above: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :return: (rows, cols, values) of the selected labels, by row then by probability in descending order
+        """
+        flat = np.flatnonzero(above)
+        rows, cols = np.divmod(flat, probs.shape[1])
+        # float16 or float32 rows are only selected in their own precision, the sort key needs float64
+        values = probs.ravel()[flat].astype(float)
+        # probabilities are within [0, 1] so this sorts by row, then by probability in descending order
+        order = np.argsort(rows - values, kind='stable')
+        return rows[order], cols[order], values[order]
+
+    @staticmethod
+    def _as_matrix(probs: np.ndarray) -> np.ndarray:
+        probs = np.atleast_2d(np.asarray(probs))
+        if not np.issubdtype(probs.dtype, np.floating):
+            probs = probs.astype(float)
+        return probs
+
+    @staticmethod
+    def _select(probs: np.ndarray, score_threshold: float, char_threshold: float,
+                top_k: int | None = None) -> np.ndarray:
+        """
+        :return: mask of the labels that go in result_all, rating columns are always False
+        """
+        n_images, n_outputs = probs.shape
+        n_labels = n_outputs - 3
+        images = np.arange(n_images)
+
+        # Labels within either threshold, plus the highest one under both (the loop used to stop on that one).
+        # Masks cover the rating columns too so the matrix is never copied, they are switched off instead
+        # smallest value of the matrix dtype that is not under the threshold, so float16 rows select like float64
+        threshold = probs.dtype.type(min(score_threshold, char_threshold))
+        if threshold < min(score_threshold, char_threshold):
+            threshold = np.nextafter(threshold, probs.dtype.type(np.inf))
+        keys = probs
+        if probs.dtype == np.float16:
+            # probabilities are not negative, so float16 bits order like the values and int16 compares are vectorised
+            keys, threshold = probs.view(np.int16), threshold.view(np.int16)
+        above = keys >= threshold
+        above[:, n_labels:] = False
+        if keys is probs:
+            empty = probs.dtype.type(-1)
+            below = np.where(above, empty, probs)
+        else:
+            # shifted by one so the labels within threshold are zeroed out, a lot quicker than np.where
+            empty = 0
+            below = (keys + np.int16(1)) * ~above
+        below[:, n_labels:] = empty
+        first_below = below.argmax(axis=1)
+        has_below = below[images, first_below] > empty
+        above[images[has_below], first_below[has_below]] = True
+
+        if top_k is not None and top_k < n_labels:
+            top = np.argpartition(-probs[:, :n_labels], top_k - 1, axis=1)[:, :top_k]
+            in_top = np.zeros_like(above)
+            np.put_along_axis(in_top, top, True, axis=1)
+            above &= in_top
+        return above
+
+
+def has_tags(result: tuple) -> bool:
+    """
+    :param result: (result_threshold, result_all, result_rating, result_char, result_text)
+    :return: True if any general or character tag is within threshold
+    """
+    return len(result[0]) > 0 or len(result[3]) > 0
@@ -1,15 +1,16 @@
 from __future__ import annotations
 
 import os
-from collections import OrderedDict
 from typing import Any
 
-import deepdanbooru as dd
 import numpy as np
 import tensorflow as tf
-from PIL import Image
 from PyQt5.QtCore import QRunnable, QThreadPool
 
+from src.commands.pipeline import list_images, normalize_images, preprocess_image
+from src.commands.prediction_cache import PredictionCache
+from src.commands.postprocess import TagPostProcessor, has_tags
+
 
 class Runnable(QRunnable):
     """
@@ -17,27 +18,19 @@ class Runnable(QRunnable):
     :param image_path: file name
     :param size: dimensions to resize to
     :param preprocessed_images: return array
+    :param compact: store images as uint8, see preprocess_image
     """
-    def __init__(self, image_path, size, preprocessed_images):
+    def __init__(self, image_path, size, preprocessed_images, compact=False):
 
         super().__init__()
         self.image_path = image_path
         self.size = size
         self.preprocessed_images = preprocessed_images
+        self.compact = compact
 
     def run(self):
         try:
-            # Model only supports 3 channels
-            image = Image.open(self.image_path).convert('RGB')
-
-            image = np.asarray(image)
-            image = tf.image.resize(image,
-                                    size=self.size,
-                                    method=tf.image.ResizeMethod.AREA,
-                                    preserve_aspect_ratio=True)
-            image = image.numpy()
-            image = dd.image.transform_and_pad_image(image, self.size[0], self.size[1])
-            image = image / 255.
+            image = preprocess_image(self.image_path, self.size, self.compact)
 
             self.preprocessed_images.append((self.image_path, image))
 
@@ -45,25 +38,32 @@ class Runnable(QRunnable):
             print(f"Error processing {self.image_path}: {e}")
 
 
-def process_images_from_directory(model: tf.keras.Model, directory: str | os.path) -> list[(str, np.ndarray)]:
+def process_images_from_directory(model: tf.keras.Model,
+                                  directory: str | os.path,
+                                  compact: bool = False,
+                                  exclude: set[str] | None = None
+                                  ) -> list[(str, np.ndarray)]:
     """
-    Processes all images in a directory, does not go into subdirectories.
+    Processes all images in a directory, does not go into subdirectories. Files that are not images are skipped.
     Images need to be shaped before predict can be called on it.
     :param model: model, shape is used to resize of images
     :param directory: directory of images to be precessed
+    :param compact: keep images as uint8 (4x less memory), they are normalized when predicted
+    :param exclude: file paths to skip
     :return: [(filename, ndarray)] returns a list of file names and processed images
     """
     preprocessed_images = []
-    image_filenames = os.listdir(directory)
+    image_paths = list_images(directory)
     pool = QThreadPool.globalInstance()
 
     # get dimensions from model
     _, height, width, _ = model.input_shape
     size = (height, width)
 
-    for filename in image_filenames:
-        image_path = os.path.join(directory, filename)
-        runnable = Runnable(image_path, size, preprocessed_images)
+    for image_path in image_paths:
+        if exclude and image_path in exclude:
+            continue
+        runnable = Runnable(image_path, size, preprocessed_images, compact)
         pool.start(runnable)
 
     pool.waitForDone()
@@ -76,60 +76,31 @@ def predict(
         char_labels: list[str],
         image: np.ndarray,
         score_threshold: float = 0.5,
-        char_threshold: float = 0.85
+        char_threshold: float = 0.85,
+        postprocessor: TagPostProcessor | None = None
 ) -> tuple[dict[str, float], dict[str, float], dict[str, float], dict[str, float], str] | None:
     """
     Predicts tags for the image given the model and tags.
     :param model: model to use
     :param labels: general tags
     :param char_labels: character tags
-    :param image: processed image
+    :param image: processed image, float or compact uint8
     :param score_threshold: general tags, if the probability of the prediction is greater than this number add to tags
     :param char_threshold: character tags, see above
+    :param postprocessor: TagPostProcessor of labels and char_labels, pass one when predicting many images,
+     building it indexes every label
     :return: None if there are no tags within threshold otherwise returns:
      result_threshold, result_all, result_rating, result_char, result_text
     """
+    if postprocessor is None:
+        postprocessor = TagPostProcessor(labels, char_labels)
     try:
         # Make a prediction using the model
-        probs = model.predict(image[None, ...])[0]
-        probs = probs.astype(float)
-
-        # Extract the last three tags as ratings
-        rating_labels = ["rating:safe", "rating:questionable", "rating:explicit"]
-        rating_probs = probs[-3:]
-
-        probs = probs[:-3]
-        result_rating = OrderedDict(zip(rating_labels, rating_probs))
-
-        # Get the indices of labels sorted by probability in descending order
-        indices = np.argsort(probs)[::-1]
-
-        result_all = OrderedDict()
-        result_threshold = OrderedDict()
-        result_char = OrderedDict()
-
-        # Iterate over the sorted indices
-        for index in indices:
-            label = labels[index]
-            prob = probs[index]
-
-            # Store result for all labels
-            result_all[label] = prob
-
-            # If probability is below the threshold, stop adding to threshold results, cannot assume char > general
-            if prob < score_threshold and prob < char_threshold:
-                break
+        probs = model.predict(normalize_images(image[None, ...]))
 
-            # Store result for labels above the threshold
-            if prob > score_threshold and label not in char_labels:
-                result_threshold[label] = prob
-            if prob > char_threshold and label in char_labels:
-                result_char[label] = prob
-
-        result_text = ', '.join(result_all.keys())
-
-        if len(result_threshold) > 0 or len(result_char) > 0:
-            return result_threshold, result_all, result_rating, result_char, result_text
+        result = postprocessor.process(probs, score_threshold, char_threshold)[0]
+        if has_tags(result):
+            return result
         else:
             return None
 
@@ -148,7 +119,9 @@ def predict_all(model: tf.keras.Model,
                 char_labels: list[str],
                 directory: str | os.path,
                 score_threshold: float = 0.5,
-                char_threshold: float = 0.85
+                char_threshold: float = 0.85,
+                compact: bool = False,
+                cache: PredictionCache | None = None
                 ) -> (
         list[tuple[Any, tuple[dict[str, float], dict[str, float], dict[str, float], dict[str, float], str]]] | None):
     """
@@ -159,17 +132,41 @@ def predict_all(model: tf.keras.Model,
     :param directory: folder to process
     :param score_threshold: general tags, if the probability of the prediction is greater than this number add to tags
     :param char_threshold: character tags, see above
+    :param compact: preprocess images as uint8, see process_images_from_directory
+    :param cache: prediction cache of the model, only images missing from it are processed and predicted
     :return:     :return: None if there are no tags within threshold otherwise returns:
      [(filename, (result_threshold, result_all, result_rating, result_char, result_text))]
     """
-    images = process_images_from_directory(model, directory)
-    processed_images = []
-    for image in images:
-        result = predict(model, labels, char_labels, image[1], score_threshold, char_threshold)
-        if result is not None:
-            processed_images.append((image[0], result))
-    if processed_images is not None:
+    postprocessor = TagPostProcessor(labels, char_labels)
+    if cache is None:
+        images = process_images_from_directory(model, directory, compact)
+        processed_images = []
+        for image in images:
+            result = predict(model, labels, char_labels, image[1], score_threshold, char_threshold, postprocessor)
+            if result is not None:
+                processed_images.append((image[0], result))
         return processed_images
-    else:
-        print("No results within threshold: ", score_threshold)
-        return None
+
+    cached = []
+    for image_path in list_images(directory):
+        try:
+            probs = cache.get(image_path)
+        except OSError as e:
+            print(f"Error processing {image_path}: {e}")
+            continue
+        if probs is not None:
+            cached.append((image_path, probs))
+
+    images = process_images_from_directory(model, directory, compact, exclude={path for path, _ in cached})
+    processed_images = []
+    for image_path, image in images:
+        probs = model.predict(normalize_images(image[None, ...]))[0]
+        cache.put(image_path, probs)
+        cached.append((image_path, probs))
+    cache.flush()
+
+    for image_path, probs in cached:
+        result = postprocessor.process(probs, score_threshold, char_threshold)[0]
+        if has_tags(result):
+            processed_images.append((image_path, result))
+    return processed_images
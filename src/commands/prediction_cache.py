@@ -0,0 +1,274 @@
+from __future__ import annotations
+
+import abc
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import numpy as np
+
+APP_NAME = "Bulk-AI-Image-Classification-Tool"
+
+
+def user_cache_dir() -> str:
+    """
+    Per user cache folder of the app, created if it does not exist
+    :return: path of the folder
+    """
+    if os.name == 'nt':
+        base = os.environ.get("LOCALAPPDATA", os.path.expanduser(r"~\AppData\Local"))
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser("~/Library/Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    path = os.path.join(base, APP_NAME)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def file_digest(path: str | os.path, chunk_size: int = 1 << 20) -> str:
+    """
+    Hashes the content of a file
+    :param path: file name
+    :param chunk_size: bytes read at a time
+    :return: hex digest
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SQLiteLRUCache(abc.ABC):
+    """
+    Base of the caches packed into one SQLite file, safe to use from several threads.
+    Entries are blobs with their size and last use, the least recently used are evicted once the cache grows
+    over max_bytes. Last use times of hits are written touch_batch at a time, or by put, flush and close.
+    Subclasses name the table, its key and blob columns and create it in create_tables.
+    :param db_path: database file
+    :param max_bytes: size limit of the stored blobs
+    """
+    table = ""
+    key_columns = ()
+    value_column = ""
+    touch_batch = 256
+
+    def __init__(self, db_path: str | os.path, max_bytes: int):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._touched = {}  # key -> last use of hits not written yet
+        self._where = " AND ".join(f"{column} = ?" for column in self.key_columns)
+
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self.create_tables()
+        self._db.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_last_used ON {self.table} (last_used)")
+        self._db.commit()
+        self._size = self._db.execute(f"SELECT COALESCE(SUM(nbytes), 0) FROM {self.table}").fetchone()[0]
+
+    @abc.abstractmethod
+    def create_tables(self) -> None:
+        """ Creates the table of the entries, with the key columns, the blob, nbytes and last_used"""
+
+    def _get(self, key: tuple) -> bytes | None:
+        """
+        :param key: values of the key columns
+        :return: stored blob or None on a miss
+        """
+        with self._lock:
+            row = self._db.execute(f"SELECT {self.value_column} FROM {self.table} WHERE {self._where}",
+                                   key).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touched[key] = time.time()
+            if len(self._touched) >= self.touch_batch:
+                self._write_touched()
+                self._db.commit()
+        return row[0]
+
+    def _put_many(self, entries: list[tuple[tuple, bytes]]) -> None:
+        """
+        Stores blobs in one transaction, evicting what no longer fits
+        :param entries: list of (key, blob)
+        """
+        now = time.time()
+        rows = [(*key, blob, len(blob), now) for key, blob in entries]
+        columns = ", ".join((*self.key_columns, self.value_column, "nbytes", "last_used"))
+        with self._lock:
+            for key, blob in entries:
+                old = self._db.execute(f"SELECT nbytes FROM {self.table} WHERE {self._where}", key).fetchone()
+                self._size += len(blob) - (old[0] if old else 0)
+            self._db.executemany(f"INSERT OR REPLACE INTO {self.table} ({columns}) "
+                                 f"VALUES ({', '.join('?' * (len(self.key_columns) + 3))})", rows)
+            self._write_touched()
+            self._evict()
+            self._db.commit()
+
+    def flush(self) -> None:
+        """ Writes the last use of hits"""
+        with self._lock:
+            self._write_touched()
+            self._db.commit()
+
+    def _write_touched(self) -> None:
+        if self._touched:
+            self._db.executemany(f"UPDATE {self.table} SET last_used = ? WHERE {self._where}",
+                                 [(last_used, *key) for key, last_used in self._touched.items()])
+            self._touched.clear()
+
+    def _evict(self) -> None:
+        """ Drops the least recently used entries until the cache is back under 90% of max_bytes"""
+        if self._size <= self.max_bytes:
+            return
+        target = self.max_bytes * 0.9
+        cursor = self._db.execute(f"SELECT {', '.join(self.key_columns)}, nbytes FROM {self.table} "
+                                  f"ORDER BY last_used")
+        evicted = []
+        for *key, nbytes in cursor:
+            if self._size <= target:
+                break
+            evicted.append(key)
+            self._size -= nbytes
+        self._db.executemany(f"DELETE FROM {self.table} WHERE {self._where}", evicted)
+
+    def stats(self) -> dict[str, int]:
+        """
+        :return: hit and miss counters, number of stored entries and their size
+        """
+        with self._lock:
+            entries = self._db.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": self._size}
+
+    def clear(self) -> None:
+        """ Removes every stored entry"""
+        with self._lock:
+            self._db.execute(f"DELETE FROM {self.table}")
+            self._db.commit()
+            self._touched.clear()
+            self._size = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._write_touched()
+            self._db.commit()
+            self._db.close()
+
+
+class PredictionCache(SQLiteLRUCache):
+    """
+    On disk cache of raw model outputs, backed by SQLite.
+    Predictions are keyed on the content hash of the image and a fingerprint of the model and its tags,
+    so renaming or moving a file still hits while editing it or switching models misses.
+    Fast decoded images give slightly different predictions, they are kept under a fingerprint of their own.
+    Content hashes are remembered by path, mtime and size so unchanged files are not read again.
+    Least recently used predictions are evicted once the cache grows over max_bytes.
+    :param model_path: model directory, the .h5 file and tags.txt make up the fingerprint
+    :param db_path: database file, defaults to predictions.sqlite3 in the user cache folder
+    :param max_bytes: size limit of the stored predictions
+    :param variant: what the model was converted to if it is not the float model, see model_variant
+    """
+    model_file = "model-resnet_custom_v3.h5"
+    tags_file = "tags.txt"
+    table = "predictions"
+    key_columns = ("model", "digest")
+    value_column = "probs"
+
+    def __init__(self, model_path: str | os.path, db_path: str | os.path | None = None, max_bytes: int = 1 << 30,
+                 variant: str = ""):
+        super().__init__(db_path or os.path.join(user_cache_dir(), "predictions.sqlite3"), max_bytes)
+        self._pending = {}  # path -> digest of lookups that missed, saves hashing again on put
+
+        self.fingerprint = self.model_fingerprint(model_path, variant)
+        self.fast_decode_fingerprint = self.model_fingerprint(model_path, variant, fast_decode=True)
+
+    def create_tables(self) -> None:
+        self._db.execute("CREATE TABLE IF NOT EXISTS files "
+                         "(path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, digest TEXT)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS predictions "
+                         "(model TEXT, digest TEXT, probs BLOB, nbytes INTEGER, last_used REAL, "
+                         "PRIMARY KEY (model, digest))")
+
+    def model_fingerprint(self, model_path: str | os.path, variant: str = "", fast_decode: bool = False) -> str:
+        """
+        :param model_path: model directory
+        :param variant: what the model was converted to, quantised models give slightly different predictions
+        :param fast_decode: the images are decoded at a reduced scale, see preprocess_image
+        :return: combined digest of the model file and its tags
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        for filename in (self.model_file, self.tags_file):
+            digest.update(self.digest(os.path.join(model_path, filename)).encode())
+        if variant:
+            digest.update(variant.encode())
+        if fast_decode:
+            digest.update(b"fast_decode")
+        return digest.hexdigest()
+
+    def digest(self, path: str | os.path, stat: os.stat_result | None = None) -> str:
+        """
+        Content hash of a file, only reads the file if its mtime or size changed since it was last hashed
+        :param path: file name
+        :param stat: result of os.stat if the caller already has it
+        :return: hex digest
+        """
+        path = os.path.abspath(path)
+        stat = stat or os.stat(path)
+        with self._lock:
+            row = self._db.execute("SELECT mtime_ns, size, digest FROM files WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == stat.st_mtime_ns and row[1] == stat.st_size:
+            return row[2]
+
+        digest = file_digest(path)
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                             (path, stat.st_mtime_ns, stat.st_size, digest))
+            self._db.commit()
+        return digest
+
+    def get(self, path: str | os.path, fast_decode: bool = False) -> np.ndarray | None:
+        """
+        :param path: image file name
+        :param fast_decode: the prediction would be made on a fast decoded image
+        :return: cached probabilities or None on a miss
+        """
+        digest = self.digest(path)
+        probs = self._get((self.fast_decode_fingerprint if fast_decode else self.fingerprint, digest))
+        if probs is None:
+            self._pending[path] = digest
+            return None
+        return np.frombuffer(probs, dtype=np.float32)
+
+    def put(self, path: str | os.path, probs: np.ndarray, fast_decode: bool = False) -> None:
+        """
+        :param path: image file name
+        :param probs: raw model output for the image
+        :param fast_decode: the prediction was made on a fast decoded image
+        """
+        self.put_many([path], [probs], fast_decode)
+
+    def put_many(self, paths: list[str], probs: np.ndarray | list[np.ndarray], fast_decode: bool = False) -> None:
+        """
+        Stores the predictions of a batch in one transaction
+        :param paths: image file names
+        :param probs: raw model output, one row per image
+        :param fast_decode: the predictions were made on fast decoded images
+        """
+        fingerprint = self.fast_decode_fingerprint if fast_decode else self.fingerprint
+        self._put_many([((fingerprint, self._pending.pop(path, None) or self.digest(path)),
+                         np.asarray(image_probs, dtype=np.float32).tobytes())
+                        for path, image_probs in zip(paths, probs)])
+
+    def flush(self) -> None:
+        """ Writes the last use of hits and forgets the misses that were not put, call once a run is done"""
+        super().flush()
+        self._pending.clear()
@@ -0,0 +1,229 @@
+from __future__ import annotations
+
+import json
+import os
+import re
+import shutil
+import struct
+import threading
+from typing import Iterable, Iterator
+
+import numpy as np
+
+from src.commands.prediction_cache import user_cache_dir
+
+_HEADER_SIZE = 128  # .npy header padded to a fixed size so the shape can be rewritten in place as the file grows
+
+
+def _write_header(f, shape: tuple[int, int], dtype: np.dtype) -> None:
+    header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': shape})
+    header = header.ljust(_HEADER_SIZE - 11) + "\n"
+    f.seek(0)
+    f.write(b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1"))
+
+
+def results_dir(directory: str | os.path, key: str) -> str:
+    """
+    Where the GUI keeps the results store of a folder
+    :param directory: folder that was tagged
+    :param key: tells runs over the same folder apart, e.g. a job id
+    :return: path in the user cache folder, named after the folder so it can be found in a file dialog
+    """
+    name = re.sub(r"[^\w.-]+", "_", os.path.basename(os.path.abspath(directory))) or "root"
+    return os.path.join(user_cache_dir(), "results", f"{name}-{key[:8]}")
+
+
+class ResultsStore:
+    """
+    Raw model outputs of a tagging job, one row per image, so thresholds can be applied again without the model.
+    Rows are kept as float16, or as uint8 with dtype=np.uint8 (steps of 1/255), instead of the float32 model output.
+    With a directory the matrix is a memory-mapped probs.npy that grows as rows are added, paths go to paths.jsonl
+    and labels to store.json, so only the pages being read are in memory and the run can be opened again later.
+    Without a directory everything stays in memory.
+    :param directory: folder to write the store to, its previous contents are replaced or OSError raised
+    :param dtype: np.float16 or np.uint8
+    :param labels: general tags of the model, the columns before the ratings
+    :param char_labels: character tags of the model
+    :param info: anything worth keeping with the results, e.g. the folder that was tagged
+    """
+    probs_file = "probs.npy"
+    paths_file = "paths.jsonl"
+    meta_file = "store.json"
+
+    def __init__(self,
+                 directory: str | os.path | None = None,
+                 dtype: np.dtype = np.float16,
+                 labels: list[str] | None = None,
+                 char_labels: Iterable[str] | None = None,
+                 info: dict | None = None):
+        self.directory = directory
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.float16, np.uint8):
+            raise ValueError(f"Unsupported store dtype {self.dtype}, use float16 or uint8")
+        self.labels = list(labels or [])
+        self.char_labels = list(char_labels or [])
+        self.info = dict(info or {})
+        self.paths = []
+        self.index = {}  # path -> row
+        self.read_only = False
+        self._probs = None  # (capacity, outputs), rows past len(self) are unused
+        self._paths_file = None
+        self._lock = threading.RLock()
+
+        if directory is not None:
+            # an earlier run of the same job, it has to be released first, see release
+            if os.path.lexists(directory):
+                shutil.rmtree(directory)
+            os.makedirs(directory)
+            self._write_meta()
+            self._paths_file = open(os.path.join(directory, self.paths_file), 'w', encoding='utf-8')
+
+    @classmethod
+    def open(cls, directory: str | os.path) -> ResultsStore:
+        """
+        Opens a store written earlier, read only
+        :param directory: folder of the store
+        :return: store
+        """
+        with open(os.path.join(directory, cls.meta_file), encoding='utf-8') as f:
+            meta = json.load(f)
+        store = cls.__new__(cls)
+        store.directory = directory
+        store.dtype = np.dtype(meta["dtype"])
+        store.labels = meta["labels"]
+        store.char_labels = meta["char_labels"]
+        store.info = meta["info"]
+        store.read_only = True
+        store._paths_file = None
+        store._lock = threading.RLock()
+
+        probs = np.load(os.path.join(directory, cls.probs_file), mmap_mode='r')
+        with open(os.path.join(directory, cls.paths_file), encoding='utf-8') as f:
+            # a run that crashed may have written rows without their paths or the other way round
+            store.paths = [json.loads(line) for line, _ in zip(f, range(len(probs)))]
+        store.index = {path: row for row, path in enumerate(store.paths)}
+        store._probs = probs
+        return store
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def __contains__(self, path: str | os.path) -> bool:
+        return path in self.index
+
+    def append(self, paths: list[str], probs: np.ndarray) -> None:
+        """
+        Adds a batch of results, a path that is already stored is replaced
+        :param paths: image file names
+        :param probs: model output in [0, 1], one row per image
+        """
+        if self.read_only:
+            raise ValueError("Results store was opened read only")
+        probs = self._quantize(np.asarray(probs))
+        with self._lock:
+            new, replaced = [], []
+            for i, path in enumerate(paths):
+                (replaced if path in self.index or path in paths[:i] else new).append(i)
+            if new:
+                start = len(self.paths)
+                self._reserve(start + len(new), probs.shape[1])
+                self._probs[start:start + len(new)] = probs[new]
+                for i in new:
+                    self.index[paths[i]] = len(self.paths)
+                    self.paths.append(paths[i])
+                if self._paths_file is not None:
+                    self._paths_file.write("".join(json.dumps(paths[i]) + "\n" for i in new))
+                    self._paths_file.flush()
+            for i in replaced:
+                self._probs[self.index[paths[i]]] = probs[i]
+
+    @property
+    def probs(self) -> np.ndarray:
+        """
+        :return: stored (images, outputs) matrix in the store dtype, rows line up with paths
+        """
+        with self._lock:
+            if self._probs is None:
+                return np.empty((0, 0), dtype=self.dtype)
+            return self._probs[:len(self.paths)]
+
+    def read(self, rows: int | slice | np.ndarray, dtype: type = np.float32) -> np.ndarray:
+        """
+        :param rows: row numbers, see rows
+        :param dtype: float type of the copy, float16 stores read as float16 skip the conversion
+        :return: probabilities as dtype
+        """
+        with self._lock:
+            # copy while holding the lock, appending may remap the file
+            probs = self.probs[rows].astype(dtype)
+        if self.dtype == np.uint8:
+            probs *= probs.dtype.type(1 / 255)
+        return probs
+
+    def rows(self, paths: Iterable[str]) -> np.ndarray:
+        """
+        :param paths: image file names, all of them have to be stored
+        :return: row numbers of the paths
+        """
+        return np.fromiter((self.index[path] for path in paths), dtype=np.intp)
+
+    def iter_chunks(self, chunk_size: int = 1024) -> Iterator[tuple[list[str], np.ndarray]]:
+        """
+        Walks the store in float32 slices, converting the whole matrix at once would need a lot more memory
+        :param chunk_size: rows per slice
+        :return: generator of (paths, probs)
+        """
+        for start in range(0, len(self.paths), chunk_size):
+            yield self.paths[start:start + chunk_size], self.read(slice(start, start + chunk_size))
+
+    def close(self) -> None:
+        """ Trims probs.npy to the rows in use so it loads with np.load, the store can not be added to afterwards"""
+        with self._lock:
+            if self._paths_file is not None:
+                self._paths_file.close()
+                self._paths_file = None
+                n_outputs = self._probs.shape[1] if self._probs is not None else len(self.labels) + 3
+                self._resize_file(len(self.paths), n_outputs)
+            self.read_only = True
+
+    def release(self) -> None:
+        """ Closes the store and unmaps probs.npy so its folder can be replaced, the store can not be read afterwards"""
+        with self._lock:
+            self.close()
+            self._probs = None
+            self.paths = []
+            self.index = {}
+
+    def _quantize(self, probs: np.ndarray) -> np.ndarray:
+        if self.dtype == np.uint8:
+            return np.rint(np.clip(probs, 0, 1) * 255).astype(np.uint8)
+        return probs.astype(self.dtype)
+
+    def _reserve(self, rows: int, n_outputs: int) -> None:
+        capacity = 0 if self._probs is None else len(self._probs)
+        if rows <= capacity:
+            return
+        capacity = max(rows, capacity * 2, 256)
+        if self.directory is None:
+            probs = np.empty((capacity, n_outputs), dtype=self.dtype)
+            if self._probs is not None:
+                probs[:len(self.paths)] = self._probs[:len(self.paths)]
+            self._probs = probs
+            return
+        self._resize_file(capacity, n_outputs)
+
+    def _resize_file(self, rows: int, n_outputs: int) -> None:
+        path = os.path.join(self.directory, self.probs_file)
+        if self._probs is not None:
+            self._probs.flush()
+            self._probs = None
+        with open(path, 'r+b' if os.path.exists(path) else 'w+b') as f:
+            _write_header(f, (rows, n_outputs), self.dtype)
+            f.truncate(_HEADER_SIZE + rows * n_outputs * self.dtype.itemsize)
+        if rows:
+            self._probs = np.memmap(path, dtype=self.dtype, mode='r+', offset=_HEADER_SIZE, shape=(rows, n_outputs))
+
+    def _write_meta(self) -> None:
+        with open(os.path.join(self.directory, self.meta_file), 'w', encoding='utf-8') as f:
+            json.dump({"dtype": self.dtype.str, "labels": self.labels, "char_labels": self.char_labels,
+                       "info": self.info}, f)
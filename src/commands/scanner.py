@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import fnmatch
+import os
+from typing import Iterable, Iterator, NamedTuple
+
+IMAGE_EXTENSIONS = frozenset({".jpg", ".jpeg", ".jpe", ".jfif", ".png", ".gif", ".bmp", ".webp", ".tif", ".tiff"})
+
+# (offset, signature) of the formats in IMAGE_EXTENSIONS
+MAGIC_NUMBERS = (
+    (0, b"\xff\xd8\xff"),  # jpeg
+    (0, b"\x89PNG\r\n\x1a\n"),
+    (0, b"GIF87a"),
+    (0, b"GIF89a"),
+    (0, b"BM"),
+    (8, b"WEBP"),
+    (0, b"II*\x00"),  # tiff, little endian
+    (0, b"MM\x00*"),  # tiff, big endian
+)
+
+
+class ScanEntry(NamedTuple):
+    path: str
+    stat: os.stat_result
+
+
+def has_image_signature(path: str | os.path) -> bool:
+    """
+    Checks the first bytes of a file against known image formats
+    :param path: file name
+    :return: True if the file looks like an image
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(16)
+    except OSError:
+        return False
+    return any(header[offset:offset + len(magic)] == magic for offset, magic in MAGIC_NUMBERS)
+
+
+def _matches(relative_path: str, name: str, patterns: Iterable[str]) -> bool:
+    return any(fnmatch.fnmatch(relative_path, pattern) or fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+
+def scan_images(directory: str | os.path,
+                recursive: bool = False,
+                max_depth: int | None = None,
+                include: Iterable[str] | None = None,
+                exclude: Iterable[str] | None = None,
+                extensions: Iterable[str] | None = IMAGE_EXTENSIONS,
+                check_magic: bool = False
+                ) -> Iterator[ScanEntry]:
+    """
+    Lazily walks a directory and yields the images in it, folders are listed one at a time
+    so processing can start before a large tree has been fully enumerated.
+    Glob patterns are matched against the file name and the path relative to directory (using / separators).
+    :param directory: folder to scan
+    :param recursive: go into subdirectories
+    :param max_depth: how many levels of subdirectories to go into when recursive, None for no limit
+    :param include: only yield files matching one of these patterns
+    :param exclude: skip files and folders matching one of these patterns
+    :param extensions: lower case file extensions to accept, None to accept every file
+    :param check_magic: also check the first bytes of each file, catches files with the wrong extension
+    :return: generator of (path, stat)
+    """
+    include = list(include or [])
+    exclude = list(exclude or [])
+    extensions = {extension.lower() for extension in extensions} if extensions is not None else None
+
+    pending = [(os.fspath(directory), "", 0)]
+    while pending:
+        folder, relative_folder, depth = pending.pop()
+        try:
+            entries = os.scandir(folder)
+        except OSError as e:
+            print(f"Error scanning {folder}: {e}")
+            continue
+
+        subfolders = []
+        with entries:
+            for entry in entries:
+                relative_path = relative_folder + entry.name
+                if exclude and _matches(relative_path, entry.name, exclude):
+                    continue
+                try:
+                    if entry.is_dir():
+                        if recursive and (max_depth is None or depth < max_depth):
+                            subfolders.append((entry.path, relative_path + "/", depth + 1))
+                        continue
+                    if not entry.is_file():
+                        continue
+                    if extensions is not None and os.path.splitext(entry.name)[1].lower() not in extensions:
+                        continue
+                    if include and not _matches(relative_path, entry.name, include):
+                        continue
+                    if check_magic and not has_image_signature(entry.path):
+                        continue
+                    yield ScanEntry(entry.path, entry.stat())
+                except OSError as e:
+                    print(f"Error scanning {entry.path}: {e}")
+
+        # visit subfolders in the order they were listed
+        pending.extend(reversed(subfolders))
@@ -0,0 +1,214 @@
+from __future__ import annotations
+
+from collections import defaultdict
+from typing import Iterable, Sequence
+
+import numpy as np
+
+
+def _key(tag: str) -> str:
+    return tag.strip().lower()
+
+
+def _keys(tags: Iterable[str]) -> frozenset[str]:
+    # map over the str methods, a generator calling _key is several times slower on large indexes
+    return frozenset(map(str.strip, map(str.lower, tags))) - {""}
+
+
+class TagIndex:
+    """
+    Inverted index from tag to the rows that have it, for filtering a long list of images by several tags at once.
+    Each tag keeps a bitmap of rows packed 8 to a byte, rows with all of a set of tags are the AND of their bitmaps.
+    Tags match whole and ignore case, hat does not match white_hat.
+    Rows line up with the rows of a list model, insert_rows and remove_rows follow the model as it changes.
+    """
+    def __init__(self):
+        self._bitmaps = {}  # tag -> uint8 array of self._nbytes, bit (row & 7) of byte (row >> 3)
+        self._row_tags = []  # tags of each row, a frozenset or a tuple for rows set by set_ids
+        self._nbytes = 0
+
+    def __len__(self) -> int:
+        return len(self._row_tags)
+
+    def __contains__(self, tag: str) -> bool:
+        return _key(tag) in self._bitmaps
+
+    def clear(self) -> None:
+        self._bitmaps = {}
+        self._row_tags = []
+        self._nbytes = 0
+
+    def set_row(self, row: int, tags: Iterable[str]) -> None:
+        """
+        Replaces the tags of a row
+        :param row: row number, below len(self)
+        :param tags: tags of the row, empty strings are skipped
+        """
+        tags = _keys(tags)
+        old = frozenset(self._row_tags[row])
+        byte, bit = row >> 3, np.uint8(1 << (row & 7))
+        for tag in old - tags:
+            self._bitmaps[tag][byte] &= ~bit
+        for tag in tags - old:
+            bitmap = self._bitmaps.get(tag)
+            if bitmap is None:
+                bitmap = self._bitmaps[tag] = np.zeros(self._nbytes, dtype=np.uint8)
+            bitmap[byte] |= bit
+        self._row_tags[row] = tags
+
+    def set_rows(self, first: int, rows_tags: Iterable[Iterable[str]]) -> None:
+        """
+        set_row for consecutive rows, much faster when most of the rows are new
+        :param first: row number of the first row
+        :param rows_tags: tags of each row
+        """
+        postings = defaultdict(list)  # tag -> rows to set
+        for row, tags in enumerate(rows_tags, first):
+            tags = _keys(tags)
+            if self._row_tags[row]:
+                self.set_row(row, tags)
+                continue
+            self._row_tags[row] = tags
+            for tag in tags:
+                postings[tag].append(row)
+        for tag, rows in postings.items():
+            rows = np.array(rows, dtype=np.intp)
+            bitmap = self._bitmaps.get(tag)
+            if bitmap is None:
+                bitmap = self._bitmaps[tag] = np.zeros(self._nbytes, dtype=np.uint8)
+            # rows are ascending, combine the bits of rows that share a byte before setting them
+            byte = rows >> 3
+            starts = np.flatnonzero(np.r_[True, byte[1:] != byte[:-1]])
+            bitmap[byte[starts]] |= np.bitwise_or.reduceat((1 << (rows & 7)).astype(np.uint8), starts)
+
+    def set_ids(self, first: int, counts: np.ndarray, ids: np.ndarray, names: Sequence[str]) -> None:
+        """
+        set_rows with the tags given as numbers into names, each name is made a key once
+        and the bitmaps of every row are set together, for indexing thousands of rows
+        :param first: row number of the first row
+        :param counts: number of tags of each row
+        :param ids: tags of the rows one row after the other
+        :param names: tag of each number
+        """
+        index = {}
+        key_ids = np.fromiter((index.setdefault(_key(name), len(index)) for name in names), dtype=np.intp,
+                              count=len(names))
+        keys = np.array(list(index), dtype=object)
+        rows = np.repeat(np.arange(first, first + len(counts)), counts)
+        ids = key_ids[ids]
+        if "" in index:
+            valid = ids != index[""]
+            rows, ids = rows[valid], ids[valid]
+            counts = np.bincount(rows - first, minlength=len(counts))
+
+        ends = np.cumsum(counts).tolist()
+        row_keys = keys[ids].tolist()
+        new = np.ones(len(counts), dtype=bool)
+        for row, start, end in zip(range(first, first + len(counts)), [0] + ends[:-1], ends):
+            # kept as a tuple, hashing every tag into a frozenset took longer than the rest together
+            tags = tuple(row_keys[start:end])
+            if self._row_tags[row]:
+                self.set_row(row, tags)
+                new[row - first] = False
+            else:
+                self._row_tags[row] = tags
+        set_new = new[rows - first]
+        rows, ids = rows[set_new], ids[set_new]
+        if not len(rows):
+            return
+
+        # bits of the new rows for each of their tags, only over the bytes the rows fall in
+        start_byte = first >> 3
+        span = ((first + len(counts) - 1) >> 3) + 1 - start_byte
+        found = np.flatnonzero(np.bincount(ids, minlength=len(keys)))
+        slots = np.zeros(len(keys), dtype=np.intp)
+        slots[found] = np.arange(len(found))
+        bits = np.zeros((len(found), span), dtype=np.uint8)
+        np.bitwise_or.at(bits.ravel(), slots[ids] * span + (rows >> 3) - start_byte,
+                         (1 << (rows & 7)).astype(np.uint8))
+        for tag, tag_bits in zip(keys[found].tolist(), bits):
+            bitmap = self._bitmaps.get(tag)
+            if bitmap is None:
+                bitmap = self._bitmaps[tag] = np.zeros(self._nbytes, dtype=np.uint8)
+            bitmap[start_byte:start_byte + span] |= tag_bits
+
+    def insert_rows(self, first: int, count: int) -> None:
+        """
+        Adds rows without tags before first, later rows move down
+        :param first: row number of the first new row
+        :param count: number of rows
+        """
+        rows = len(self._row_tags)
+        self._row_tags[first:first] = [frozenset()] * count
+        self._reserve(rows + count)
+        if first < rows:
+            self._shift(lambda bits: np.insert(bits, first, np.zeros(count, dtype=np.uint8)), rows)
+
+    def remove_rows(self, first: int, count: int) -> None:
+        """
+        :param first: row number of the first row to remove
+        :param count: number of rows, later rows move up
+        """
+        rows = len(self._row_tags)
+        del self._row_tags[first:first + count]
+        self._shift(lambda bits: np.delete(bits, np.s_[first:first + count]), rows)
+        # tags only the removed rows had are not searchable any more
+        for tag in [tag for tag, bitmap in self._bitmaps.items() if not bitmap.any()]:
+            del self._bitmaps[tag]
+
+    def tags(self, row: int) -> frozenset[str]:
+        """
+        :param row: row number
+        :return: tags of the row, lower case
+        """
+        return frozenset(self._row_tags[row])
+
+    def match(self, tags: Iterable[str]) -> np.ndarray:
+        """
+        :param tags: tags every matching row must have, no tags matches every row
+        :return: bool array with one entry per row
+        """
+        result = np.full(self._nbytes, 0xFF, dtype=np.uint8)
+        for key in _keys(tags):
+            bitmap = self._bitmaps.get(key)
+            if bitmap is None:
+                return np.zeros(len(self._row_tags), dtype=bool)
+            np.bitwise_and(result, bitmap, out=result)
+        return np.unpackbits(result, count=len(self._row_tags), bitorder='little').view(bool)
+
+    def matches_row(self, row: int, tags: Iterable[str]) -> bool:
+        """
+        match for a single row, without going through the bitmaps
+        """
+        return _keys(tags).issubset(self._row_tags[row])
+
+    def count(self, tag: str) -> int:
+        """
+        :param tag: tag
+        :return: number of rows with the tag
+        """
+        bitmap = self._bitmaps.get(_key(tag))
+        return 0 if bitmap is None else int(np.unpackbits(bitmap).sum())
+
+    def _reserve(self, rows: int) -> None:
+        nbytes = (rows + 7) >> 3
+        if nbytes <= self._nbytes:
+            return
+        # grow by doubling so adding rows one at a time stays cheap
+        self._nbytes = max(nbytes, self._nbytes * 2, 64)
+        for tag, bitmap in self._bitmaps.items():
+            grown = np.zeros(self._nbytes, dtype=np.uint8)
+            grown[:len(bitmap)] = bitmap
+            self._bitmaps[tag] = grown
+
+    def _shift(self, move, rows: int) -> None:
+        """
+        Moves rows of every bitmap, only needed when rows are added or removed in the middle
+        :param move: takes the unpacked bits of the first rows rows of a bitmap and returns the new bits
+        :param rows: number of rows before the change
+        """
+        for tag, bitmap in self._bitmaps.items():
+            bits = move(np.unpackbits(bitmap, count=rows, bitorder='little'))
+            packed = np.packbits(bits, bitorder='little')
+            bitmap[:] = 0
+            bitmap[:len(packed)] = packed
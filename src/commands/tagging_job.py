@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import contextlib
+import glob
+import hashlib
+import os
+import shutil
+import threading
+from typing import Iterable, Iterator
+
+import numpy as np
+import tensorflow as tf
+
+from src.commands.metrics import PipelineMetrics
+from src.commands.pipeline import stream_predictions
+from src.commands.prediction_cache import PredictionCache, user_cache_dir
+from src.commands.scanner import scan_images
+
+
+def job_id(directory: str | os.path, model_path: str | os.path, recursive: bool = False,
+           fast_decode: bool = False, variant: str = "") -> str:
+    """
+    Identifies a tagging job, the same folder tagged with the same settings and an unchanged model gets the same id
+    :param directory: folder being tagged
+    :param model_path: model directory
+    :param recursive: subdirectories are tagged too
+    :param fast_decode: large images are decoded at a reduced scale
+    :param variant: what the model was converted to, see model_variant
+    :return: hex digest
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for value in (os.path.abspath(directory), os.path.abspath(model_path), recursive, fast_decode):
+        digest.update(repr(value).encode())
+    if variant:
+        digest.update(variant.encode())
+    for filename in (PredictionCache.model_file, PredictionCache.tags_file):
+        try:
+            stat = os.stat(os.path.join(model_path, filename))
+            digest.update(repr((stat.st_mtime_ns, stat.st_size)).encode())
+        except OSError:
+            pass
+    return digest.hexdigest()
+
+
+class TaggingJob:
+    """
+    Tags a folder in chunks that can be cancelled between batches.
+    Raw predictions of every finished chunk are checkpointed to disk, running a job that was cancelled
+    or crashed again returns the checkpointed chunks first and only predicts the images that are left.
+    Checkpoints are removed once the job runs to completion.
+    :param directory: folder to tag
+    :param model_path: model directory, used to tell jobs apart. None disables checkpoints
+    :param recursive: also tag images in subdirectories
+    :param fast_decode: decode large images at a reduced scale, see preprocess_image
+    :param chunk_size: number of images per checkpoint
+    :param checkpoint_dir: folder for the checkpoints of all jobs, defaults to jobs in the user cache folder
+    :param variant: what the model was converted to, see model_variant
+    """
+    def __init__(self,
+                 directory: str | os.path,
+                 model_path: str | os.path | None = None,
+                 recursive: bool = False,
+                 fast_decode: bool = False,
+                 chunk_size: int = 200,
+                 checkpoint_dir: str | os.path | None = None,
+                 variant: str = ""):
+        self.directory = directory
+        self.recursive = recursive
+        self.fast_decode = fast_decode
+        self.chunk_size = chunk_size
+        self.path = None
+        if model_path is not None:
+            checkpoint_dir = checkpoint_dir or os.path.join(user_cache_dir(), "jobs")
+            job = job_id(directory, model_path, recursive, fast_decode, variant)
+            self.path = os.path.join(checkpoint_dir, job)
+        self.restored = 0  # images returned from checkpoints by the last run
+        self._cancel = threading.Event()
+
+    def cancel(self) -> None:
+        """ Stops the job after the batch being predicted, safe to call from any thread"""
+        self._cancel.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    @property
+    def checkpoints(self) -> list[str]:
+        """
+        :return: checkpoint files of this job in the order they were written
+        """
+        if self.path is None:
+            return []
+        return sorted(glob.glob(os.path.join(self.path, "chunk-*.npz")))
+
+    def restore(self) -> Iterator[tuple[list[str], np.ndarray]]:
+        """
+        Reads the checkpointed chunks, unreadable ones are skipped and their images predicted again
+        :return: generator of (file names, probabilities)
+        """
+        for checkpoint in self.checkpoints:
+            try:
+                with np.load(checkpoint) as chunk:
+                    filenames = chunk["filenames"].tolist()
+                    probs = chunk["probs"].astype(float)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Error reading checkpoint {checkpoint}: {e}")
+                continue
+            yield filenames, probs
+
+    def discard(self) -> None:
+        """ Removes the checkpoints of this job"""
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def run(self,
+            model: tf.keras.Model,
+            image_paths: Iterable[str] | None = None,
+            batch_size: int = 20,
+            queue_depth: int = 4,
+            workers: int | None = None,
+            cache: PredictionCache | None = None,
+            backend: str = "thread",
+            metrics: PipelineMetrics | None = None
+            ) -> Iterator[tuple[list[str], np.ndarray]]:
+        """
+        Predicts the images of the folder, see stream_predictions.
+        Checkpointed chunks come out first. The chunk in progress is checkpointed if the job is cancelled,
+        fails or the generator is closed early.
+        :param model: model to use
+        :param image_paths: files to process, defaults to the images found in directory
+        :param batch_size: number of images per batch
+        :param queue_depth: number of batches that can be waiting to be predicted
+        :param workers: number of decode threads or processes
+        :param cache: prediction cache of the model
+        :param backend: "thread", "process" or "tfdata", see pipeline.BACKENDS and decode_images
+        :param metrics: see stream_predictions, also records restore and checkpoint times
+        :return: generator of (file names, probabilities)
+        """
+        self.restored = 0
+        done = set()
+        for filenames, probs in self.restore():
+            done.update(os.path.abspath(filename) for filename in filenames)
+            self.restored += len(filenames)
+            if metrics is not None:
+                metrics.add_images(len(filenames))
+            yield filenames, probs
+            if self.cancelled:
+                return
+
+        if image_paths is None:
+            image_paths = (entry.path for entry in scan_images(self.directory, recursive=self.recursive))
+        pending = (image_path for image_path in image_paths if os.path.abspath(image_path) not in done)
+        predictions = stream_predictions(model, pending, batch_size, queue_depth, workers,
+                                         cache=cache, backend=backend, fast_decode=self.fast_decode, metrics=metrics)
+
+        chunk_filenames, chunk_probs = [], []
+        try:
+            for filenames, probs in predictions:
+                chunk_filenames.extend(filenames)
+                chunk_probs.append(probs)
+                yield filenames, probs
+                if len(chunk_filenames) >= self.chunk_size:
+                    timer = metrics.stage("checkpoint", len(chunk_filenames)) if metrics else contextlib.nullcontext()
+                    with timer:
+                        self._save_chunk(chunk_filenames, chunk_probs)
+                    chunk_filenames, chunk_probs = [], []
+                if self.cancelled:
+                    break
+        finally:
+            predictions.close()
+            if chunk_filenames:
+                self._save_chunk(chunk_filenames, chunk_probs)
+
+        if not self.cancelled:
+            self.discard()
+
+    def _save_chunk(self, filenames: list[str], probs: list[np.ndarray]) -> None:
+        if self.path is None:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        checkpoint = os.path.join(self.path, f"chunk-{len(self.checkpoints):06d}.npz")
+        # write then rename so a crash never leaves half a checkpoint behind
+        temp_path = checkpoint + ".tmp"
+        try:
+            with open(temp_path, 'wb') as f:
+                np.savez(f, filenames=np.array(filenames), probs=np.concatenate(probs).astype(np.float32))
+            os.replace(temp_path, checkpoint)
+        except OSError as e:
+            print(f"Error writing checkpoint {checkpoint}: {e}")
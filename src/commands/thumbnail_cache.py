@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import hashlib
+import os
+
+from src.commands.prediction_cache import SQLiteLRUCache, user_cache_dir
+
+
+class ThumbnailCache(SQLiteLRUCache):
+    """
+    On disk cache of encoded thumbnails, packed into one SQLite file instead of a file per image.
+    Thumbnails are keyed on the path, mtime and size of the image and the thumbnail height, editing or replacing
+    an image misses. Least recently used thumbnails are evicted once the cache grows over max_bytes.
+    Safe to use from several threads.
+    :param db_path: database file, defaults to thumbnails.sqlite3 in the user cache folder
+    :param max_bytes: size limit of the stored thumbnails
+    """
+    table = "thumbnails"
+    key_columns = ("key",)
+    value_column = "data"
+
+    def __init__(self, db_path: str | os.path | None = None, max_bytes: int = 512 << 20):
+        super().__init__(db_path or os.path.join(user_cache_dir(), "thumbnails.sqlite3"), max_bytes)
+
+    def create_tables(self) -> None:
+        self._db.execute("CREATE TABLE IF NOT EXISTS thumbnails "
+                         "(key TEXT PRIMARY KEY, data BLOB, nbytes INTEGER, last_used REAL)")
+
+    @staticmethod
+    def key(path: str | os.path, height: int, stat: os.stat_result | None = None) -> str:
+        """
+        :param path: image file name
+        :param height: thumbnail height
+        :param stat: result of os.stat if the caller already has it
+        :return: cache key of the thumbnail
+        """
+        path = os.path.abspath(path)
+        stat = stat or os.stat(path)
+        return hashlib.blake2b(f"{path}\0{stat.st_mtime_ns}\0{stat.st_size}\0{height}".encode(),
+                               digest_size=16).hexdigest()
+
+    def get(self, path: str | os.path, height: int) -> bytes | None:
+        """
+        :param path: image file name
+        :param height: thumbnail height
+        :return: encoded thumbnail or None on a miss, also None if the image is gone
+        """
+        try:
+            key = self.key(path, height)
+        except OSError:
+            return None
+        return self._get((key,))
+
+    def put(self, path: str | os.path, height: int, data: bytes) -> None:
+        """
+        :param path: image file name
+        :param height: thumbnail height
+        :param data: encoded thumbnail
+        """
+        try:
+            key = self.key(path, height)
+        except OSError:
+            return
+        self._put_many([((key,), data)])
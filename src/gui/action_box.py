@@ -1,19 +1,32 @@
 import os
-from collections import OrderedDict
+import sqlite3
+import threading
 
 import numpy as np
 from PyQt5 import QtCore
-from PyQt5.QtCore import Qt, QObject, pyqtSignal, QThread, QStringListModel
-from PyQt5.QtGui import QPixmap, QIcon
-from PyQt5.QtWidgets import QListWidgetItem, QProgressDialog, QGroupBox
+from PyQt5.QtCore import Qt, QObject, pyqtSignal, QThread, QStringListModel, QTimer, QSettings
+from PyQt5.QtWidgets import QProgressDialog, QGroupBox
 from PyQt5.QtWidgets import QWidget, QHBoxLayout, QVBoxLayout, QLabel, QPushButton, QGridLayout, \
-    QLineEdit, QSlider, QSpinBox, QFileDialog, QMessageBox
+    QLineEdit, QSlider, QSpinBox, QFileDialog, QMessageBox, QCheckBox, QComboBox
 
 import tensorflow as tf
 
+from src.commands.autotune import BatchSizeCache, tuned_batch_size
+from src.commands.backends import INFERENCE_BACKENDS, load_backend, model_variant, compare_backends, \
+    format_agreement
+from src.commands.metrics import PipelineMetrics
+from src.commands.postprocess import TagPostProcessor
+from src.commands.model_cache import ModelCache, warm_up
+from src.commands.prediction_cache import PredictionCache, user_cache_dir, APP_NAME
+from src.commands.results_store import ResultsStore, results_dir
+from src.commands.pipeline import list_images
+from src.commands.scanner import scan_images
+from src.commands.tagging_job import TaggingJob, job_id
 from src.commands.predict_all import process_images_from_directory, predict
-from src.commands.exif_actions import write_tags
+from src.commands.exif_actions import write_tags, write_tags_all
+from src.commands.export import open_exporter, export_store, format_for
 from src.commands.load_actions import load_model, load_labels, load_char_labels
+from src.gui.results_model import StoreResults
 
 FILE_PATH = Qt.UserRole
 RATING = Qt.UserRole + 1
@@ -33,7 +46,18 @@ class ActionBox(QGroupBox):
         self.dir_button = QPushButton("Browse")
 
         self.images = []
+        self.progress_value = 0
+        self.metrics = None  # PipelineMetrics of the last job
+        self.job_running = False
+        self.job_thresholds = None  # (general, character) the results were made with
+        self.submitted_sliders = None
+        self.general_threshold = None
+        self.character_threshold = None
+        self.store_results = None  # StoreResults the filelist rows read from
+        self.settings = QSettings(APP_NAME, APP_NAME)
+        self.preload_thread = None
         self.initUI()
+        self.preload_model()
 
     def initUI(self):
         action_layout = QVBoxLayout()
@@ -72,6 +96,33 @@ class ActionBox(QGroupBox):
         selection_grid.addWidget(self.model_button, 0, 1)
         selection_grid.addWidget(self.dir_input, 1, 0)
         selection_grid.addWidget(self.dir_button, 1, 1)
+        self.recursive_check = QCheckBox("Include subdirectories")
+        selection_grid.addWidget(self.recursive_check, 2, 0)
+        self.fast_decode_check = QCheckBox("Fast decode")
+        self.fast_decode_check.setToolTip("Decode large images at a reduced size, tags may differ slightly")
+        selection_grid.addWidget(self.fast_decode_check, 2, 1)
+        self.preload_check = QCheckBox("Load last model on start")
+        self.preload_check.setToolTip("Load the last model used in the background when the app starts")
+        self.preload_check.setChecked(self.settings.value("model/preload", True, type=bool))
+        self.preload_check.toggled.connect(lambda checked: self.settings.setValue("model/preload", checked))
+        selection_grid.addWidget(self.preload_check, 3, 0)
+        self.inference_combo = QComboBox()
+        self.inference_combo.addItems(INFERENCE_BACKENDS)
+        self.inference_combo.setToolTip("keras runs the float model. tflite quantises the weights to int8, "
+                                        "tflite-int8 also the activations, calibrated on images of the folder above. "
+                                        "Applies when the model is loaded")
+        self.inference_combo.setCurrentText(self.settings.value("model/inference", "keras", type=str))
+        self.inference_combo.currentTextChanged.connect(lambda text: self.settings.setValue("model/inference", text))
+        selection_grid.addWidget(self.inference_combo, 3, 1)
+        self.batch_size_spin = QSpinBox()
+        self.batch_size_spin.setRange(0, 1024)
+        self.batch_size_spin.setPrefix("Batch size: ")
+        self.batch_size_spin.setSpecialValueText("Batch size: auto")  # shown for 0
+        self.batch_size_spin.setToolTip("Images per model call. Auto probes the model for the fastest size that fits "
+                                        "in memory the first time it runs on this machine")
+        self.batch_size_spin.setValue(self.settings.value("predict/batch_size", 0, type=int))
+        self.batch_size_spin.valueChanged.connect(lambda value: self.settings.setValue("predict/batch_size", value))
+        selection_grid.addWidget(self.batch_size_spin, 4, 0)
 
         general_tag = QLabel("General Tags Threshold")
         character_tag = QLabel("Character Tags Threshold")
@@ -98,6 +149,17 @@ class ActionBox(QGroupBox):
         character_threshold.valueChanged.connect(lambda value: character_slider.setValue(value))
         general_threshold.setValue(50)
         character_threshold.setValue(85)
+        self.general_threshold = general_threshold
+        self.character_threshold = character_threshold
+
+        # Sliders fire on every step, wait for them to settle before filtering the results again
+        self.threshold_timer = QTimer(self)
+        self.threshold_timer.setSingleShot(True)
+        self.threshold_timer.setInterval(150)
+        self.threshold_timer.timeout.connect(
+            lambda: self.apply_thresholds(general_threshold.value(), character_threshold.value()))
+        general_threshold.valueChanged.connect(lambda value: self.threshold_timer.start())
+        character_threshold.valueChanged.connect(lambda value: self.threshold_timer.start())
 
         slider_grid.addWidget(general_tag, 0, 0)
         slider_grid.addWidget(general_threshold, 0, 2)
@@ -108,16 +170,30 @@ class ActionBox(QGroupBox):
 
         submit_button = QPushButton("Submit")
         submit_button.clicked.connect(
-            lambda: self.submit(self.dir_input.text(), general_threshold.value(), character_threshold.value()))
+            lambda: self.submit(self.dir_input.text(), general_threshold.value(), character_threshold.value(),
+                                self.recursive_check.isChecked(), self.fast_decode_check.isChecked()))
 
         one_image_button = QPushButton("Tag Current Image")
         selected_images_button = QPushButton("Tag Selected images")
+        open_results_button = QPushButton("Open Results")
+        open_results_button.setToolTip("Show the results of an earlier job without running the model")
+        export_button = QPushButton("Export")
+        export_button.setToolTip("Save the tags of the images in the list as JSONL, CSV, SQLite or a file next to each "
+                                 "image, the images are not changed")
+        report_button = QPushButton("Save Report")
+        report_button.setToolTip("Save timings and memory use of the last job as JSON or CSV")
         one_image_button.clicked.connect(lambda: self.tag_image())
         selected_images_button.clicked.connect(lambda: self.tag_selected_images())
+        open_results_button.clicked.connect(lambda: self.open_results())
+        export_button.clicked.connect(lambda: self.export_results())
+        report_button.clicked.connect(lambda: self.save_report())
 
         button_grid.addWidget(submit_button)
         button_grid.addWidget(one_image_button)
         button_grid.addWidget(selected_images_button)
+        button_grid.addWidget(open_results_button)
+        button_grid.addWidget(export_button)
+        button_grid.addWidget(report_button)
 
     def browse_directory(self, line_edit):
         """
@@ -146,6 +222,7 @@ class ActionBox(QGroupBox):
 
     def load_models(self, directory_path):
 
+            self.model_input.setText(directory_path)
             self.pd = QProgressDialog("Loading Model...", None, 0, 0, self.main_widget)
             # Prevents the user from interacting with the gui until finished
             self.pd.setWindowModality(QtCore.Qt.WindowModal)
@@ -157,7 +234,7 @@ class ActionBox(QGroupBox):
             # self.pd.forceShow()  # use instead of above incase it does not show
 
             self.thread = QThread(self.main_widget)
-            self.worker = ModelWorker(directory_path)
+            self.worker = ModelWorker(directory_path, self.inference_combo.currentText(), self.dir_input.text() or None)
 
             self.worker.moveToThread(self.thread)
 
@@ -170,24 +247,73 @@ class ActionBox(QGroupBox):
 
             self.thread.start()
 
+    def preload_model(self) -> bool:
+        """
+        Loads the last model used in the background, the GUI can be used meanwhile
+        :return: True if a model is being loaded
+        """
+        directory_path = self.settings.value("model/last_path", "", type=str)
+        if not self.preload_check.isChecked() or not directory_path:
+            return False
+        if not os.path.isfile(os.path.join(directory_path, PredictionCache.model_file)):
+            return False
+
+        self.model_input.setText(directory_path)
+        self.preload_thread = QThread(self.main_widget)
+        self.preload_worker = ModelWorker(directory_path, self.inference_combo.currentText(),
+                                          self.dir_input.text() or None)
+        self.preload_worker.moveToThread(self.preload_thread)
+
+        self.preload_thread.started.connect(self.preload_worker.run)
+        self.preload_worker.finished.connect(self._load_results)
+        self.preload_worker.finished.connect(self.preload_thread.quit)
+        self.preload_worker.finished.connect(self.preload_worker.deleteLater)
+        self.preload_thread.finished.connect(self.preload_thread.deleteLater)
+
+        self.preload_thread.start()
+        return True
+
+    def wait_for_preload(self) -> None:
+        """ Blocks until a model being preloaded is loaded, Qt aborts if its thread is destroyed while running"""
+        try:
+            if self.preload_thread is not None and self.preload_thread.isRunning():
+                self.preload_thread.wait()
+        except RuntimeError:  # the thread finished and was deleted already
+            pass
+        self.preload_thread = None
+
     def _load_results(self, results) -> None:
         """
         Helper function for loading models and tags. ALso sets the model for completer
-        :parameter results: model, labels, and character labels to be loaded
+        :parameter results: model, labels, character labels and prediction cache to be loaded
         """
-        model, labels, char_labels = results
+        model, labels, char_labels, cache, model_path = results
+        if model_path != self.model_input.text():
+            # a preloaded model finishing after another model was picked
+            if cache is not None:
+                cache.close()
+            return
+        if model is not None:
+            self.settings.setValue("model/last_path", model_path)
+        if self.main_widget.prediction_cache is not None:
+            self.main_widget.prediction_cache.close()
         self.main_widget.model = model
+        self.main_widget.model_path = model_path if model is not None else None
         self.main_widget.labels = labels
         self.main_widget.char_labels = char_labels
+        self.main_widget.prediction_cache = cache
         self.main_widget.t_completer.setModel(QStringListModel(self.main_widget.labels))  # update tag completer
 
-    def submit(self, directory: str, general_threshold: int, char_threshold: int) -> None:
+    def submit(self, directory: str, general_threshold: int, char_threshold: int, recursive: bool = False,
+               fast_decode: bool = False) -> None:
         """
-        Predicts tags for all images in the directory. Does not go into subdirectories.
+        Predicts tags for all images in the directory.
 
         :param char_threshold: limit to what to tag if prob > threshold then write that tag
         :param general_threshold: limit to what to tag if prob > threshold then write that tag
         :param directory: directory to target
+        :param recursive: also tag images in subdirectories
+        :param fast_decode: decode large images at a reduced size
         """
         if self.main_widget.model is None or directory is None or directory == '':
             print("No model found")
@@ -197,17 +323,24 @@ class ActionBox(QGroupBox):
             QMessageBox.warning(self, "Warning", "Model loaded successfully but no labels are found.")
             return
 
+        self.job_thresholds = (general_threshold, char_threshold)
+        self.submitted_sliders = (self.general_threshold.value(), self.character_threshold.value())
         score_threshold = general_threshold / 100
         char_threshold = char_threshold / 100
-        self.pd = QProgressDialog("Preprocessing Images...", None, 0, 100, self)
+        self.pd = QProgressDialog("Preprocessing Images...", "Cancel", 0, 100, self)
         self.pd.setWindowModality(QtCore.Qt.WindowModal)
-        self.pd.setCancelButton(None)
         self.pd.setWindowTitle("Please wait")
+        stats_label = QLabel()
+        stats_label.setWordWrap(True)  # room for the stats of _update_stats
+        self.pd.setLabel(stats_label)
         self.pd.setLabelText("Preprocessing Images...")
-        self.pd.setFixedSize(250, 150)
+        self.pd.setFixedSize(350, 220)
         self.pd.show()
         # self.pd.forceShow()  # use instead of above incase it does not show
 
+        # a job submitted again writes its results to the folder of the store being shown
+        self._set_store(None, score_threshold, char_threshold)
+
         # process images before predicting
         self.thread = QThread(self.main_widget)
         self.worker = PredictWorker(self.main_widget.model,
@@ -215,83 +348,265 @@ class ActionBox(QGroupBox):
                                     self.main_widget.labels,
                                     self.main_widget.char_labels,
                                     score_threshold,
-                                    char_threshold)
+                                    char_threshold,
+                                    batch_size=self.batch_size_spin.value() or None,
+                                    cache=self.main_widget.prediction_cache,
+                                    recursive=recursive,
+                                    fast_decode=fast_decode,
+                                    model_path=self.main_widget.model_path)
 
         self.worker.moveToThread(self.thread)
 
         self.thread.started.connect(self.worker.run)
         self.worker.max.connect(self._set_max)
         self.worker.progress.connect(self._update_progress)
+        self.worker.stats.connect(self._update_stats)
         self.worker.results.connect(self.process_results)
+        self.worker.cancelled.connect(self._cancelled)
+        self.worker.finished.connect(self._finish_results)
+        # the worker thread is busy predicting, cancel has to be delivered directly
+        self.pd.canceled.connect(self.worker.cancel, Qt.DirectConnection)
         self.worker.finished.connect(self.thread.quit)
         self.worker.finished.connect(self.pd.close)
         self.worker.finished.connect(self.worker.deleteLater)
         self.thread.finished.connect(self.thread.deleteLater)
 
-        # assign images to results
+        # results arrive in batches, start from an empty list
+        self.progress_value = 0
+        self.metrics = self.worker.metrics
+        self._set_store(self.worker.store, score_threshold, char_threshold)
+        self.job_running = True
 
         self.thread.start()
 
     def _set_max(self, maximum) -> None:
         """
         Helper function for setting the bar for progress dialog
-        @param maximum: how many steps to take
+        @param maximum: how many steps to take, 0 while the number of images is not known yet
         """
         self.pd.setLabelText("Predicting Tags")
         self.pd.setMaximum(maximum)
+        self.pd.setValue(self.progress_value)
 
     def _update_progress(self, val) -> None:
         """
         Helper function for setting the bar for progress dialog
         @param val: increment progress bar by this
         """
-        self.pd.setValue(self.pd.value() + val)
+        self.progress_value += val
+        self.pd.setValue(self.progress_value)
 
     def process_results(self, result_count):
         """
-        Processes results into the GUI and refreshes the page
-        :param result_count: results of predictions, and count of tags
+        Adds a batch of results to the GUI
+        :param result_count: images of the batch with tags within threshold, and count of tags so far
         """
         results, count = result_count
-        if len(results) == 0 or None:
-            QMessageBox.information(self, "No results", "No results within threshold")
 
-        self.main_widget.filelist.clear()
         # Populate filelist
-        for image in results:
-            file_path = image[0]
-            threshold_results, _, rating_results, char_results, text = image[1]
-            filename = os.path.basename(file_path)
-            pixmap = QPixmap(file_path).scaledToHeight(200, Qt.FastTransformation)
-            icon = QIcon(pixmap)
-            item = QListWidgetItem(icon, filename)
-            item.setData(FILE_PATH, file_path)
-            item.setData(GENERAL_RESULTS, threshold_results)
-            item.setData(CHARACTER_RESULTS, char_results)
-            item.setData(RATING, rating_results)
-            item.setData(TEXT, text)
-
-            # Build initial tag states
-            max_rating_key = max(rating_results, key=rating_results.get)
-            tag_state = {}
-
-            # Only check the content rating for threshold, check everything else
-            for key in rating_results.keys():
-                if key == max_rating_key:
-                    tag_state[key] = True
-                else:
-                    tag_state[key] = False
-
-            for key, value in char_results.items():
-                tag_state[key] = True
-
-            for key, value in threshold_results.items():
-                tag_state[key] = True
-
-            item.setData(TAG_STATE, tag_state)
-            self.main_widget.filelist.addItem(item)
-        self.main_widget.results = self.main_widget.filelist.model()  # set a pointer to listwidget's model
+        self._add_items(results)
         self.main_widget.tag_count = count
+
+    def _add_items(self, results) -> None:
+        """
+        Adds images to the filelist, rows read their results from the results store when they are shown
+        :param results: list of file paths, they have to be in the results store
+        """
+        index = self.store_results.store.index
+        self.main_widget.filelist.model().append([(file_path, index[file_path]) for file_path in results])
+
+    def _set_store(self, store, score_threshold, char_threshold) -> None:
+        """
+        Replaces the results the filelist shows, releasing the previous store
+        :param store: ResultsStore of the new results, None to only empty the filelist
+        :param score_threshold: general tags threshold the items are shown with
+        :param char_threshold: character tags threshold the items are shown with
+        """
+        self.main_widget.tag_count = {}
+        if self.main_widget.results_store is not None:
+            self.main_widget.results_store.release()
+        self.main_widget.results_store = store
+        self.store_results = StoreResults(store, score_threshold, char_threshold) if store is not None else None
+        self.main_widget.filelist.model().set_results(self.store_results)
+
+    def apply_thresholds(self, general_threshold: int, char_threshold: int) -> bool:
+        """
+        Filters the results of the last job again with new thresholds, the model is not used.
+        Images that now have tags are added to the filelist, images that lost them stay.
+        Tags added by hand and unchecked tags are kept.
+        :param general_threshold: limit to what to tag if prob > threshold then write that tag
+        :param char_threshold: limit to what to tag if prob > threshold then write that tag
+        :return: True if the results were updated
+        """
+        store = self.main_widget.results_store
+        if store is None or len(store) == 0 or self.job_running:
+            return False
+        if self.job_thresholds == (general_threshold, char_threshold):
+            return False
+        score_threshold = general_threshold / 100
+        char_threshold_value = char_threshold / 100
+
+        filelist = self.main_widget.filelist
+        model = filelist.model()
+
+        # rows read their tags and text with the new thresholds when they are shown, only the labels within
+        # threshold are selected here, as column numbers
+        self.store_results.set_thresholds(score_threshold, char_threshold_value)
+        tag_count = {"rating:safe": 0, "rating:questionable": 0, "rating:explicit": 0}
+        self.store_results.select(tag_count)
+        shown = np.zeros(len(store), dtype=bool)
+        shown[np.frombuffer(model.store_rows, dtype=np.int64)] = True
+        added = np.flatnonzero(self.store_results.tagged() & ~shown)
+        model.thresholds_changed()
+        model.append([(store.paths[row], row) for row in added.tolist()])
+
+        self.main_widget.tag_count = tag_count
+        self.job_thresholds = (general_threshold, char_threshold)
+        if filelist.currentItem() is not None:
+            self.main_widget.update_page()
+        elif filelist.count() > 0:
+            self.main_widget.results = filelist.model()
+            filelist.setCurrentRow(0)
+            self.main_widget.update_page()
+        return True
+
+    def open_results(self, directory=None) -> bool:
+        """
+        Shows the results store of an earlier job with the current thresholds, the model is not needed
+        :param directory: folder of the store, asks for it if not given
+        :return: True if the results were opened
+        """
+        if self.job_running:
+            return False
+        if directory is None:
+            directory = QFileDialog.getExistingDirectory(None, "Open Results", os.path.join(user_cache_dir(), "results"))
+            if not directory:
+                return False
+        try:
+            store = ResultsStore.open(directory)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error opening results {directory}: {e}")
+            QMessageBox.warning(self, "Warning", "No results found in this folder.")
+            return False
+
+        if not self.main_widget.labels:
+            # tags of the model the results were made with, so tags can be added without loading it
+            self.main_widget.labels = store.labels
+            self.main_widget.char_labels = store.char_labels
+            self.main_widget.t_completer.setModel(QStringListModel(store.labels))
+        general_threshold, char_threshold = self.general_threshold.value(), self.character_threshold.value()
+        self._set_store(store, general_threshold / 100, char_threshold / 100)
+        self.job_thresholds = None  # apply_thresholds fills the filelist
+        self.apply_thresholds(general_threshold, char_threshold)
+        if self.main_widget.filelist.count() == 0:
+            QMessageBox.information(self, "No results", "No results within threshold")
+        return True
+
+    def _update_stats(self, summary) -> None:
+        """
+        Shows throughput, stage timings and memory use under the progress bar
+        @param summary: see PipelineMetrics.summary
+        """
+        self.pd.setLabelText("Predicting Tags\n" + summary)
+
+    def save_report(self) -> bool:
+        """
+        Saves the metrics of the last job
+        :return: True if a report was written
+        """
+        if self.metrics is None:
+            QMessageBox.information(self, "No report", "Submit a folder first")
+            return False
+        path, _ = QFileDialog.getSaveFileName(self, "Save Report", "report.json", "JSON (*.json);;CSV (*.csv)")
+        if not path:
+            return False
+        try:
+            self.metrics.save(path)
+        except OSError as e:
+            print(f"Error writing report {path}: {e}")
+            return False
+        return True
+
+    def export_results(self, path=None, export_format=None) -> bool:
+        """
+        Exports the images in the filelist with the tags they show, on a worker thread
+        :param path: output file, asks for it if neither it nor a sidecar format is given
+        :param export_format: see EXPORT_FORMATS, defaults to the one picked in the dialog
+        :return: True if the export started
+        """
+        store = self.main_widget.results_store
+        model = self.main_widget.filelist.model()
+        if store is None or model.rowCount() == 0 or self.job_running:
+            QMessageBox.information(self, "No results", "Submit a folder first")
+            return False
+        if path is None and export_format is None:
+            filters = {"JSON Lines (*.jsonl)": "jsonl", "CSV (*.csv)": "csv", "SQLite (*.sqlite3)": "sqlite",
+                       "Text file next to each image (*.txt)": "txt", "JSON file next to each image (*.json)": "json"}
+            path, selected = QFileDialog.getSaveFileName(self, "Export", "tags.jsonl", ";;".join(filters))
+            if not path:
+                return False
+            export_format = filters[selected]
+        export_format = export_format or format_for(path)
+
+        texts = {file_path: model.text(row) for row, file_path in enumerate(model.paths)}
+        self.export_pd = QProgressDialog("Exporting...", None, 0, 0, self)
+        self.export_pd.setWindowModality(QtCore.Qt.WindowModal)
+        self.export_pd.setWindowTitle("Please wait")
+        self.export_pd.show()
+
+        self.export_thread = QThread(self.main_widget)
+        self.export_worker = ExportWorker(store, texts, export_format, path, self.store_results.score_threshold,
+                                          self.store_results.char_threshold)
+        self.export_worker.moveToThread(self.export_thread)
+
+        self.export_thread.started.connect(self.export_worker.run)
+        self.export_worker.finished.connect(self._finish_export)
+        self.export_worker.finished.connect(self.export_thread.quit)
+        self.export_worker.finished.connect(self.export_pd.close)
+        self.export_worker.finished.connect(self.export_worker.deleteLater)
+        self.export_thread.finished.connect(self.export_thread.deleteLater)
+
+        self.export_thread.start()
+        return True
+
+    def _finish_export(self, count, error) -> None:
+        """
+        :param count: number of images exported
+        :param error: why the export failed, empty if it did not
+        """
+        if error:
+            QMessageBox.warning(self, "Warning", f"Export failed: {error}")
+        else:
+            print(f"Exported {count} results")
+
+    def _cancelled(self, resumable) -> None:
+        """
+        Tells the user how to continue a cancelled job
+        :param resumable: progress was checkpointed
+        """
+        if resumable:
+            QMessageBox.information(self, "Cancelled",
+                                    "Tagging stopped. Submit the same folder again to continue where it left off.")
+
+    def _finish_results(self, error="") -> None:
+        """
+        Refreshes the page once all batches have been added
+        :param error: why the job stopped early, empty if it did not
+        """
+        self.job_running = False
+        if error:
+            self.pd.close()
+            QMessageBox.warning(self, "Warning", f"Tagging stopped: {error}")
+        # sliders may have moved while the job was running
+        sliders = (self.general_threshold.value(), self.character_threshold.value())
+        if sliders != self.submitted_sliders and self.apply_thresholds(*sliders):
+            return
+        if self.main_widget.filelist.count() == 0:
+            if not error:
+                QMessageBox.information(self, "No results", "No results within threshold")
+            return
+
+        self.main_widget.results = self.main_widget.filelist.model()  # set a pointer to listwidget's model
         self.main_widget.filelist.setCurrentRow(0)
         self.main_widget.update_page()
 
@@ -314,37 +629,178 @@ class ActionBox(QGroupBox):
 
     def tag_selected_images(self):
         """
-        Write tags to image's exif for all selected images
-        :return: True if successful, False if labels or model is missing
+        Write tags to image's exif for all selected images, the files are written on a thread pool
+        while a progress dialog shows how far it got
+        :return: True if writing started, False if labels or model is missing or nothing is selected
         """
         if not self.main_widget.model:
             return False
         if not self.main_widget.labels:
             return False
 
-        selected_rows = self.main_widget.filelist.getCheckedRows()
-        for row in selected_rows:
-            item = self.filelist.item(row)
-            info = item.data(TEXT)
-            image_path = item.data(FILE_PATH)
-            write_tags(image_path, info)
+        model = self.main_widget.filelist.model()
+        items = [(model.paths[row], model.text(row)) for row in self.main_widget.filelist.getCheckedRows()]
+        if not items:
+            return False
+
+        self.exif_pd = QProgressDialog("Writing Tags...", "Cancel", 0, len(items), self)
+        self.exif_pd.setWindowModality(QtCore.Qt.WindowModal)
+        self.exif_pd.setWindowTitle("Please wait")
+        self.exif_pd.show()
+
+        self.exif_thread = QThread(self.main_widget)
+        self.exif_worker = ExifWorker(items)
+        self.exif_worker.moveToThread(self.exif_thread)
+
+        self.exif_thread.started.connect(self.exif_worker.run)
+        self.exif_worker.progress.connect(lambda done: self.exif_pd.setValue(done))
+        self.exif_worker.failed.connect(lambda path, error: print(f"Error writing tags to {path}: {error}"))
+        self.exif_worker.finished.connect(self._finish_tagging)
+        # the worker thread is busy writing, cancel has to be delivered directly
+        self.exif_pd.canceled.connect(self.exif_worker.cancel, Qt.DirectConnection)
+        self.exif_worker.finished.connect(self.exif_thread.quit)
+        self.exif_worker.finished.connect(self.exif_pd.close)
+        self.exif_worker.finished.connect(self.exif_worker.deleteLater)
+        self.exif_thread.finished.connect(self.exif_thread.deleteLater)
+
+        self.exif_thread.start()
+        return True
+
+    def _finish_tagging(self, failures) -> None:
+        """
+        Lists the images whose tags could not be written
+        :param failures: (file path, error) of each failed image
+        """
+        if not failures:
+            return
+        shown = "\n".join(f"{os.path.basename(path)}: {error}" for path, error in failures[:10])
+        more = f"\n... and {len(failures) - 10} more" if len(failures) > 10 else ""
+        QMessageBox.warning(self, "Warning", f"Tags could not be written to {len(failures)} images\n{shown}{more}")
 
 
 class ModelWorker(QObject):
     """
-     Worker Object for qthreading, loads models and tags from directory
+     Worker Object for qthreading, loads models and tags from directory.
+     The model is read from its converted copy in the ModelCache and run once so the first batch starts right away.
+     With a tflite backend it is quantised, tflite-int8 is calibrated on images of calibration_dir,
+     the agreement of its tags with the float model is printed
     """
     finished = pyqtSignal(tuple)
 
-    def __init__(self, directory_path):
+    def __init__(self, directory_path, backend="keras", calibration_dir=None, agreement_images=16):
         super().__init__()
         self.directory_path = directory_path
+        self.backend = backend
+        self.calibration_dir = calibration_dir
+        self.agreement_images = agreement_images
 
     def run(self):
-        model = load_model(self.directory_path)
+        try:
+            model_cache = ModelCache()
+        except OSError as e:
+            print("Model cache disabled:", e)
+            model_cache = None
+        model = load_model(self.directory_path, model_cache)
+        if model is not None and self.backend != "keras":
+            model = self.convert(model, model_cache)
+        if model is not None:
+            warm_up(model)
         labels = load_labels(self.directory_path)
         char_labels = load_char_labels(self.directory_path)
-        self.finished.emit((model, labels, char_labels))
+        cache = None
+        if model is not None:
+            try:
+                cache = PredictionCache(self.directory_path, variant=model_variant(model))
+            except (sqlite3.Error, OSError) as e:
+                print("Prediction cache disabled:", e)
+        self.finished.emit((model, labels, char_labels, cache, self.directory_path))
+
+    def convert(self, model, model_cache):
+        """
+        :return: the model behind the chosen backend, the float model if it can not be converted
+        """
+        backend = self.backend
+        image_paths = []
+        if self.calibration_dir and os.path.isdir(self.calibration_dir):
+            image_paths = list_images(self.calibration_dir)
+        if backend == "tflite-int8" and not image_paths:
+            print("No images to calibrate tflite-int8 on, select the folder first. Using tflite")
+            backend = "tflite"
+        # int8 ranges are measured on more images than the agreement is checked on
+        count = 100 if backend == "tflite-int8" else self.agreement_images
+        model_file = os.path.join(self.directory_path, PredictionCache.model_file)
+        try:
+            converted, calibration = load_backend(model, backend, image_paths, count, model_cache, model_file)
+        except (ValueError, RuntimeError, OSError) as e:
+            print("Conversion failed, using the float model:", e)
+            return model
+        if calibration:
+            print(format_agreement(compare_backends(model, converted, calibration[:self.agreement_images])))
+        return converted
+
+
+class ExifWorker(QObject):
+    """
+    Worker Object for qthreading, writes tags to the exif of many images, see write_tags_all
+    """
+    finished = pyqtSignal(list)
+    progress = pyqtSignal(int)
+    failed = pyqtSignal(str, str)
+
+    def __init__(self, items, workers=None):
+        super().__init__()
+        self.items = items
+        self.workers = workers
+        self.written = 0
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        """ Stops after the writes in progress, called from the GUI thread"""
+        self._cancel.set()
+
+    def run(self):
+        failures = []
+        try:
+            failures = write_tags_all(self.items, self.workers, self._written, self._cancel)
+        except Exception as e:
+            print("Error writing tags:", e)
+            failures.append(("writing stopped", str(e) or type(e).__name__))
+        finally:
+            # the progress dialog only closes on finished
+            self.finished.emit(failures)
+
+    def _written(self, image_path, error):
+        self.written += 1
+        self.progress.emit(self.written)
+        if error is not None:
+            self.failed.emit(image_path, error)
+
+
+class ExportWorker(QObject):
+    """
+    Worker Object for qthreading, exports a results store, see export_store
+    """
+    finished = pyqtSignal(int, str)
+
+    def __init__(self, store, texts, export_format, path, score, char, precision=4):
+        super().__init__()
+        self.store = store
+        self.texts = texts
+        self.export_format = export_format
+        self.path = path
+        self.score_threshold = score
+        self.char_threshold = char
+        self.precision = precision
+
+    def run(self):
+        try:
+            with open_exporter(self.export_format, self.path, self.precision) as exporter:
+                count = export_store(self.store, exporter, self.score_threshold, self.char_threshold, self.texts)
+        except (OSError, ValueError, sqlite3.Error) as e:
+            print(f"Error exporting to {self.path}: {e}")
+            self.finished.emit(0, str(e))
+            return
+        self.finished.emit(count, "")
 
 
 class ImageWorker(QObject):
@@ -373,9 +829,10 @@ class ImageWorker(QObject):
         self.max.emit(val * 2)
         self.progress.emit(val)
 
+        postprocessor = TagPostProcessor(self.labels, self.char_labels)
         for image in images:
             result = predict(self.model, self.labels, self.char_labels, image[1], self.score_threshold,
-                             self.char_threshold)
+                             self.char_threshold, postprocessor)
             if result is not None:
                 self.processed_images.append((image[0], result))
             self.progress.emit(1)
@@ -387,15 +844,22 @@ class ImageWorker(QObject):
 class PredictWorker(QObject):
     """
     Worker Object for qthreading, calls predicts all.
-    Faster implementation of ImageWorker, uses significantly more computing power
+    Faster implementation of ImageWorker, uses significantly more computing power.
+    Images are streamed through the model in batches so memory use does not grow with the size of the folder,
+    results are emitted after every batch.
+    Runs as a TaggingJob, it can be cancelled between batches and resumes from its checkpoints when
+    the same folder is submitted again with the same model.
     Tensorflow: GPU not supported on Windows unless used with WSL
     """
-    finished = pyqtSignal()
+    finished = pyqtSignal(str)  # why the job stopped early, empty if it did not
+    cancelled = pyqtSignal(bool)
     max = pyqtSignal(int)
     results = pyqtSignal(tuple)
     progress = pyqtSignal(int)
+    stats = pyqtSignal(str)
 
-    def __init__(self, model, directory, labels, char_labels, score, char):
+    def __init__(self, model, directory, labels, char_labels, score, char, batch_size=None, queue_depth=4,
+                 cache=None, recursive=False, backend="thread", workers=None, fast_decode=False, model_path=None):
         super().__init__()
         self.model = model
         self.directory = directory
@@ -403,16 +867,49 @@ class PredictWorker(QObject):
         self.char_labels = char_labels
         self.score_threshold = score
         self.char_threshold = char
-        self.processed_images = []
+        self.batch_size = batch_size  # tuned when the worker runs if None
+        self.queue_depth = queue_depth
+        self.model_path = model_path
+        self.cache = cache
+        self.recursive = recursive
+        self.backend = backend
+        self.workers = workers
+        variant = model_variant(model)
+        self.job = TaggingJob(directory, model_path, recursive, fast_decode, variant=variant)
+        self.metrics = PipelineMetrics()
+        # kept on disk next to the prediction cache so the run can be opened again, in memory without a model path
+        info = {"directory": os.path.abspath(directory), "model": model_path, "recursive": recursive,
+                "fast_decode": fast_decode, "variant": variant}
+        self.store = None
+        if model_path is not None:
+            store_path = results_dir(directory, job_id(directory, model_path, recursive, fast_decode, variant))
+            try:
+                self.store = ResultsStore(store_path, labels=labels, char_labels=char_labels, info=info)
+            except OSError as e:
+                print("Results not kept on disk:", e)
+        if self.store is None:
+            self.store = ResultsStore(labels=labels, char_labels=char_labels, info=info)
 
-    def run(self):
-        images = process_images_from_directory(self.model, self.directory)
-        val = len(images)
-        self.max.emit(val * 3)
-        self.progress.emit(val)
+    def cancel(self):
+        """ Stops after the current batch, called from the GUI thread"""
+        self.job.cancel()
 
-        filenames, arrays = zip(*images)
-        arrays = np.array(arrays)
+    def run(self):
+        error = ""
+        try:
+            self.predict()
+        except Exception as e:
+            print("Error tagging images:", e)
+            error = str(e) or type(e).__name__
+        finally:
+            # rows written so far stay readable, the progress dialog only closes on finished
+            self.store.close()
+            self.finished.emit(error)
+
+    def predict(self):
+        """ Streams the images through the model, emitting the results of every batch"""
+        self.max.emit(0)  # busy until the folder has been scanned
+        image_paths = self.scan()
 
         # Stop TF from hogging all the VRAM, GPU not supported on windows
         gpus = tf.config.experimental.list_physical_devices("GPU")
@@ -423,54 +920,54 @@ class PredictWorker(QObject):
             except RuntimeError as e:
                 print(e)
 
-        probs = self.model.predict(arrays, batch_size=20, use_multiprocessing=True)
-        probs = probs.astype(float)
-        self.progress.emit(val)
-        tag_count = {"rating:safe": 0, "rating:questionable": 0, "rating:explicit": 0}
+        if self.batch_size is None:
+            self.stats.emit("Tuning batch size...")
+            self.batch_size = self.tune_batch_size()
 
-        # Match labels with predictions
-        for filename, probs in zip(filenames, probs):
-            # Extract the last three tags as ratings
-            rating_labels = ["rating:safe", "rating:questionable", "rating:explicit"]
-            rating_probs = probs[-3:]
-            probs = probs[:-3]
-            # get the highest rating
-            result_rating = OrderedDict(zip(rating_labels, rating_probs))
-            max_index = max(result_rating, key=result_rating.get)
-            tag_count[max_index] = tag_count[max_index] + 1
-
-            # Get the indices of labels sorted by probability in descending order
-            indices = np.argsort(probs)[::-1]
-
-            result_all = OrderedDict()
-            result_all[max_index] = result_rating[max_index]
-            result_threshold = OrderedDict()
-            result_char = OrderedDict()
-
-            # Iterate over the sorted indices
-            for index in indices:
-                label = self.labels[index]
-                prob = probs[index]
-
-                # Store result for all labels
-                result_all[label] = prob
-                tag_count[label] = tag_count.get(label, 0) + 1
-
-                # If probability is below the threshold, stop adding to threshold results, cannot assume char > general
-                if prob < self.score_threshold and prob < self.char_threshold:
-                    break
-
-                # Store result for labels above the threshold
-                if prob > self.score_threshold and label not in self.char_labels:
-                    result_threshold[label] = prob
-                if prob > self.char_threshold and label in self.char_labels:
-                    result_char[label] = prob
-
-            result_text = ', '.join(result_all.keys())
-            self.progress.emit(val)
-            if len(result_threshold) > 0 or len(result_char) > 0:
-                self.processed_images.append(
-                    (filename, (result_threshold, result_all, result_rating, result_char, result_text)))
-
-        self.results.emit((self.processed_images, tag_count))
-        self.finished.emit()
+        tag_count = {"rating:safe": 0, "rating:questionable": 0, "rating:explicit": 0}
+        postprocessor = TagPostProcessor(self.labels, self.char_labels)
+        predictions = self.job.run(self.model, image_paths, self.batch_size, self.queue_depth, self.workers,
+                                   cache=self.cache, backend=self.backend, metrics=self.metrics)
+        for filenames, probs in predictions:
+            self.store.append(filenames, probs)
+            with self.metrics.stage("postprocess", len(filenames)):
+                # the filelist reads the results of its rows from the store, only which images have tags is needed
+                _, _, tagged, _ = postprocessor.select(probs, self.score_threshold, self.char_threshold, tag_count)
+                tagged_images = [filename for filename, has in zip(filenames, tagged.tolist()) if has]
+
+            self.results.emit((tagged_images, dict(tag_count)))
+            self.progress.emit(len(filenames))
+            self.stats.emit(self.metrics.summary())
+        self.metrics.finish()
+
+        if self.job.restored:
+            print(f"Resumed job, {self.job.restored} images restored from checkpoints")
+        if self.cache is not None:
+            print("Prediction cache:", self.cache.stats())
+        if self.job.cancelled:
+            self.cancelled.emit(bool(self.job.checkpoints))
+
+    def tune_batch_size(self) -> int:
+        """
+        :return: fastest batch size for the model on this machine, probed once then remembered per model file
+        """
+        model_file = None
+        if self.model_path is not None:
+            model_file = os.path.join(self.model_path, PredictionCache.model_file)
+        try:
+            cache = BatchSizeCache()
+        except OSError as e:
+            print("Batch size cache disabled:", e)
+            cache = None
+        return tuned_batch_size(self.model, model_file, queue_depth=self.queue_depth, cache=cache)
+
+    def scan(self):
+        """
+        Yields the images of the directory, emits max once they have all been found.
+        Prediction starts on the first images while the rest of the folder is still being scanned.
+        """
+        count = 0
+        for entry in scan_images(self.directory, recursive=self.recursive):
+            count += 1
+            yield entry.path
+        self.max.emit(count)
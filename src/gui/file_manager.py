@@ -1,13 +1,15 @@
 import os
 import shutil
 
-from PyQt5.QtCore import Qt, QSize, QSortFilterProxyModel, QRegularExpression, QUrl
+from PyQt5.QtCore import Qt, QSize, QSortFilterProxyModel, QUrl
 from PyQt5.QtGui import QDesktopServices
 from PyQt5.QtWidgets import QApplication, QWidget, QHBoxLayout, QVBoxLayout, QStyleFactory, QPushButton, QLineEdit, \
     QCompleter, QListWidget, QAbstractItemView, QListView, QStyledItemDelegate, QTextEdit, QGridLayout, QFileDialog, \
     QGroupBox
 
+from src.commands.tag_index import TagIndex
 from src.gui.dark_palette import create_dark_palette
+from src.gui.results_model import THUMBNAIL
 
 FILE_PATH = Qt.UserRole
 RATING = Qt.UserRole + 1
@@ -24,7 +26,9 @@ class FileManager(QWidget):
 
         self.searchbar = QLineEdit()
         self.tag_list = QListWidget()
-        self.proxy_model = QSortFilterProxyModel()
+        self.proxy_model = TagFilterProxyModel()
+        self.tag_index = TagIndex()  # tags of each row of the tagger's filelist, kept up to date by its signals
+        self.filter_tags = None  # tags the gallery is filtered by, None shows every image
         self.search_completer = MultiCompleter()
 
         self.file_name = QLineEdit()
@@ -92,6 +96,8 @@ class FileManager(QWidget):
         self.image_gallery.setSelectionMode(QAbstractItemView.ExtendedSelection)  # ctrl and shift click selection
         self.image_gallery.setIconSize(QSize(400, 200))
         self.image_gallery.setResizeMode(QListWidget.Adjust)  # Reorganize thumbnails on resize
+        # cells are sized from the first row, measuring every row would ask for every thumbnail
+        self.image_gallery.setUniformItemSizes(True)
         self.image_gallery.clicked.connect(self.display_info)
         self.image_gallery.doubleClicked.connect(self.open_image)
 
@@ -167,20 +173,14 @@ class FileManager(QWidget):
     def search_tags(self, text: str):
         """
         Alternative to clicking tags, Searches for tags based on text.
-        Filtering is based on the text output section of the tagger.
+        Filtering is based on the text output section of the tagger, images need every tag, whole tags only.
         This is accessed by the TEXT user role ie: item.data(TEXT)
         :parameter text: string of tags to filter by
         """
-
-        if text == "":
+        tags = [tag.strip() for tag in text.split(',') if tag.strip()]
+        if not tags:
             return
-        tags = [tag.strip() for tag in text.split(',')]
-        regex_pattern = "(?=.*{})".format(")(?=.*".join(tags))  # Regex for selecting things with all tags
-        # Create QRegularExpression object
-        regex = QRegularExpression(regex_pattern, QRegularExpression.CaseInsensitiveOption)
-
-        self.proxy_model.setFilterRole(TEXT)  # Filter by TEXT role, each item comes with a string of all checked tags
-        self.proxy_model.setFilterRegularExpression(regex)  # Apply filter
+        self.set_filter(tags)
 
     def filter_images(self):
         """
@@ -194,24 +194,65 @@ class FileManager(QWidget):
             item.text().split("   ", 1)[1].strip()
             for item in self.tag_list.selectedItems()
         ]
-        regex_pattern = "(?=.*{})".format(")(?=.*".join(selected_tags))  # Regex for selecting things with all tags
-
-        # Create QRegularExpression object
-        regex = QRegularExpression(regex_pattern, QRegularExpression.CaseInsensitiveOption)
-
-        self.proxy_model.setFilterRole(TEXT)  # Filter by TEXT role, each item comes with a string of all checked tags
-        self.proxy_model.setFilterRegularExpression(regex)  # Apply filter
+        self.set_filter(selected_tags or None)
 
     def clear_filter(self):
         """
         clears filters
         """
         self.tag_list.clearSelection()
-        # Create QRegularExpression object
-        regex = QRegularExpression('', QRegularExpression.CaseInsensitiveOption)
+        self.set_filter(None)
 
-        self.proxy_model.setFilterRole(TEXT)  # Filter by TEXT role, each item comes with a string of all checked tags
-        self.proxy_model.setFilterRegularExpression(regex)  # Apply filter
+    def set_filter(self, tags):
+        """
+        Shows the images that have all the tags, the rows come from the tag index so no text is searched
+        :param tags: list of tags, None shows every image
+        """
+        self.filter_tags = tags
+        self.proxy_model.set_accepted(None if tags is None else self.tag_index.match(tags))
+
+    def _index_rows(self, first, last):
+        """
+        Reads the tags of source rows into the tag index and the rows the filter accepts.
+        The tags come from the ResultsModel as numbers, only the rows edited by hand are read one at a time
+        """
+        model = self.proxy_model.sourceModel()
+        self.tag_index.set_ids(first, *model.tag_ids(first, last))
+        for row in sorted(model.edits):
+            if first <= row <= last:
+                self.tag_index.set_row(row, model.tags(row))
+        accepted = self.proxy_model.accepted
+        if accepted is not None:
+            accepted[first:last + 1] = self.tag_index.match(self.filter_tags)[first:last + 1].tobytes()
+
+    def _rebuild_index(self):
+        self.tag_index.clear()
+        model = self.proxy_model.sourceModel()
+        rows = model.rowCount() if model is not None else 0
+        self.tag_index.insert_rows(0, rows)
+        if rows:
+            self._index_rows(0, rows - 1)
+        self.set_filter(self.filter_tags)
+
+    def _rows_inserted(self, parent, first, last):
+        self.tag_index.insert_rows(first, last - first + 1)
+        if self.proxy_model.accepted is not None:
+            self.proxy_model.accepted[first:first] = bytes(last - first + 1)
+        self._index_rows(first, last)
+
+    def _rows_removed(self, parent, first, last):
+        self.tag_index.remove_rows(first, last - first + 1)
+        if self.proxy_model.accepted is not None:
+            del self.proxy_model.accepted[first:last + 1]
+
+    def _data_changed(self, top_left, bottom_right, roles=()):
+        if roles and TEXT not in roles:
+            return
+        if top_left.row() == 0 and bottom_right.row() == len(self.tag_index) - 1:
+            # thresholds changed, building the index again is quicker than replacing the tags of each row
+            self._rebuild_index()
+            return
+        self._index_rows(top_left.row(), bottom_right.row())
 
     def display_info(self, item):
         """
@@ -255,7 +296,16 @@ class FileManager(QWidget):
     def load_tagger_info(self):
         """ Reloads changes from tagger, loads images and tags."""
 
-        self.proxy_model.setSourceModel(self.tagger.results)
+        model = self.tagger.results
+        if model is not self.proxy_model.sourceModel():
+            # connected before the proxy model connects itself, so the index is current when the proxy filters rows
+            model.rowsInserted.connect(self._rows_inserted)
+            model.rowsRemoved.connect(self._rows_removed)
+            model.dataChanged.connect(self._data_changed)
+            model.modelReset.connect(self._rebuild_index)
+            model.layoutChanged.connect(self._rebuild_index)
+            self.proxy_model.setSourceModel(model)
+            self._rebuild_index()
         self.search_completer = MultiCompleter(self.tagger.tag_count.keys())
         self.searchbar.setCompleter(self.search_completer)
 
@@ -297,6 +347,26 @@ class FileManager(QWidget):
             print(e)
 
 
+class TagFilterProxyModel(QSortFilterProxyModel):
+    """
+    Filters source rows by a precomputed row set instead of matching text
+    accepted has one byte per source row, FileManager keeps it in line with the source model
+    """
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.accepted = None  # bytearray, None accepts every row
+
+    def set_accepted(self, accepted):
+        """
+        :param accepted: bool array with one entry per source row, None accepts every row
+        """
+        self.accepted = None if accepted is None else bytearray(accepted.astype(bool).tobytes())
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        return self.accepted is None or (source_row < len(self.accepted) and bool(self.accepted[source_row]))
+
+
 class MultiCompleter(QCompleter):
     """ Multi Tag completer, allows for comma separated tag searching"""
 
@@ -326,6 +396,11 @@ class ThumbnailDelegate(QStyledItemDelegate):
 
     def initStyleOption(self, option, index):
         super().initStyleOption(option, index)
+        # thumbnails are only loaded for the rows the gallery paints
+        icon = index.data(THUMBNAIL)
+        if icon is not None:
+            option.icon = icon
+            option.features |= option.HasDecoration
         # remove checkbox and name area
         if not self.displayRoleEnabled:
             option.features &= ~option.HasDisplay
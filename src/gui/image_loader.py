@@ -0,0 +1,97 @@
+from collections import OrderedDict
+
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+from PyQt5.QtGui import QImage, QPixmap
+
+from src.gui.thumbnails import read_scaled
+
+
+class _Signals(QObject):
+    loaded = pyqtSignal(object, QImage)
+
+
+class _ImageTask(QRunnable):
+    def __init__(self, key, signals):
+        super().__init__()
+        self.setAutoDelete(False)  # the loader keeps it until it is done or taken back
+        self.key = key
+        self.signals = signals
+
+    def run(self):
+        path, width, height = self.key
+        self.signals.loaded.emit(self.key, read_scaled(path, width, height))
+
+
+class ImageLoader(QObject):
+    """
+    Decodes the images shown by the viewer on worker threads, at the size they are shown at.
+    pixmap() returns an image that is ready, load() queues the image being shown and the ones next to it
+    and ready is emitted once an image is decoded. Images are keyed on path and size, a resized viewer decodes again.
+    :param cache_size: number of decoded images to keep
+    :param threads: decoding threads
+    """
+    ready = pyqtSignal(str)
+
+    def __init__(self, cache_size=16, threads=2, parent=None):
+        super().__init__(parent)
+        self.cache_size = cache_size
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(threads)
+        self._pixmaps = OrderedDict()  # (path, width, height) -> QPixmap, least recently used first
+        self._pending = {}  # (path, width, height) -> _ImageTask
+        self._signals = _Signals(self)
+        self._signals.loaded.connect(self._loaded)
+
+    def pixmap(self, path, width, height):
+        """
+        :param path: image file name
+        :param width: width of the viewer
+        :param height: height of the viewer
+        :return: image scaled to fit the viewer if it is ready, None otherwise
+        """
+        pixmap = self._pixmaps.get((path, width, height))
+        if pixmap is not None:
+            self._pixmaps.move_to_end((path, width, height))
+        return pixmap
+
+    def load(self, paths, width, height):
+        """
+        Queues images in order of priority, queued images not in paths are dropped, they were
+        prefetched for a row that was skipped over
+        :param paths: image being shown then the images to prefetch, nearest first
+        :param width: width of the viewer
+        :param height: height of the viewer
+        """
+        keys = [(path, width, height) for path in paths]
+        wanted = set(keys)
+        for key, task in list(self._pending.items()):
+            if key not in wanted and self.pool.tryTake(task):
+                del self._pending[key]
+        for priority, key in enumerate(reversed(keys)):
+            if key in self._pixmaps:
+                self._pixmaps.move_to_end(key)  # keep what is about to be shown
+            elif key not in self._pending:
+                task = _ImageTask(key, self._signals)
+                self._pending[key] = task
+                self.pool.start(task, priority)
+
+    def clear(self):
+        """ Drops queued and decoded images"""
+        for task in list(self._pending.values()):
+            self.pool.tryTake(task)
+        self._pending.clear()
+        self._pixmaps.clear()
+
+    def close(self):
+        """ Waits for the threads"""
+        self.clear()
+        self.pool.waitForDone()
+
+    def _loaded(self, key, image):
+        if self._pending.pop(key, None) is None:
+            return  # cleared while it was decoding
+        # QPixmap can only be made on the GUI thread
+        self._pixmaps[key] = QPixmap.fromImage(image)
+        if len(self._pixmaps) > self.cache_size:
+            self._pixmaps.popitem(last=False)
+        self.ready.emit(key[0])
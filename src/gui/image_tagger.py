@@ -1,12 +1,13 @@
-from PyQt5.QtCore import Qt, QEvent, QSize
+from PyQt5.QtCore import Qt, QEvent
 from PyQt5.QtGui import QPixmap, QFont
 from PyQt5.QtWidgets import QApplication, QWidget, QHBoxLayout, QVBoxLayout, QLabel, QPushButton, QGridLayout, \
     QTextEdit, QSizePolicy, QStyleFactory, QCompleter, QLineEdit
 
-from src.gui.CheckListWidget import CheckListWidget
 from src.gui.TupleCheckListWidget import TupleCheckListWidget
 from src.gui.action_box import ActionBox
 from src.gui.dark_palette import create_dark_palette
+from src.gui.image_loader import ImageLoader
+from src.gui.results_model import ResultsList
 
 FILE_PATH = Qt.UserRole
 RATING = Qt.UserRole + 1
@@ -22,8 +23,14 @@ class ImageTagger(QWidget):
         self.labels = []
         self.char_labels = []
         self.model = None
+        self.model_path = None
+        self.prediction_cache = None
         self.results = None
+        self.results_store = None  # raw predictions of the last job, see ActionBox.apply_thresholds
         self.tag_count = {}
+        self.prefetch = 3  # rows decoded ahead in the direction the list is browsed
+        self._shown_row = -1
+        self._direction = 1
 
         # QWigdets
         self.image_label = None
@@ -38,6 +45,9 @@ class ImageTagger(QWidget):
         self.t_completer = None
         self.t_lineedit = None
 
+        self.image_loader = ImageLoader(cache_size=4 * self.prefetch + 4, parent=self)
+        self.image_loader.ready.connect(self.image_ready)
+
         self.initUI()
 
     def initUI(self):
@@ -65,11 +75,10 @@ class ImageTagger(QWidget):
         frame3.setLayout(QVBoxLayout())
 
         # Frame 1
-        self.filelist = CheckListWidget()
-        self.filelist.setIconSize(QSize(0, 0))
+        self.filelist = ResultsList()  # its model is shared with the file manager
         select_all = QPushButton("Select All")
         deselect_all = QPushButton("Deselect All")
-        self.filelist.itemClicked.connect(self.update_page)  # on click change image
+        self.filelist.clicked.connect(self.update_page)  # on click change image
 
         select_all.clicked.connect(self.select_all_files)
         deselect_all.clicked.connect(self.clear_all_files)
@@ -195,22 +204,42 @@ class ImageTagger(QWidget):
         self.text_output.setText(text)
 
     def update_image(self):
-        """ Changes the display image"""
-        try:
-            image_path = self.filelist.currentItem().data(FILE_PATH)
-            pixmap = QPixmap(image_path)
-            width = self.image_label_widget.width()
-            height = self.image_label_widget.height()
-
-            # scale down image if it's bigger than the container
-            if pixmap.width() > width or pixmap.height() > height:
-                self.image_label.setPixmap(
-                    pixmap.scaled(width, height, Qt.AspectRatioMode.KeepAspectRatio, Qt.FastTransformation))
-            else:
+        """
+        Changes the display image, images are decoded at the size of the viewer on worker threads.
+        The next rows in the direction the list is browsed and the previous row are decoded ahead,
+        the thumbnail is shown until the image is ready
+        """
+        row = self.filelist.currentRow()
+        if row < 0:
+            return
+        if row != self._shown_row:
+            self._direction = 1 if row > self._shown_row else -1
+            self._shown_row = row
+        paths = self.filelist.model().paths
+        width = max(1, self.image_label_widget.width())
+        height = max(1, self.image_label_widget.height())
+
+        ahead = [row + self._direction * step for step in range(1, self.prefetch + 1)]
+        rows = [row] + ahead + [row - self._direction]
+        self.image_loader.load([paths[r] for r in rows if 0 <= r < len(paths)], width, height)
+
+        pixmap = self.image_loader.pixmap(paths[row], width, height)
+        if pixmap is None:
+            thumbnail = self.filelist.model().thumbnails.pixmap(paths[row])
+            if thumbnail is None:
+                self.image_label.clear()
+                return
+            pixmap = thumbnail.scaled(width, height, Qt.AspectRatioMode.KeepAspectRatio, Qt.FastTransformation)
+        self.image_label.setPixmap(pixmap)
+
+    def image_ready(self, path):
+        """ Shows an image decoded by the image loader if it is still the current one"""
+        row = self.filelist.currentRow()
+        if 0 <= row < self.filelist.count() and self.filelist.model().paths[row] == path:
+            pixmap = self.image_loader.pixmap(path, max(1, self.image_label_widget.width()),
+                                              max(1, self.image_label_widget.height()))
+            if pixmap is not None:
                 self.image_label.setPixmap(pixmap)
-            self.image_label_layout.addWidget(self.image_label)
-        except Exception as e:
-            print(e)
 
     def update_tags(self, checklist, tags, tag_state):
         """ Refreshes the tags in the given checklist"""
@@ -33,3 +33,10 @@ class MainWindow(QMainWindow):
         # Add tabs to the QTabWidget
         self.tab_widget.addTab(self.tab1, "Main")
         self.tab_widget.addTab(self.tab2, "File Manager")
+
+    def closeEvent(self, event):
+        # let thumbnails being decoded finish and write the cache out
+        self.tab1.filelist.model().thumbnails.close()
+        self.tab1.image_loader.close()
+        self.tab1.action_box.wait_for_preload()
+        super().closeEvent(event)
@@ -0,0 +1,458 @@
+import os
+import sqlite3
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+
+import numpy as np
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QUrl
+from PyQt5.QtGui import QDesktopServices, QIcon
+from PyQt5.QtWidgets import QListView, QAbstractItemView
+
+from src.commands.postprocess import TagPostProcessor, RATING_LABELS
+from src.commands.thumbnail_cache import ThumbnailCache
+from src.gui.thumbnails import ThumbnailService
+
+FILE_PATH = Qt.UserRole
+RATING = Qt.UserRole + 1
+CHARACTER_RESULTS = Qt.UserRole + 2
+GENERAL_RESULTS = Qt.UserRole + 3
+TEXT = Qt.UserRole + 4
+TAG_STATE = Qt.UserRole + 5
+THUMBNAIL = Qt.UserRole + 6
+
+RESULT_ROLES = (RATING, CHARACTER_RESULTS, GENERAL_RESULTS)
+
+
+class StoreResults:
+    """
+    Thresholded results of the rows of a ResultsStore, built when a row is shown.
+    The last few rows are cached since a page reads several roles of the same row in a row.
+    The labels within threshold of every row are kept as column numbers in chunks of the store, see select,
+    so the text of any row is a lookup and changing the thresholds does not build results.
+    :param store: results store of the job
+    :param score_threshold: general tags threshold
+    :param char_threshold: character tags threshold
+    :param cache_size: number of rows to keep results for
+    """
+    def __init__(self, store, score_threshold, char_threshold, cache_size=32):
+        self.store = store
+        self.postprocessor = TagPostProcessor(store.labels, store.char_labels)
+        self.tag_names = RATING_LABELS + list(store.labels)  # what the numbers of tag_ids stand for
+        self.score_threshold = score_threshold
+        self.char_threshold = char_threshold
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._chunks = []  # (offsets, label columns, tagged, rating) of consecutive store rows
+        self._starts = []  # first store row of each chunk
+        self._selected = 0  # store rows covered by the chunks
+
+    def set_thresholds(self, score_threshold, char_threshold):
+        self.score_threshold = score_threshold
+        self.char_threshold = char_threshold
+        self._cache.clear()
+        self._chunks = []
+        self._starts = []
+        self._selected = 0
+
+    def select(self, tag_count=None, chunk_size=1024):
+        """
+        Selects the labels of the rows added to the store since the last call, a chunk at a time
+        :param tag_count: if given, the labels of the newly selected rows are counted into it
+        :param chunk_size: rows read at once
+        """
+        # the postprocessor compares float16 as is, only uint8 stores need converting
+        dtype = np.float16 if self.store.dtype == np.float16 else np.float32
+        end = len(self.store)
+        for start in range(self._selected, end, chunk_size):
+            probs = self.store.read(slice(start, min(start + chunk_size, end)), dtype)
+            counts, cols, tagged, rating = self.postprocessor.select(probs, self.score_threshold,
+                                                                     self.char_threshold, tag_count)
+            offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+            np.cumsum(counts, out=offsets[1:])
+            self._chunks.append((offsets, cols.astype(np.int32), tagged, rating))
+            self._starts.append(start)
+        self._selected = max(self._selected, end)
+
+    def tagged(self):
+        """
+        :return: bool array of the selected rows, True for rows with tags within threshold, see has_tags
+        """
+        if not self._chunks:
+            return np.zeros(0, dtype=bool)
+        return np.concatenate([tagged for _, _, tagged, _ in self._chunks])
+
+    def tags(self, row):
+        """
+        :param row: row of the store
+        :return: labels of result_all in order, the highest rating first, without building the result
+        """
+        if row >= self._selected:
+            self.select()
+        chunk = bisect_right(self._starts, row) - 1
+        offsets, cols, _, rating = self._chunks[chunk]
+        i = row - self._starts[chunk]
+        return [RATING_LABELS[rating[i]], *self.postprocessor.labels[cols[offsets[i]:offsets[i + 1]]].tolist()]
+
+    def tag_ids(self, rows):
+        """
+        tags for many rows at once, as numbers into tag_names so no strings are made per row
+        :param rows: rows of the store
+        :return: (counts, ids): number of tags of each row and the tags row after row, in the order of tags
+        """
+        rows = np.asarray(rows, dtype=np.intp)
+        if len(rows) and rows.max() >= self._selected:
+            self.select()
+        if not self._chunks:
+            return np.zeros(len(rows), dtype=np.int64), np.zeros(0, dtype=np.int32)
+        # offsets into the columns of every chunk one after the other
+        bases = np.cumsum([0] + [len(cols) for _, cols, _, _ in self._chunks])
+        offsets = np.concatenate([chunk[0][:-1] + base for chunk, base in zip(self._chunks, bases.tolist())]
+                                 + [bases[-1:]])
+        cols = np.concatenate([cols for _, cols, _, _ in self._chunks])
+        rating = np.concatenate([rating for _, _, _, rating in self._chunks])
+
+        starts = offsets[rows]
+        counts = offsets[rows + 1] - starts + 1
+        ends = np.cumsum(counts)
+        firsts = ends - counts
+        ids = np.empty(ends[-1] if len(ends) else 0, dtype=np.int32)
+        # the highest rating leads each row, like tags
+        ids[firsts] = rating[rows]
+        is_label = np.ones(len(ids), dtype=bool)
+        is_label[firsts] = False
+        positions = np.flatnonzero(is_label)
+        ids[positions] = cols[positions + np.repeat(starts - firsts - 1, counts - 1)] + len(RATING_LABELS)
+        return counts, ids
+
+    def result(self, row):
+        """
+        :param row: row of the store
+        :return: (result_threshold, result_all, result_rating, result_char, result_text)
+        """
+        result = self._cache.get(row)
+        if result is not None:
+            self._cache.move_to_end(row)
+            return result
+        result = self.postprocessor.process(self.store.read(row), self.score_threshold, self.char_threshold,
+                                            include_rating=True)[0]
+        self._cache[row] = result
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return result
+
+
+class ResultEdits:
+    """ What the user changed on one image, only images that were edited have one"""
+    __slots__ = ("custom", "overrides", "text")
+
+    def __init__(self):
+        self.custom = {}  # role -> {tag: value} of tags added by hand
+        self.overrides = {}  # tag -> check state that differs from the default
+        self.text = None  # tags of the text output set by hand, built from the other edits once thresholds change
+
+
+class ResultRecord:
+    """
+    Handle on one row of a ResultsModel with the data/setData of a QListWidgetItem, nothing is copied out of the model
+    """
+    __slots__ = ("model", "row")
+
+    def __init__(self, model, row):
+        self.model = model
+        self.row = row
+
+    def data(self, role):
+        return self.model.data(self.model.index(self.row), role)
+
+    def setData(self, role, value):
+        self.model.setData(self.model.index(self.row), value, role)
+
+    def text(self):
+        return self.data(Qt.DisplayRole)
+
+    def checkState(self):
+        return self.data(Qt.CheckStateRole)
+
+    def setCheckState(self, state):
+        self.setData(Qt.CheckStateRole, state)
+
+
+class ResultsModel(QAbstractListModel):
+    """
+    Results of a tagging job for the tagger's file list and the file manager's gallery, one row per image.
+    Rows are kept in columns: paths, rows of the results store and file check states,
+    so 100k images cost a few dozen bytes each.
+    The text output, ratings and tags with their probabilities are read from the results store when a row asks
+    for them, tags added by hand and changed check states are kept in a ResultEdits of the rows that have them.
+    Roles are the ones the QListWidgetItems used to hold. THUMBNAIL is only made for rows a view asks for,
+    on the threads of a ThumbnailService, the row shows a placeholder until it is ready.
+    """
+    def __init__(self, parent=None, thumbnails=None):
+        super().__init__(parent)
+        self.results = None  # StoreResults
+        self.paths = []
+        self.store_rows = array('q')
+        self.checked = bytearray()
+        self.edits = {}  # row -> ResultEdits
+        if thumbnails is None:
+            try:
+                cache = ThumbnailCache()
+            except (sqlite3.Error, OSError) as e:
+                print("Thumbnail cache disabled:", e)
+                cache = None
+            thumbnails = ThumbnailService(cache=cache, parent=self)
+        self.thumbnails = thumbnails
+        self.thumbnails.ready.connect(self._thumbnail_ready)
+        self._waiting = {}  # path -> row waiting for its thumbnail
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.paths)
+
+    def flags(self, index):
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsUserCheckable
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = index.row()
+        if role == Qt.DisplayRole:
+            return os.path.basename(self.paths[row])
+        if role == FILE_PATH:
+            return self.paths[row]
+        if role == TEXT:
+            return self.text(row)
+        if role == Qt.CheckStateRole:
+            return Qt.Checked if self.checked[row] else Qt.Unchecked
+        if role in RESULT_ROLES:
+            _, rating_results, char_results, threshold_results = self._results(row)
+            # copies, callers add tags to what they get back and the cached result is shared
+            return dict({RATING: rating_results, CHARACTER_RESULTS: char_results,
+                         GENERAL_RESULTS: threshold_results}[role])
+        if role == TAG_STATE:
+            tag_state = self.default_tag_state(row)
+            edits = self.edits.get(row)
+            if edits is not None:
+                tag_state.update(edits.overrides)
+            return tag_state
+        if role == THUMBNAIL:
+            return self.thumbnail(row)
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if not index.isValid():
+            return False
+        row = index.row()
+        if role == Qt.CheckStateRole:
+            self.checked[row] = value == Qt.Checked
+        elif role == FILE_PATH:
+            self.paths[row] = value
+        elif role == TEXT:
+            self._edits(row).text = value.split(', ') if value else []
+        elif role in (CHARACTER_RESULTS, GENERAL_RESULTS):
+            # tags added by hand are stored with a probability of 10
+            self._edits(row).custom[role] = {tag: prob for tag, prob in value.items() if prob > 1}
+        elif role == TAG_STATE:
+            defaults = self.default_tag_state(row)
+            self._edits(row).overrides = {tag: state for tag, state in value.items() if defaults.get(tag) != state}
+        else:
+            return False
+        self.dataChanged.emit(index, index, [role])
+        return True
+
+    def set_results(self, results):
+        """
+        Starts over with the results of a new job
+        :param results: StoreResults of the job
+        """
+        self.beginResetModel()
+        self.results = results
+        self.paths = []
+        self.store_rows = array('q')
+        self.checked = bytearray()
+        self.edits = {}
+        self._waiting = {}
+        self.thumbnails.clear()
+        self.endResetModel()
+
+    def append(self, entries):
+        """
+        Adds images at the end, one insert for the whole batch
+        :param entries: list of (file path, row in the results store)
+        """
+        if not entries:
+            return
+        first = len(self.paths)
+        self.beginInsertRows(QModelIndex(), first, first + len(entries) - 1)
+        for file_path, store_row in entries:
+            self.paths.append(file_path)
+            self.store_rows.append(store_row)
+        self.checked.extend(bytes(len(entries)))
+        self.endInsertRows()
+
+    def thresholds_changed(self):
+        """
+        Tells the views the text output of every row may have changed, call after StoreResults.set_thresholds.
+        Text set by hand is built again from the tags added by hand and the unchecked tags.
+        """
+        for edits in self.edits.values():
+            edits.text = None
+        if self.paths:
+            self.dataChanged.emit(self.index(0), self.index(len(self.paths) - 1), [TEXT])
+
+    def tags(self, row):
+        """
+        :return: tags of the text output of a row
+        """
+        edits = self.edits.get(row)
+        if edits is not None and edits.text is not None:
+            return edits.text
+        result_all = self.results.tags(self.store_rows[row])
+        if edits is None:
+            return result_all
+        tags = [tag for tag in result_all if edits.overrides.get(tag, True)]
+        for custom in edits.custom.values():
+            tags += [tag for tag in custom if tag not in result_all and edits.overrides.get(tag, True)]
+        return tags
+
+    def text(self, row):
+        return ', '.join(self.tags(row))
+
+    def tag_ids(self, first, last):
+        """
+        tags of rows first to last at once, see StoreResults.tag_ids.
+        Rows that were edited get the tags of their results, read their tags with tags
+        :return: (counts, ids, names)
+        """
+        if self.results is None:
+            return np.zeros(last - first + 1, dtype=np.int64), np.zeros(0, dtype=np.int32), []
+        rows = np.frombuffer(self.store_rows, dtype=np.int64)[first:last + 1]
+        counts, ids = self.results.tag_ids(rows)
+        return counts, ids, self.results.tag_names
+
+    def default_tag_state(self, row):
+        """
+        :return: the highest rating and every tag within threshold checked
+        """
+        _, rating_results, char_results, threshold_results = self._results(row)
+        max_rating_key = max(rating_results, key=rating_results.get)
+        tag_state = {key: key == max_rating_key for key in rating_results}
+        tag_state.update(dict.fromkeys(char_results, True))
+        tag_state.update(dict.fromkeys(threshold_results, True))
+        return tag_state
+
+    def thumbnail(self, row):
+        """
+        :return: 200 pixel high icon of the image, a placeholder while it is being made
+        """
+        path = self.paths[row]
+        pixmap = self.thumbnails.pixmap(path)
+        if pixmap is not None:
+            return QIcon(pixmap)
+        self._waiting[path] = row
+        self.thumbnails.request(path)
+        return self.thumbnails.placeholder
+
+    def _thumbnail_ready(self, path):
+        row = self._waiting.pop(path, None)
+        if row is not None and row < len(self.paths) and self.paths[row] == path:
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [THUMBNAIL])
+
+    def _results(self, row):
+        threshold_results, result_all, rating_results, char_results, _ = self.results.result(self.store_rows[row])
+        edits = self.edits.get(row)
+        if edits is None or not edits.custom:
+            return result_all, rating_results, char_results, threshold_results
+        char_results = {**char_results, **edits.custom.get(CHARACTER_RESULTS, {})}
+        threshold_results = {**threshold_results, **edits.custom.get(GENERAL_RESULTS, {})}
+        return result_all, rating_results, char_results, threshold_results
+
+    def _edits(self, row):
+        edits = self.edits.get(row)
+        if edits is None:
+            edits = self.edits[row] = ResultEdits()
+        return edits
+
+
+class ResultsList(QListView):
+    """
+    File list of the tagger over a ResultsModel, keeps the item API of the CheckListWidget it replaces
+    so rows can be read with item(row).data(role) and checked with space or cleared with ctrl + D
+    """
+    def __init__(self, model=None):
+        super().__init__()
+        self.setSelectionMode(QAbstractItemView.ExtendedSelection)  # Allows ctrl and  shift click selection
+        self.setUniformItemSizes(True)  # rows all have the same height, scrolling does not measure each of them
+        self.setModel(model if model is not None else ResultsModel(self))
+
+    def count(self):
+        return self.model().rowCount()
+
+    def item(self, row):
+        return ResultRecord(self.model(), row) if 0 <= row < self.count() else None
+
+    def currentRow(self):
+        return self.currentIndex().row()
+
+    def currentItem(self):
+        return self.item(self.currentRow())
+
+    def setCurrentRow(self, row):
+        self.setCurrentIndex(self.model().index(row))
+
+    def clear(self):
+        self.model().set_results(self.model().results)
+
+    def getCheckedRows(self):
+        return [row for row, checked in enumerate(self.model().checked) if checked]
+
+    def getUncheckedRows(self):
+        return [row for row, checked in enumerate(self.model().checked) if not checked]
+
+    def check_all(self):
+        self._set_checked(range(self.count()), Qt.Checked)
+
+    def uncheck_all(self):
+        self._set_checked(range(self.count()), Qt.Unchecked)
+
+    def clear_selection(self):
+        self._set_checked(self._selected_rows(), Qt.Unchecked)
+
+    def _selected_rows(self):
+        return [index.row() for index in self.selectionModel().selectedIndexes()]
+
+    def _set_checked(self, rows, state):
+        model = self.model()
+        for row in rows:
+            model.checked[row] = state == Qt.Checked
+        if model.rowCount():
+            model.dataChanged.emit(model.index(0), model.index(model.rowCount() - 1), [Qt.CheckStateRole])
+
+    def keyPressEvent(self, event):
+        # on space key press swap states
+        if event.key() == Qt.Key_Space:
+            model = self.model()
+            for row in self._selected_rows():
+                model.setData(model.index(row), Qt.Unchecked if model.checked[row] else Qt.Checked, Qt.CheckStateRole)
+
+        # Uncheck all selected items with CTRL + D
+        elif event.modifiers() == Qt.ControlModifier and event.key() == Qt.Key_D:
+            self.clear_selection()
+        # do default action
+        else:
+            super().keyPressEvent(event)
+
+    def mouseDoubleClickEvent(self, event):
+        try:
+            index = self.indexAt(event.pos())
+            if index.isValid():
+                file_path = index.data(FILE_PATH)
+                if file_path:
+                    QDesktopServices.openUrl(QUrl.fromLocalFile(file_path))
+
+            # Call the base class implementation to allow for additional processing
+            super().mouseDoubleClickEvent(event)
+
+        except Exception as e:
+            print(e)
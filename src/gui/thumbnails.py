@@ -0,0 +1,186 @@
+from collections import OrderedDict
+
+from PyQt5.QtCore import Qt, QObject, QRunnable, QSize, QThreadPool, pyqtSignal, QBuffer, QByteArray, QIODevice
+from PyQt5.QtGui import QColor, QIcon, QImage, QImageIOHandler, QImageReader, QPixmap
+
+
+def _read(path, scale):
+    """
+    Decodes an image at a reduced size, formats such as JPEG skip most of the work at reduced scale.
+    Safe to call from any thread, it only uses QImage
+    :param path: image file name
+    :param scale: takes the size of the image as shown and returns the size to decode it at, None for full size
+    :return: QImage, null if the file could not be read
+    """
+    reader = QImageReader(path)
+    reader.setAutoTransform(True)  # follow the EXIF orientation like QPixmap does
+    size = reader.size()
+    if size.isValid() and size.height() > 0:
+        # the scaled size applies before rotating, the height shown is the width read
+        rotated = bool(reader.transformation() & QImageIOHandler.TransformationRotate90)
+        if rotated:
+            size.transpose()
+        scaled = scale(size)
+        if scaled is not None and scaled.width() * scaled.height() < size.width() * size.height():
+            if rotated:
+                scaled.transpose()
+            reader.setScaledSize(scaled)
+    return reader.read()
+
+
+def read_thumbnail(path, height=200):
+    """
+    Decodes an image straight to thumbnail size
+    :param path: image file name
+    :param height: height of the thumbnail
+    :return: QImage, null if the file could not be read
+    """
+    image = _read(path, lambda size: QSize(max(1, round(size.width() * height / size.height())), height))
+    if not image.isNull() and image.height() != height:
+        image = image.scaledToHeight(height, Qt.FastTransformation)
+    return image
+
+
+def read_scaled(path, width, height):
+    """
+    Decodes an image to fit in width x height, smaller images are not enlarged
+    :param path: image file name
+    :param width: width to fit in
+    :param height: height to fit in
+    :return: QImage, null if the file could not be read
+    """
+    image = _read(path, lambda size: size.scaled(width, height, Qt.KeepAspectRatio)
+                  if size.width() > width or size.height() > height else None)
+    if not image.isNull() and (image.width() > width or image.height() > height):
+        image = image.scaled(width, height, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    return image
+
+
+def load_thumbnail(path, height=200, cache=None):
+    """
+    read_thumbnail through a ThumbnailCache, thumbnails that are not cached yet are stored as JPEG,
+    or PNG if the image has transparency
+    :param path: image file name
+    :param height: height of the thumbnail
+    :param cache: ThumbnailCache or None
+    :return: QImage, null if the file could not be read
+    """
+    if cache is not None:
+        data = cache.get(path, height)
+        if data is not None:
+            image = QImage.fromData(data)
+            if not image.isNull():
+                return image
+    image = read_thumbnail(path, height)
+    if cache is not None and not image.isNull():
+        data = QByteArray()
+        buffer = QBuffer(data)
+        buffer.open(QIODevice.WriteOnly)
+        if image.hasAlphaChannel():
+            image.save(buffer, "PNG")
+        else:
+            image.save(buffer, "JPG", 85)
+        cache.put(path, height, bytes(data))
+    return image
+
+
+class _Signals(QObject):
+    loaded = pyqtSignal(str, QImage)
+
+
+class _ThumbnailTask(QRunnable):
+    def __init__(self, path, height, cache, signals):
+        super().__init__()
+        self.setAutoDelete(False)  # the service keeps it until it is done or taken back
+        self.path = path
+        self.height = height
+        self.cache = cache
+        self.signals = signals
+
+    def run(self):
+        self.signals.loaded.emit(self.path, load_thumbnail(self.path, self.height, self.cache))
+
+
+class ThumbnailService(QObject):
+    """
+    Makes thumbnails on worker threads for the rows a view is showing.
+    pixmap() returns a thumbnail that is ready, request() queues one and ready is emitted once it is,
+    views show placeholder meanwhile. Requests waiting longest are dropped once there are more than max_pending,
+    after scrolling past a lot of images only the ones on screen are decoded.
+    With a ThumbnailCache, thumbnails made in earlier sessions are read back instead of decoding the image.
+    :param height: thumbnail height in pixels
+    :param cache_size: number of QPixmaps to keep
+    :param max_pending: requests to keep queued
+    :param threads: decoding threads, defaults to half the cores
+    :param cache: ThumbnailCache shared by the threads
+    """
+    ready = pyqtSignal(str)
+
+    def __init__(self, height=200, cache_size=512, max_pending=64, threads=None, cache=None, parent=None):
+        super().__init__(parent)
+        self.height = height
+        self.cache = cache
+        self.cache_size = cache_size
+        self.max_pending = max_pending
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(threads or max(2, QThreadPool.globalInstance().maxThreadCount() // 2))
+        self._pixmaps = OrderedDict()  # path -> QPixmap, least recently used first
+        self._pending = OrderedDict()  # path -> _ThumbnailTask, oldest first
+        self._priority = 0
+        self._signals = _Signals(self)
+        self._signals.loaded.connect(self._loaded)
+
+        placeholder = QPixmap(height * 4 // 3, height)
+        placeholder.fill(QColor(60, 60, 60))
+        self.placeholder = QIcon(placeholder)
+
+    def pixmap(self, path):
+        """
+        :param path: image file name
+        :return: thumbnail if it is ready, None otherwise
+        """
+        pixmap = self._pixmaps.get(path)
+        if pixmap is not None:
+            self._pixmaps.move_to_end(path)
+        return pixmap
+
+    def request(self, path):
+        """
+        Queues a thumbnail, the most recent requests are decoded first
+        :param path: image file name
+        """
+        if path in self._pending:
+            return
+        task = _ThumbnailTask(path, self.height, self.cache, self._signals)
+        self._pending[path] = task
+        self._priority += 1
+        self.pool.start(task, self._priority)
+        while len(self._pending) > self.max_pending:
+            old_path, old_task = next(iter(self._pending.items()))
+            if not self.pool.tryTake(old_task):
+                break  # already decoding, it will finish soon
+            del self._pending[old_path]
+
+    def clear(self):
+        """ Drops queued requests and cached thumbnails"""
+        for task in list(self._pending.values()):
+            self.pool.tryTake(task)
+        self._pending.clear()
+        self._pixmaps.clear()
+
+    def close(self):
+        """ Waits for the threads and closes the cache"""
+        self.clear()
+        self.pool.waitForDone()
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+    def _loaded(self, path, image):
+        if self._pending.pop(path, None) is None:
+            return  # cleared while it was decoding
+        # QPixmap can only be made on the GUI thread
+        self._pixmaps[path] = QPixmap.fromImage(image)
+        if len(self._pixmaps) > self.cache_size:
+            self._pixmaps.popitem(last=False)
+        self.ready.emit(path)
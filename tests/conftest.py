@@ -0,0 +1,20 @@
+import pytest
+from PyQt5.QtCore import QSettings
+
+
+@pytest.fixture(autouse=True)
+def settings_path(tmp_path_factory):
+    """Keeps the settings of the app, like the model loaded on start, out of the user's own"""
+    path = str(tmp_path_factory.mktemp("settings"))
+    for settings_format in (QSettings.NativeFormat, QSettings.IniFormat):
+        QSettings.setPath(settings_format, QSettings.UserScope, path)
+    return path
+
+
+@pytest.fixture(autouse=True)
+def cache_path(tmp_path_factory, monkeypatch):
+    """Keeps the caches the app makes by default, thumbnails, predictions, models and jobs, out of the user's own"""
+    path = str(tmp_path_factory.mktemp("cache"))
+    monkeypatch.setenv("XDG_CACHE_HOME", path)
+    monkeypatch.setenv("LOCALAPPDATA", path)
+    return path
@@ -0,0 +1,29 @@
+from benchmarks.bench_throughput import STAGES, run_benchmark
+from benchmarks.synthetic import make_images, write_model
+from src.commands.load_actions import load_model, load_labels, load_char_labels
+
+
+def test_synthetic_model(tmp_path):
+    model_path = write_model(tmp_path / "model", n_labels=50, input_size=64)
+
+    model = load_model(model_path)
+    assert model.input_shape == (None, 64, 64, 3)
+    assert model.output_shape == (None, 53)
+    assert len(load_labels(model_path)) == 50
+    assert len(load_char_labels(model_path)) == 5
+
+
+def test_make_images(tmp_path):
+    paths = make_images(tmp_path, 3, (40, 30), "png")
+    assert len(paths) == 3
+    assert all(path.endswith(".png") for path in paths)
+
+
+def test_run_benchmark(tmp_path):
+    results = run_benchmark(tmp_path, images=4, resolution=(96, 64), n_labels=50, input_size=64, batch_size=2,
+                            repeat=1)
+
+    assert tuple(results["stages"]) == STAGES
+    for stage in results["stages"].values():
+        assert len(stage["runs"]) == 1
+        assert stage["images_per_second"] > 0
@@ -0,0 +1,14 @@
+import os
+
+from src.cli import main
+from src.commands.prediction_cache import APP_NAME
+
+
+def test_nothing_to_do(tmp_path):
+    assert main(["--model", str(tmp_path), str(tmp_path)]) == 2
+
+
+def test_missing_model(tmp_path, cache_path):
+    assert main(["--model", str(tmp_path), "--output", str(tmp_path / "out.jsonl"), str(tmp_path)]) == 1
+    # the default model cache goes to the cache folder of the tests, see conftest
+    assert os.path.isdir(os.path.join(cache_path, APP_NAME, "models"))
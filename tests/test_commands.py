@@ -1,14 +1,36 @@
+import contextlib
+import csv
+import json
+import os
+import sqlite3
+
 import deepdanbooru as dd
 import numpy as np
 import pytest
 import tensorflow as tf
 from PIL import Image
 
-from src.commands.exif_actions import write_tags, read_exif
+from src.commands.autotune import autotune_batch_size, tuned_batch_size, BatchSizeCache
+from src.commands.backends import load_backend, compare_backends, model_variant
+from src.commands.exif_actions import write_tags, read_exif, write_tags_all
+from src.commands.export import open_exporter, export_store
 from src.commands.load_actions import load_model, load_labels, load_char_labels
+from src.commands.metrics import PipelineMetrics
+from src.commands.model_cache import ModelCache, warm_up
+from src.commands.pipeline import list_images, decode_images, stream_images, preprocess_image, normalize_images, reduce_for_size
 from src.commands.predict_all import predict, process_images_from_directory, predict_all
+from src.commands.postprocess import TagPostProcessor, RATING_LABELS, has_tags
+from src.commands.prediction_cache import PredictionCache
+from src.commands.results_store import ResultsStore
+from src.commands.scanner import scan_images
+from src.commands.tag_index import TagIndex
+from src.commands.tagging_job import TaggingJob
+from src.commands.thumbnail_cache import ThumbnailCache
+from benchmarks.bench_postprocess import legacy_postprocess, synthetic_probs
+from benchmarks.synthetic import write_model
 
 path = r"models/deepdanbooru-v3-20211112-sgd-e28"
+requires_model = pytest.mark.skipif(not os.path.isdir(path), reason="deepdanbooru model not found")
 
 # Define paths for test images and info
 TEST_IMAGE_PATH = "test_image.jpg"
@@ -72,6 +94,107 @@ def test_predict(model, labels):
     assert result_text == "sketch, denim, greyscale, monochrome, pants, short_hair, long_sleeves, simple_background, long_hair, shirt, shorts, hood, 1girl, standing, white_background, concept_art, partially_colored, jeans, looking_at_viewer"
 
 
+def test_preprocess_compact():
+    img_path = r'tests/images/test1.jpg'
+    image = preprocess_image(img_path, (512, 512))
+    compact = preprocess_image(img_path, (512, 512), compact=True)
+
+    assert compact.dtype == np.uint8
+    assert compact.nbytes * image.itemsize == image.nbytes
+    # rounding to uint8 is the only difference
+    assert np.abs(normalize_images(compact) - image).max() <= 0.5 / 255 + 1e-6
+
+
+@requires_model
+def test_predict_compact(model, labels):
+    img_path = r'tests/images/test1.jpg'
+    _, height, width, _ = model.input_shape
+    image = preprocess_image(img_path, (height, width))
+    compact = preprocess_image(img_path, (height, width), compact=True)
+
+    _, result_all, _, _, _ = predict(model, labels, [], image, 0.5)
+    _, compact_all, _, _, _ = predict(model, labels, [], compact, 0.5)
+
+    assert list(result_all)[:10] == list(compact_all)[:10]
+    for label, prob in compact_all.items():
+        assert prob == pytest.approx(result_all.get(label, prob), abs=0.01)
+
+
+@pytest.mark.parametrize("score_threshold, char_threshold", [(0.5, 0.85), (0.9, 0.3), (0.05, 0.02), (1.0, 1.0)])
+def test_postprocess_matches_loop(score_threshold, char_threshold):
+    labels = [f"tag_{i}" for i in range(500)]
+    char_labels = set(labels[::7])
+    probs = synthetic_probs(16, len(labels))
+
+    postprocessor = TagPostProcessor(labels, char_labels)
+    results = postprocessor.process(probs, score_threshold, char_threshold)
+    counts, cols, tagged, rating = postprocessor.select(probs, score_threshold, char_threshold)
+    offsets = np.r_[0, np.cumsum(counts)]
+
+    for i, (row, result) in enumerate(zip(probs, results)):
+        expected = legacy_postprocess(row, labels, char_labels, score_threshold, char_threshold)
+        assert list(result[1].items()) == list(expected[1].items())
+        assert list(result[0].items()) == list(expected[0].items())
+        assert list(result[3].items()) == list(expected[3].items())
+        assert result[2] == dict(expected[2])
+        assert result[4] == expected[4]
+        # the same labels as column numbers
+        assert [labels[col] for col in cols[offsets[i]:offsets[i + 1]]] == list(result[1])
+        assert tagged[i] == has_tags(result)
+        assert RATING_LABELS[rating[i]] == max(result[2], key=result[2].get)
+
+
+def large_photo(path, size=(4000, 3000)):
+    # smooth gradients plus some texture, closer to a photo than flat colour
+    x = np.linspace(0, 1, size[0])[None, :, None]
+    y = np.linspace(0, 1, size[1])[:, None, None]
+    pixels = np.concatenate([x * 255 + 0 * y, y * 255 + 0 * x, (np.sin(x * 60) * np.cos(y * 40) + 1) * 127], axis=2)
+    noise = np.random.default_rng(0).normal(0, 8, pixels.shape)
+    Image.fromarray(np.clip(pixels + noise, 0, 255).astype(np.uint8)).save(path, quality=90)
+    return str(path)
+
+
+def test_reduce_for_size(tmp_path):
+    with Image.open(large_photo(tmp_path / "large.jpg")) as image:
+        reduced = reduce_for_size(image, (512, 512))
+        assert reduced.size == (1000, 750)  # 1/4 scale, 1/8 would be smaller than the model input
+
+    with Image.open(r'tests/images/test1.jpg') as image:
+        assert reduce_for_size(image, (4096, 4096)).size == image.size
+
+
+def test_fast_decode_drift(tmp_path):
+    image_path = large_photo(tmp_path / "large.jpg")
+    image = preprocess_image(image_path, (512, 512))
+    fast = preprocess_image(image_path, (512, 512), fast_decode=True)
+
+    assert fast.shape == image.shape
+    # mean drift well under one grey level, DCT scaling only differs from the area resize in fine detail
+    assert np.abs(fast - image).mean() < 1 / 255
+
+
+@requires_model
+def test_fast_decode_tag_drift(model, labels, char_labels, tmp_path):
+    _, height, width, _ = model.input_shape
+    image_paths = list_images(r"tests/images")
+    for size in [(4000, 3000), (3000, 4500)]:
+        # upscale the test images so fast decode has something to reduce
+        with Image.open(image_paths[0]) as image:
+            path = tmp_path / f"{size[0]}x{size[1]}.jpg"
+            image.convert('RGB').resize(size, Image.LANCZOS).save(path, quality=95)
+        image_paths.append(str(path))
+
+    for image_path in image_paths:
+        full = predict(model, labels, char_labels, preprocess_image(image_path, (height, width)), 0.5)
+        fast = predict(model, labels, char_labels, preprocess_image(image_path, (height, width), fast_decode=True), 0.5)
+        full_tags, fast_tags = set(full[0]) | set(full[3]), set(fast[0]) | set(fast[3])
+
+        # Jaccard similarity of the tags within threshold
+        assert len(full_tags & fast_tags) / len(full_tags | fast_tags) >= 0.9
+        for tag in full_tags & fast_tags:
+            assert full[1][tag] == pytest.approx(fast[1][tag], abs=0.05)
+
+
 def test_process_all(model, labels):
     dir = r"tests/images"
     images = process_images_from_directory(model, dir)
@@ -96,6 +219,48 @@ def test_predict_all(model, labels, char_labels):
         assert len(result_text) > 0
 
 
+def test_stream_images():
+    dir = r"tests/images"
+    batches = list(stream_images(list_images(dir), (512, 512), batch_size=2, queue_depth=1))
+
+    assert sorted(len(filenames) for filenames, _ in batches) == [1, 2]
+    for filenames, images in batches:
+        assert images.shape == (len(filenames), 512, 512, 3)
+
+
+def test_stream_images_process_backend():
+    image_paths = list_images(r"tests/images")
+    threaded = {}
+    for filenames, images in stream_images(image_paths, (512, 512), compact=True):
+        threaded.update(zip(filenames, images))
+
+    batches = list(stream_images(image_paths, (512, 512), batch_size=2, workers=1, compact=True, backend="process"))
+
+    assert [filename for filenames, _ in batches for filename in filenames] == image_paths
+    for filenames, images in batches:
+        for filename, image in zip(filenames, images):
+            assert np.array_equal(image, threaded[filename])
+
+
+def test_decode_images_tfdata(tmp_path):
+    image_paths = list_images(r"tests/images")
+    threaded = {path: image for path, image, _ in decode_images(image_paths, (512, 512), compact=True)}
+    broken = tmp_path / "broken.jpg"
+    broken.write_bytes(b"not an image")
+    lookup = {image_paths[1]: "cached"}.get
+
+    items = list(decode_images([image_paths[0], str(broken)] + image_paths[1:], (512, 512), capacity=4, workers=2,
+                               compact=True, lookup=lookup, backend="tfdata"))
+
+    # in order, without the file that failed to decode
+    assert [path for path, _, _ in items] == image_paths
+    for path, image, found in items:
+        if path == image_paths[1]:
+            assert image is None and found == "cached"
+        else:
+            assert found is None and np.array_equal(image, threaded[path])
+
+
 def test_write_tags(tmp_path):
     image_path = tmp_path / 'test.jpg'
     image = Image.new('RGB', (300, 300), color='red')
@@ -104,3 +269,407 @@ def test_write_tags(tmp_path):
     write_tags(image_path, "TEST")
     assert read_exif(image_path) == "TEST"
 
+
+@pytest.mark.parametrize("image_format", ["jpeg", "png", "webp"])
+def test_write_tags_lossless(tmp_path, image_format):
+    image_path = tmp_path / f"test.{image_format}"
+    exif = Image.Exif()
+    exif[274] = 6  # orientation
+    Image.new('RGB', (64, 48), color='blue').save(image_path, exif=exif.tobytes())
+    before = image_path.read_bytes()
+
+    write_tags(image_path, "first, tag")
+    write_tags(image_path, "hat, smile")
+    assert read_exif(image_path) == "hat, smile"
+    if image_format == "webp":
+        return  # saved again through PIL
+    with Image.open(image_path) as image:
+        assert image.getexif()[274] == 6
+    if image_format == "jpeg":
+        # the compressed image data is copied as is
+        assert image_path.read_bytes().endswith(before[before.index(b"\xff\xda"):])
+    elif image_format == "png":
+        assert image_path.read_bytes().endswith(before[before.index(b"IDAT") - 4:])
+
+
+def test_write_tags_all(tmp_path, monkeypatch):
+    paths = []
+    for i in range(6):
+        paths.append(str(tmp_path / f"{i}.jpg"))
+        Image.new('RGB', (32, 32), color='red').save(paths[-1])
+    broken = tmp_path / "broken.jpg"
+    broken.write_bytes(b"not an image")
+    items = [(path, f"tag_{i}") for i, path in enumerate(paths)]
+    items += [(str(broken), "x"), (str(tmp_path / "missing.jpg"), "x")]
+
+    written = []
+    failures = write_tags_all(items, workers=2, on_written=lambda path, error: written.append(path))
+    assert sorted(written) == sorted(path for path, _ in items)
+    assert sorted(path for path, _ in failures) == sorted([str(broken), str(tmp_path / "missing.jpg")])
+    assert [read_exif(path) for path in paths] == [f"tag_{i}" for i in range(6)]
+    # failed writes leave the original and no temporary files behind
+    assert broken.read_bytes() == b"not an image"
+    assert sorted(os.listdir(tmp_path)) == sorted(["broken.jpg"] + [f"{i}.jpg" for i in range(6)])
+
+    # any error is reported per file instead of stopping the batch
+    def malformed(image_path, info):
+        if image_path == paths[0]:
+            raise KeyError("bad exif")
+        write_tags(image_path, info)
+
+    monkeypatch.setattr("src.commands.exif_actions.write_tags", malformed)
+    failures = write_tags_all([(path, "again") for path in paths], workers=2)
+    assert [path for path, _ in failures] == [paths[0]]
+    assert [read_exif(path) for path in paths[1:]] == ["again"] * 5
+
+
+@pytest.mark.parametrize("export_format", ["jsonl", "csv", "sqlite", "txt", "json"])
+def test_export(tmp_path, export_format):
+    labels = ["hat", "smile", "char_a"]
+    store = ResultsStore(labels=labels, char_labels=["char_a"])
+    paths = [str(tmp_path / "a.jpg"), str(tmp_path / "b.jpg"), str(tmp_path / "c.jpg")]
+    store.append(paths, [[0.91234, 0.2, 0.95, 0.8, 0.1, 0.1],
+                         [0.1, 0.7, 0.3, 0.1, 0.9, 0.2],
+                         [0.1, 0.1, 0.1, 0.9, 0.1, 0.1]])
+    output = str(tmp_path / f"out.{export_format}")
+    with open_exporter(export_format, output, precision=2, batch_size=1) as exporter:
+        # the last image has no tags within threshold
+        assert export_store(store, exporter, 0.5, 0.85) == 2
+
+    if export_format == "jsonl":
+        records = [json.loads(line) for line in open(output, encoding='utf-8')]
+    elif export_format == "csv":
+        with open(output, newline='', encoding='utf-8') as f:
+            records = [{**row, "general": json.loads(row["general"])} for row in csv.DictReader(f)]
+    elif export_format == "sqlite":
+        with contextlib.closing(sqlite3.connect(output)) as db:
+            records = [{"file": file, "tags": tags, "general": json.loads(general)}
+                       for file, tags, general in db.execute("SELECT file, tags, general FROM results ORDER BY file")]
+    elif export_format == "json":
+        records = [json.load(open(path[:-4] + ".json", encoding='utf-8')) for path in paths[:2]]
+    else:
+        records = [{"file": path, "tags": open(path[:-4] + ".txt", encoding='utf-8').read()} for path in paths[:2]]
+        assert not os.path.exists(paths[2][:-4] + ".txt")
+    assert [record["file"] for record in records] == paths[:2]
+    assert records[0]["tags"] == "rating:safe, char_a, hat, smile"
+    if "general" in records[0]:
+        assert records[0]["general"] == {"hat": 0.91}
+
+    # edited tags and only the images given
+    with open_exporter("jsonl", output) as exporter:
+        assert export_store(store, exporter, 0.5, 0.85, {paths[1]: "smile, mine"}) == 1
+    assert json.loads(open(output, encoding='utf-8').read())["tags"] == "smile, mine"
+
+
+def test_model_cache(tmp_path):
+    model_path = write_model(tmp_path / "model", n_labels=20, input_size=64)
+    cache = ModelCache(tmp_path / "cache")
+    images = np.random.default_rng(0).random((2, 64, 64, 3), dtype=np.float32)
+
+    converted = load_model(model_path, cache)
+    entry = cache.entry(os.path.join(model_path, PredictionCache.model_file))
+    assert os.path.isfile(os.path.join(entry, ModelCache.weights_file))
+    cached = load_model(model_path, cache)
+    warm_up(cached)
+    assert np.allclose(cached.predict_on_batch(images), load_model(model_path).predict_on_batch(images))
+    assert np.allclose(cached.predict_on_batch(images), converted.predict_on_batch(images))
+
+    # a different model in the same place gets its own copy
+    write_model(model_path, n_labels=10, input_size=64)
+    assert cache.entry(os.path.join(model_path, PredictionCache.model_file)) != entry
+    assert load_model(model_path, cache).output_shape == (None, 13)
+
+
+@pytest.mark.parametrize("backend", ["tflite", "tflite-int8"])
+def test_tflite_backend(tmp_path, backend):
+    model_path = write_model(tmp_path / "model", n_labels=20, input_size=64)
+    model_file = os.path.join(model_path, PredictionCache.model_file)
+    cache = ModelCache(tmp_path / "cache")
+    image_paths = []
+    for i in range(4):
+        image_paths.append(str(tmp_path / f"{i}.png"))
+        Image.new('RGB', (80, 60), color=(60 * i, 100, 200 - 40 * i)).save(image_paths[-1])
+    model = load_model(model_path)
+
+    converted, calibration = load_backend(model, backend, image_paths, 3, cache, model_file)
+    assert len(calibration) == 3 and model_variant(converted).startswith(backend)
+    assert converted.input_shape == model.input_shape and converted.output_shape == model.output_shape
+    assert converted.predict_on_batch(np.stack(calibration)).shape == (3, 23)
+    assert converted.predict_on_batch(calibration[0][None, ...]).shape == (1, 23)
+    assert compare_backends(model, converted, calibration)["rating_match"] == 1.
+    assert os.path.isfile(cache.tflite_path(model_file, model_variant(converted)))
+    # the cached conversion is used again
+    cached, _ = load_backend(model, backend, image_paths, 3, cache, model_file)
+    assert np.allclose(cached.predict_on_batch(np.stack(calibration)),
+                       converted.predict_on_batch(np.stack(calibration)))
+
+
+def test_prediction_cache(tmp_path):
+    model_dir = tmp_path / "model"
+    model_dir.mkdir()
+    (model_dir / "model-resnet_custom_v3.h5").write_bytes(b"weights")
+    (model_dir / "tags.txt").write_text("a\nb\n")
+    image_path = str(tmp_path / "image.png")
+    Image.new('RGB', (10, 10), color='red').save(image_path)
+    db_path = tmp_path / "cache.sqlite3"
+
+    cache = PredictionCache(model_dir, db_path)
+    assert cache.get(image_path) is None
+    cache.put(image_path, np.array([0.1, 0.2, 0.3]))
+    assert cache.get(image_path) == pytest.approx([0.1, 0.2, 0.3])
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+    # fast decoded images predict slightly differently
+    assert cache.get(image_path, fast_decode=True) is None
+    cache.put(image_path, np.array([0.4, 0.5, 0.6]), fast_decode=True)
+    assert cache.get(image_path, fast_decode=True) == pytest.approx([0.4, 0.5, 0.6])
+    assert cache.get(image_path) == pytest.approx([0.1, 0.2, 0.3])
+
+    # last use of hits is written on flush, misses that were never put are forgotten
+    other_path = str(tmp_path / "other.png")
+    Image.new('RGB', (10, 10), color='blue').save(other_path)
+    query = "SELECT MAX(last_used) FROM predictions"
+    written = sqlite3.connect(db_path).execute(query).fetchone()[0]
+    assert cache.get(image_path) is not None and cache.get(other_path) is None
+    cache.flush()
+    assert sqlite3.connect(db_path).execute(query).fetchone()[0] > written
+    assert not cache._pending
+    cache.close()
+
+    # survives restarts, misses once the tags change
+    assert PredictionCache(model_dir, db_path).get(image_path) is not None
+    (model_dir / "tags.txt").write_text("a\nc\n")
+    assert PredictionCache(model_dir, db_path).get(image_path) is None
+
+
+def test_prediction_cache_eviction(tmp_path):
+    model_dir = tmp_path / "model"
+    model_dir.mkdir()
+    (model_dir / "model-resnet_custom_v3.h5").write_bytes(b"weights")
+    (model_dir / "tags.txt").write_text("a\n")
+    cache = PredictionCache(model_dir, tmp_path / "cache.sqlite3", max_bytes=4 * 100 * 3)
+
+    paths = []
+    for i in range(5):
+        paths.append(str(tmp_path / f"{i}.png"))
+        Image.new('RGB', (10, 10), color=(i, 0, 0)).save(paths[-1])
+        cache.put(paths[-1], np.zeros(100))
+
+    assert cache.stats()["bytes"] <= cache.max_bytes
+    assert cache.get(paths[0]) is None
+    assert cache.get(paths[-1]) is not None
+
+
+def test_scan_images(tmp_path):
+    (tmp_path / "sub" / "deep").mkdir(parents=True)
+    for name in ["a.jpg", "sub/c.png", "sub/deep/d.png"]:
+        Image.new('RGB', (10, 10)).save(tmp_path / name)
+    (tmp_path / "b.txt").write_text("not an image")
+    (tmp_path / "fake.JPG").write_text("not an image either")
+
+    def scan(**kwargs):
+        return sorted(os.path.relpath(entry.path, tmp_path).replace(os.sep, "/")
+                      for entry in scan_images(tmp_path, **kwargs))
+
+    assert scan() == ["a.jpg", "fake.JPG"]
+    assert scan(check_magic=True) == ["a.jpg"]
+    assert scan(recursive=True) == ["a.jpg", "fake.JPG", "sub/c.png", "sub/deep/d.png"]
+    assert scan(recursive=True, max_depth=1) == ["a.jpg", "fake.JPG", "sub/c.png"]
+    assert scan(recursive=True, include=["*.png"], exclude=["sub/deep"]) == ["sub/c.png"]
+
+
+@pytest.fixture
+def tiny_model():
+    inputs = tf.keras.Input((32, 32, 3))
+    outputs = tf.keras.layers.Dense(8, activation='sigmoid')(tf.keras.layers.GlobalAveragePooling2D()(inputs))
+    return tf.keras.Model(inputs, outputs)
+
+
+def test_autotune(tiny_model, tmp_path):
+    result = autotune_batch_size(tiny_model, candidates=(1, 2, 4), repeats=1)
+    assert result["batch_size"] in result["throughput"] and result["image_bytes"] > 0
+    # nothing past the first size fits in the budget
+    assert autotune_batch_size(tiny_model, memory_budget=1, candidates=(1, 2, 4))["batch_size"] == 1
+
+    model_file = tmp_path / "model.h5"
+    model_file.write_bytes(b"weights")
+    cache = BatchSizeCache(tmp_path / "batch_sizes.json")
+    batch_size = tuned_batch_size(tiny_model, model_file, cache=cache)
+    assert cache.get(cache.key(model_file))["batch_size"] == batch_size
+    assert tuned_batch_size(tiny_model, model_file, override=3, cache=cache) == 3
+    assert tuned_batch_size(tiny_model, model_file, memory_budget=1, cache=cache) == 1
+
+
+def test_tagging_job_resume(tiny_model, tmp_path):
+    model_path = tmp_path / "model"
+    model_path.mkdir()
+    expected = {}
+    for filenames, probs in TaggingJob(r"tests/images").run(tiny_model, batch_size=1):
+        expected.update(zip(filenames, probs))
+
+    job = TaggingJob(r"tests/images", model_path, chunk_size=1, checkpoint_dir=tmp_path / "jobs")
+    for _ in job.run(tiny_model, batch_size=1):
+        job.cancel()
+    assert len(job.checkpoints) == 1
+
+    job = TaggingJob(r"tests/images", model_path, chunk_size=1, checkpoint_dir=tmp_path / "jobs")
+    results = {}
+    for filenames, probs in job.run(tiny_model, batch_size=1):
+        assert not results.keys() & set(filenames)
+        results.update(zip(filenames, probs))
+
+    assert job.restored == 1
+    assert results.keys() == expected.keys()
+    for filename, probs in expected.items():
+        assert np.allclose(results[filename], probs)
+    assert job.checkpoints == []
+
+
+def test_pipeline_metrics(tiny_model, tmp_path):
+    metrics = PipelineMetrics()
+    image_paths = list_images(r"tests/images")
+    for _ in TaggingJob(r"tests/images").run(tiny_model, image_paths, batch_size=2, metrics=metrics):
+        pass
+    metrics.finish()
+
+    report = metrics.report()
+    assert report["images"] == len(image_paths)
+    for stage in ("decode", "resize", "pad", "predict"):
+        assert report["stages"][stage]["count"] == len(image_paths)
+        assert sum(report["stages"][stage]["histogram"]) == len(image_paths)
+    assert report["queues"]["decoded"]["capacity"] == 8
+    assert "images/s" in metrics.summary()
+
+    metrics.save(tmp_path / "report.json")
+    metrics.save(tmp_path / "report.csv")
+    with open(tmp_path / "report.csv") as f:
+        assert len(f.readlines()) == len(report["stages"]) + 1
+
+
+def test_results_store():
+    store = ResultsStore()
+    probs = synthetic_probs(5, 20)
+    store.append(["a", "b", "c"], probs[:3])
+    store.append(["d", "b"], probs[3:])
+
+    assert len(store) == 4
+    assert store.paths == ["a", "b", "c", "d"]
+    assert store.probs.dtype == np.float16
+    assert np.allclose(store.probs[store.rows(["b", "d"])], probs[[4, 3]], atol=1e-3)
+    assert sum(len(paths) for paths, _ in store.iter_chunks(3)) == 4
+
+
+@pytest.mark.parametrize("dtype, atol", [(np.float16, 1e-3), (np.uint8, 0.5 / 255 + 1e-6)])
+def test_results_store_reopen(tmp_path, dtype, atol):
+    probs = synthetic_probs(300, 20)
+    paths = [f"image_{i}.jpg" for i in range(300)]
+    store = ResultsStore(tmp_path / "store", dtype=dtype, labels=[f"tag_{i}" for i in range(17)],
+                         char_labels=["tag_16"], info={"directory": "images"})
+    for start in range(0, 300, 7):
+        store.append(paths[start:start + 7], probs[start:start + 7])
+
+    # readable while the job is still adding rows
+    assert len(ResultsStore.open(tmp_path / "store")) == 300
+    store.close()
+    assert np.load(tmp_path / "store" / ResultsStore.probs_file).shape == probs.shape
+
+    reopened = ResultsStore.open(tmp_path / "store")
+    assert reopened.paths == paths
+    assert reopened.char_labels == ["tag_16"] and reopened.info == {"directory": "images"}
+    assert np.allclose(reopened.read(slice(None)), probs, atol=atol)
+    with pytest.raises(ValueError):
+        reopened.append(["new.jpg"], probs[:1])
+
+    # the same job run again replaces the store once the one being read is released
+    reopened.release()
+    store.release()
+    again = ResultsStore(tmp_path / "store", dtype=dtype)
+    again.append(paths[:2], probs[:2])
+    again.close()
+    assert ResultsStore.open(tmp_path / "store").paths == paths[:2]
+
+
+@pytest.mark.parametrize("score_threshold, char_threshold", [(0.5, 0.85), (0.33, 0.9), (0.85, 0.3)])
+def test_refilter_float16(score_threshold, char_threshold):
+    labels = [f"tag_{i}" for i in range(300)]
+    postprocessor = TagPostProcessor(labels, labels[-30:])
+    probs = synthetic_probs(64, len(labels)).astype(np.float16)
+
+    tag_count = {}
+    results = postprocessor.process(probs, score_threshold, char_threshold, include_rating=True, tag_count=tag_count)
+    expected = postprocessor.process(probs.astype(float), score_threshold, char_threshold, include_rating=True)
+    assert [result[4] for result in results] == [result[4] for result in expected]
+
+    counted = {}
+    for result in expected:
+        for label in result[1]:
+            counted[label] = counted.get(label, 0) + 1
+    assert tag_count == counted
+    assert postprocessor.count_tags(probs, score_threshold, char_threshold) == counted
+
+
+def test_tag_index():
+    rows = [["hat", "Smile"], ["white_hat", "smile"], ["hat", "white_hat"], []] * 5
+    index = TagIndex()
+    index.insert_rows(0, len(rows))
+    index.set_rows(0, rows)
+
+    def expected(tags, rows):
+        return [set(tags) <= {tag.lower() for tag in row} for row in rows]
+
+    # whole tags only, hat must not match white_hat
+    assert index.match(["hat"]).tolist() == expected(["hat"], rows)
+    assert index.match(["smile", "HAT"]).tolist() == expected(["smile", "hat"], rows)
+    assert not index.match(["missing"]).any()
+    assert index.match([]).all()
+
+    index.set_row(1, ["hat"])
+    rows[1] = ["hat"]
+    index.insert_rows(2, 3)
+    rows[2:2] = [[]] * 3
+    index.set_rows(2, [["hat"]] * 3)
+    rows[2:5] = [["hat"]] * 3
+    index.remove_rows(7, 4)
+    del rows[7:11]
+    assert len(index) == len(rows)
+    assert index.match(["hat"]).tolist() == expected(["hat"], rows)
+    assert index.count("white_hat") == sum(expected(["white_hat"], rows))
+    assert [index.matches_row(row, ["hat"]) for row in range(len(rows))] == expected(["hat"], rows)
+
+    # the same rows as numbers into a list of names, set on top of rows that already have tags
+    names = ["Hat", "smile", "white_hat", "", "hat "]
+    numbered = [[0, 1], [2, 1], [4, 2, 3], []] * 5
+    by_ids = TagIndex()
+    by_ids.insert_rows(0, len(numbered))
+    by_ids.set_row(3, ["smile"])
+    by_ids.set_ids(0, np.array([len(ids) for ids in numbered]), np.array(sum(numbered, []), dtype=np.int32), names)
+    named = [[names[i].strip() for i in ids] for ids in numbered]
+    assert [by_ids.tags(row) for row in range(len(named))] == [frozenset(map(str.lower, row)) - {""} for row in named]
+    for tags in (["hat"], ["smile", "white_hat"]):
+        assert by_ids.match(tags).tolist() == expected(tags, named)
+
+
+def test_thumbnail_cache(tmp_path):
+    images = []
+    for i in range(4):
+        images.append(tmp_path / f"{i}.jpg")
+        images[-1].write_bytes(b"image %d" % i)
+    cache = ThumbnailCache(tmp_path / "thumbnails.sqlite3", max_bytes=2500)
+    for image in images[:2]:
+        cache.put(image, 200, bytes(1000))
+    assert cache.get(images[0], 200) == bytes(1000)
+    assert cache.get(images[0], 100) is None
+    assert cache.get(tmp_path / "missing.jpg", 200) is None
+
+    # edited files miss
+    os.utime(images[1], ns=(0, 0))
+    assert cache.get(images[1], 200) is None
+
+    # over max_bytes the least recently used go first, images[0] was just read
+    cache.close()
+    cache = ThumbnailCache(tmp_path / "thumbnails.sqlite3", max_bytes=2500)
+    cache.put(images[2], 200, bytes(1000))
+    assert cache.stats()["bytes"] <= 2500
+    assert cache.get(images[2], 200) is not None
+    assert cache.get(images[0], 200) is not None
+    cache.close()
+
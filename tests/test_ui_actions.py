@@ -2,8 +2,14 @@ from PyQt5 import QtCore
 from PyQt5.QtCore import QRect
 from PyQt5.QtWidgets import QMainWindow, QTabWidget, QFileDialog, QApplication
 import tensorflow as tf
+from PIL import Image
 
+from src.commands.exif_actions import read_exif
+from src.commands.results_store import ResultsStore
+from src.gui.image_loader import ImageLoader
 from src.gui.main_window import MainWindow
+from src.gui.results_model import ResultsModel, StoreResults, TEXT, TAG_STATE, GENERAL_RESULTS, RATING
+from src.gui.thumbnails import read_thumbnail
 
 
 def test_load_model(qtbot):
@@ -41,3 +47,75 @@ def test_submit(qtbot):
     assert main_window.tab1.character_tags.count() == 0
     assert main_window.tab1.rating_tags.count() == 3
 
+
+def test_results_model(qtbot):
+    store = ResultsStore(labels=["hat", "white_hat", "smile"], char_labels=[])
+    store.append(["a.jpg", "b.jpg"], [[0.9, 0.2, 0.6, 0.8, 0.1, 0.1], [0.1, 0.7, 0.3, 0.1, 0.9, 0.2]])
+    model = ResultsModel()
+    model.set_results(StoreResults(store, 0.5, 0.85))
+    model.append([("a.jpg", 0), ("b.jpg", 1)])
+
+    assert model.rowCount() == 2
+    first = model.index(0)
+    assert first.data(TEXT) == "rating:safe, hat, smile, white_hat"
+    assert model.index(1).data(TEXT) == "rating:questionable, white_hat, smile"
+    assert set(first.data(GENERAL_RESULTS)) == {"hat", "smile"}
+    assert first.data(TAG_STATE)["rating:safe"] and not first.data(TAG_STATE)["rating:explicit"]
+    assert max(first.data(RATING), key=first.data(RATING).get) == "rating:safe"
+
+    # a tag added by hand and an unchecked tag survive new thresholds
+    model.setData(first, {**first.data(GENERAL_RESULTS), "mine": 10}, GENERAL_RESULTS)
+    model.setData(first, {**first.data(TAG_STATE), "mine": True, "smile": False}, TAG_STATE)
+    model.setData(first, "rating:safe, hat, mine", TEXT)
+    assert first.data(TEXT) == "rating:safe, hat, mine"
+    model.results.set_thresholds(0.1, 0.85)
+    model.thresholds_changed()
+    assert model.text(0).split(", ") == ["rating:safe", "hat", "white_hat", "mine"]
+    assert list(model.results.tagged()) == [True, True]
+
+
+def test_read_thumbnail(qtbot, tmp_path):
+    path = str(tmp_path / "wide.jpg")
+    Image.new("RGB", (1200, 600), (200, 30, 30)).save(path)
+    image = read_thumbnail(path, 200)
+    assert (image.width(), image.height()) == (400, 200)
+    assert read_thumbnail(str(tmp_path / "missing.jpg")).isNull()
+
+
+def test_image_loader(qtbot, tmp_path):
+    paths = []
+    for i in range(3):
+        paths.append(str(tmp_path / f"{i}.jpg"))
+        Image.new("RGB", (1600, 1200), (i * 80, 30, 30)).save(paths[-1])
+    loader = ImageLoader()
+    with qtbot.waitSignal(loader.ready, timeout=5000) as blocker:
+        loader.load(paths[:1], 400, 400)
+    assert blocker.args == [paths[0]]
+    pixmap = loader.pixmap(paths[0], 400, 400)
+    assert (pixmap.width(), pixmap.height()) == (400, 300)
+    assert loader.pixmap(paths[0], 800, 800) is None  # decoded again for another size
+
+    loader.load(paths, 400, 400)
+    qtbot.waitUntil(lambda: all(loader.pixmap(path, 400, 400) is not None for path in paths), timeout=5000)
+    loader.close()
+
+
+def test_tag_selected_images(qtbot, tmp_path):
+    main_window = MainWindow()
+    paths = [str(tmp_path / f"{i}.jpg") for i in range(3)]
+    for path in paths:
+        Image.new("RGB", (32, 32), (200, 30, 30)).save(path)
+    store = ResultsStore(labels=["hat"], char_labels=[])
+    store.append(paths, [[0.9, 0.9, 0.1, 0.1]] * 3)
+    model = main_window.tab1.filelist.model()
+    model.set_results(StoreResults(store, 0.5, 0.85))
+    model.append([(path, row) for row, path in enumerate(paths)])
+    main_window.tab1.filelist.uncheck_all()
+    model.setData(model.index(1), QtCore.Qt.Checked, QtCore.Qt.CheckStateRole)
+    main_window.tab1.model = object()  # tagging needs a model loaded
+    main_window.tab1.labels = ["hat"]
+
+    action_box = main_window.tab1.action_box
+    assert action_box.tag_selected_images()
+    qtbot.waitUntil(lambda: action_box.exif_pd.isHidden(), timeout=5000)
+    assert [read_exif(path) for path in paths] == [None, "rating:safe, hat", None]